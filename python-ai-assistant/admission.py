@@ -0,0 +1,97 @@
+"""Admission control of the messages received on /new-message"""
+
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+from metrics import REGISTRY, Counter
+
+SHED = REGISTRY.register(
+    Counter(
+        "ai_shed_messages_total",
+        "Messages not answered because the worker was overloaded, by reason",
+        ("reason",),
+    )
+)
+
+
+class AdmissionController:
+    """
+    Sheds new messages while the worker is overloaded, instead of queueing them
+    until memory runs out. The load is the number of generations in flight, the
+    messages queued behind them, and the recent time to the first token. A limit of
+    0 is not checked.
+
+    Channels with an active conversation, i.e. a message admitted in the last
+    `active_window` seconds, have priority: they are only shed once the load is
+    `active_headroom` times over the limits, and never for the latency alone.
+    Once closed for shutdown, every message is shed.
+    """
+
+    def __init__(
+        self,
+        in_flight: Callable[[], int],
+        queued: Callable[[], int],
+        first_token: Callable[[], float],
+        max_in_flight: int = 0,
+        max_queued: int = 0,
+        max_first_token: float = 0.0,
+        active_window: float = 300.0,
+        active_headroom: float = 2.0,
+        max_channels: int = 100000,
+    ):
+        self.in_flight = in_flight
+        self.queued = queued
+        self.first_token = first_token
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.max_first_token = max_first_token
+        self.active_window = active_window
+        self.active_headroom = active_headroom
+        self.max_channels = max_channels
+        self.closed = False
+        # Last admitted message per channel, oldest first
+        self._active: "OrderedDict[str, float]" = OrderedDict()
+        self._shed = {
+            reason: SHED.labels(reason)
+            for reason in ("in_flight", "queue", "latency", "shutdown")
+        }
+
+    def is_active(self, key: str) -> bool:
+        """Whether the channel had a message admitted recently"""
+        last = self._active.get(key)
+        return last is not None and time.monotonic() - last < self.active_window
+
+    def close(self):
+        """Stop admitting messages, the worker is shutting down"""
+        self.closed = True
+
+    def admit(self, key: str) -> Optional[str]:
+        """Admit a message of a channel, or return the reason to shed it"""
+        if self.closed:
+            self._shed["shutdown"].inc()
+            return "shutdown"
+        reason = self._overload(self.is_active(key))
+        if reason is not None:
+            self._shed[reason].inc()
+            return reason
+
+        now = time.monotonic()
+        self._active[key] = now
+        self._active.move_to_end(key)
+        while self._active and (
+            len(self._active) > self.max_channels
+            or next(iter(self._active.values())) < now - self.active_window
+        ):
+            self._active.popitem(last=False)
+        return None
+
+    def _overload(self, active: bool) -> Optional[str]:
+        headroom = self.active_headroom if active else 1.0
+        if self.max_in_flight and self.in_flight() >= self.max_in_flight * headroom:
+            return "in_flight"
+        if self.max_queued and self.queued() >= self.max_queued * headroom:
+            return "queue"
+        if not active and self.max_first_token:
+            if self.first_token() >= self.max_first_token:
+                return "latency"
+        return None
@@ -1,24 +1,22 @@
 """The protocol for AI agents"""
 
-from abc import abstractmethod
 from enum import Enum
 from typing import Protocol
-from stream_chat import StreamChat, Channel
+from model import NewMessageRequest
 
 
 class AIAgent(Protocol):
-    """Protocol defining the interface for AI Agents."""
+    """
+    The agent of one channel, as kept by the registry. See llm_agent.ChannelAgent:
+    it holds the binding of the channel and hands the messages to the engine shared
+    by the channels of its provider.
+    """
 
-    chatClient: StreamChat
-    channel: Channel
+    async def handle_message(self, event: NewMessageRequest) -> None:
+        """Answer a new message of the channel."""
 
-    @abstractmethod
     async def dispose(self) -> None:
-        """Clean up the agent resources."""
-
-    @abstractmethod
-    def handle_message(self, event) -> None:
-        """Handle a new message."""
+        """Release what the agent holds for its channel."""
 
 
 class AgentPlatform(str, Enum):
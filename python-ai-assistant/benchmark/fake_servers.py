@@ -0,0 +1,383 @@
+"""Fake Stream REST API and LLM streaming APIs for the offline benchmark"""
+
+import asyncio
+import json
+import socket
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from aiohttp import web
+
+WORDS = "the quick brown fox jumps over a lazy dog while streaming tokens".split()
+
+
+@dataclass
+class FakeConfig:
+    """Latencies and sizes of the fake servers"""
+
+    # Latency of every Stream call in ms, with overrides per kind of call
+    stream_latency_ms: float = 20.0
+    stream_latencies_ms: Dict[str, float] = field(default_factory=dict)
+    # Calls per second allowed for each kind of Stream call, 0 for no limit
+    stream_rate_limit: float = 0.0
+    # Messages returned by the search API, to fill the conversation context
+    history_size: int = 10
+    # Time to the first token, tokens per response and tokens per second
+    llm_ttft_ms: float = 300.0
+    llm_tokens: int = 200
+    llm_token_rate: float = 80.0
+
+
+def request_size(request: web.Request, body: bytes) -> int:
+    """Bytes of an HTTP request as sent over the wire, roughly"""
+    head = len(request.method) + len(request.path_qs) + 12
+    head += sum(len(key) + len(value) + 4 for key, value in request.headers.items())
+    return head + len(body)
+
+
+class FakeStream:
+    """
+    Records the calls made to the Stream REST API. Every response is completed by
+    an `ai_indicator.clear` event (or an error state, or deleting the placeholder),
+    which can be awaited through `/_bench/wait`.
+    """
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.records: List[dict] = []
+        self.bytes_received = 0
+        self._cids: Dict[str, str] = {}
+        self._windows: Dict[str, Tuple[int, int]] = {}
+        self._completed: Dict[str, int] = defaultdict(int)
+        self._changed = asyncio.Condition()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/_bench/wait", self.wait)
+        app.router.add_get("/_bench/records", self.get_records)
+        app.router.add_post("/_bench/reset", self.reset)
+        app.router.add_route("*", "/{path:.*}", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        received = time.monotonic()
+        self.bytes_received += request_size(request, body)
+        data = json.loads(body) if body else {}
+        kind, cid, message_id = self._classify(request, data)
+        if self._limited(kind, received):
+            self.records.append(
+                {"kind": kind, "cid": cid, "received": received, "status": 429}
+            )
+            return web.json_response(
+                {"code": 9, "message": "Too many requests"},
+                status=429,
+                headers={"Retry-After": "1"},
+            )
+
+        await asyncio.sleep(
+            self.config.stream_latencies_ms.get(kind, self.config.stream_latency_ms)
+            / 1000
+        )
+
+        response: dict = {"duration": "0ms"}
+        if kind == "send_message":
+            message_id = str(uuid.uuid4())
+            self._cids[message_id] = cid
+            response["message"] = {"id": message_id, **data.get("message", {})}
+        elif kind == "search":
+            response["results"] = self._search_results()
+        elif kind == "get_message":
+            response["message"] = {"id": message_id, "text": "parent", "user": {}}
+        elif kind == "get_replies":
+            response["messages"] = []
+
+        record = {
+            "kind": kind,
+            "cid": cid,
+            "message_id": message_id,
+            "received": received,
+            "bytes": len(body),
+        }
+        if kind == "update_message_partial":
+            fields = data.get("set", {})
+            record["text_length"] = len(fields.get("text", ""))
+            record["generating"] = fields.get("generating")
+        elif kind == "send_event":
+            event = data.get("event", {})
+            record["event"] = event.get("type")
+            record["ai_state"] = event.get("ai_state")
+            record["message_id"] = message_id = event.get("message_id")
+        self.records.append(record)
+
+        if self._completes(record):
+            async with self._changed:
+                self._completed[cid] += 1
+                self._changed.notify_all()
+        return web.json_response(response)
+
+    async def wait(self, request: web.Request) -> web.Response:
+        """Wait until `count` responses completed in channel `cid`"""
+        cid = request.query["cid"]
+        count = int(request.query.get("count", "1"))
+        timeout = float(request.query.get("timeout", "60"))
+        try:
+            async with self._changed:
+                await asyncio.wait_for(
+                    self._changed.wait_for(lambda: self._completed[cid] >= count),
+                    timeout,
+                )
+        except asyncio.TimeoutError:
+            return web.json_response({"completed": self._completed[cid]}, status=504)
+        return web.json_response({"completed": self._completed[cid]})
+
+    async def get_records(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {"records": self.records, "bytes_received": self.bytes_received}
+        )
+
+    async def reset(self, request: web.Request) -> web.Response:
+        self.records = []
+        self.bytes_received = 0
+        self._completed.clear()
+        return web.json_response({})
+
+    def _limited(self, kind: str, now: float) -> bool:
+        if not self.config.stream_rate_limit:
+            return False
+        second = int(now)
+        window, count = self._windows.get(kind, (second, 0))
+        if window != second:
+            window, count = second, 0
+        self._windows[kind] = (window, count + 1)
+        return count + 1 > self.config.stream_rate_limit
+
+    def _classify(
+        self, request: web.Request, data: dict
+    ) -> Tuple[str, Optional[str], Optional[str]]:
+        parts = request.path.strip("/").split("/")
+        method = request.method
+        if parts[0] == "channels" and len(parts) >= 3:
+            cid = f"{parts[1]}:{parts[2]}"
+            if len(parts) == 4 and parts[3] == "message":
+                return "send_message", cid, None
+            if len(parts) == 4 and parts[3] == "event":
+                return "send_event", cid, None
+            if len(parts) == 3:
+                return "update_channel", cid, None
+            return "channel_other", cid, None
+        if parts[0] == "messages" and len(parts) >= 2:
+            message_id = parts[1]
+            cid = self._cids.get(message_id)
+            if len(parts) == 3 and parts[2] == "replies":
+                return "get_replies", cid, message_id
+            if method == "PUT":
+                return "update_message_partial", cid, message_id
+            if method == "DELETE":
+                return "delete_message", cid, message_id
+            return "get_message", cid, message_id
+        if parts[0] == "search":
+            payload = json.loads(request.query.get("payload", "{}"))
+            cid = payload.get("filter_conditions", {}).get("cid")
+            return "search", cid, None
+        if parts[0] == "users":
+            return "upsert_users", None, None
+        return "other", None, None
+
+    def _search_results(self) -> List[dict]:
+        results = []
+        for index in range(self.config.history_size):
+            user = "ai-bot" if index % 2 else "bench-user"
+            text = " ".join(
+                WORDS[(index + offset) % len(WORDS)] for offset in range(30)
+            )
+            results.append(
+                {
+                    "message": {
+                        "id": f"history-{index}",
+                        "text": text,
+                        "user": {"id": user},
+                    }
+                }
+            )
+        return results
+
+    @staticmethod
+    def _completes(record: dict) -> bool:
+        if record["kind"] == "delete_message":
+            return True
+        if record["kind"] != "send_event":
+            return False
+        return record["event"] == "ai_indicator.clear" or (
+            record["ai_state"] == "AI_STATE_ERROR"
+        )
+
+
+class FakeLLM:
+    """Streams generated tokens in the OpenAI and Anthropic SSE formats"""
+
+    def __init__(self, config: FakeConfig):
+        self.config = config
+        self.requests = 0
+        self.bytes_received = 0
+        self.closed_by_client = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._closed_by_client])
+        app.router.add_post("/v1/chat/completions", self.openai)
+        app.router.add_post("/v1/messages", self.anthropic)
+        app.router.add_get("/_bench/stats", self.stats)
+        return app
+
+    @web.middleware
+    async def _closed_by_client(
+        self, request: web.Request, handler
+    ) -> web.StreamResponse:
+        try:
+            return await handler(request)
+        except ConnectionResetError:
+            # The app stopped reading, e.g. the losing request of a hedge
+            self.closed_by_client += 1
+            return web.Response(status=499)
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "requests": self.requests,
+                "bytes_received": self.bytes_received,
+                "closed_by_client": self.closed_by_client,
+            }
+        )
+
+    async def _start(self, request: web.Request) -> Tuple[dict, web.StreamResponse]:
+        body = await request.read()
+        self.requests += 1
+        self.bytes_received += request_size(request, body)
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        )
+        await response.prepare(request)
+        await asyncio.sleep(self.config.llm_ttft_ms / 1000)
+        return json.loads(body), response
+
+    async def _tokens(self):
+        interval = 1 / self.config.llm_token_rate if self.config.llm_token_rate else 0
+        for index in range(self.config.llm_tokens):
+            if index:
+                await asyncio.sleep(interval)
+            yield WORDS[index % len(WORDS)] + " "
+
+    async def openai(self, request: web.Request) -> web.StreamResponse:
+        data, response = await self._start(request)
+        chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        async def send(choices: List[dict], **extra):
+            chunk = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": data.get("model", "fake"),
+                "choices": choices,
+                **extra,
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        def choice(delta: dict, finish_reason: Optional[str] = None) -> List[dict]:
+            return [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+
+        await send(choice({"role": "assistant", "content": ""}))
+        async for token in self._tokens():
+            await send(choice({"content": token}))
+        await send(choice({}, "stop"))
+        if (data.get("stream_options") or {}).get("include_usage"):
+            prompt_tokens = len(json.dumps(data.get("messages", []))) // 4
+            await send(
+                [],
+                usage={
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": self.config.llm_tokens,
+                    "total_tokens": prompt_tokens + self.config.llm_tokens,
+                    "prompt_tokens_details": {"cached_tokens": 0},
+                },
+            )
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def anthropic(self, request: web.Request) -> web.StreamResponse:
+        data, response = await self._start(request)
+
+        async def send(event: dict):
+            await response.write(
+                f"event: {event['type']}\ndata: {json.dumps(event)}\n\n".encode()
+            )
+
+        await send(
+            {
+                "type": "message_start",
+                "message": {
+                    "id": f"msg_{uuid.uuid4().hex}",
+                    "type": "message",
+                    "role": "assistant",
+                    "content": [],
+                    "model": data.get("model", "fake"),
+                    "stop_reason": None,
+                    "stop_sequence": None,
+                    "usage": {"input_tokens": 10, "output_tokens": 1},
+                },
+            }
+        )
+        await send(
+            {
+                "type": "content_block_start",
+                "index": 0,
+                "content_block": {"type": "text", "text": ""},
+            }
+        )
+        async for token in self._tokens():
+            await send(
+                {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": token},
+                }
+            )
+        await send({"type": "content_block_stop", "index": 0})
+        await send(
+            {
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": self.config.llm_tokens},
+            }
+        )
+        await send({"type": "message_stop"})
+        await response.write_eof()
+        return response
+
+
+def _listen() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+async def _serve(config: FakeConfig, ports):
+    runners = []
+    bound = []
+    for app in (FakeStream(config).app(), FakeLLM(config).app()):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sock = _listen()
+        await web.SockSite(runner, sock, backlog=1024).start()
+        runners.append(runner)
+        bound.append(sock.getsockname()[1])
+    ports.put(tuple(bound))
+    await asyncio.Event().wait()
+
+
+def serve(config: FakeConfig, ports):
+    """Run both fake servers, puts their (stream, llm) ports on the `ports` queue"""
+    asyncio.run(_serve(config, ports))
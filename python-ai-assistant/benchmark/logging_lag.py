@@ -0,0 +1,121 @@
+"""
+Event loop lag caused by logging to a slow stdout, e.g. a pipe to a log collector
+that is falling behind.
+
+Many tasks log a few lines per simulated message, once with print() like the agents
+used to, and once through the queue of logs.setup_logging. The lag of the event loop
+is sampled meanwhile:
+
+    python benchmark/logging_lag.py --tasks 200 --lines 20 --write-delay-ms 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from logs import set_log_context, setup_logging
+
+
+class SlowStream:
+    """A stream that blocks for a while on every write, like a full pipe"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.writes = 0
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        self.writes += 1
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run(mode: str, tasks: int, lines: int) -> dict:
+    logger = logging.getLogger("benchmark")
+    lags = []
+    done = False
+
+    async def sample(interval: float = 0.01):
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - started - interval)
+
+    async def agent(index: int):
+        set_log_context(f"messaging:bench-{index}", f"ai-bot-bench-{index}", "m")
+        for line in range(lines):
+            if mode == "print":
+                print("Handling message", index, line)
+            else:
+                logger.info("Handling message %s %s", index, line)
+            # Waiting on the LLM between chunks
+            await asyncio.sleep(0.001)
+
+    sampler = asyncio.create_task(sample())
+    started = time.perf_counter()
+    await asyncio.gather(*(agent(index) for index in range(tasks)))
+    elapsed = time.perf_counter() - started
+    done = True
+    await sampler
+    return {
+        "mode": mode,
+        "records": tasks * lines,
+        "seconds": round(elapsed, 2),
+        "loop_lag_ms": {
+            "p50": round(percentile(lags, 0.5) * 1000, 2),
+            "p99": round(percentile(lags, 0.99) * 1000, 2),
+            "max": round(max(lags) * 1000, 2),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--write-delay-ms", type=float, default=0.2)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    stdout = sys.stdout
+    results = []
+    for mode in ("print", "logging"):
+        sys.stdout = SlowStream(args.write_delay_ms / 1000)
+        listener = None
+        if mode == "logging":
+            listener = setup_logging(queue_size=args.tasks * args.lines)
+            listener.start()
+        try:
+            results.append(asyncio.run(run(mode, args.tasks, args.lines)))
+        finally:
+            if listener is not None:
+                listener.stop()
+            sys.stdout = stdout
+
+    for result in results:
+        lag = result["loop_lag_ms"]
+        print(
+            f"{result['mode']:>8}: {result['records']} records in "
+            f"{result['seconds']}s, loop lag p50 {lag['p50']} ms, "
+            f"p99 {lag['p99']} ms, max {lag['max']} ms"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
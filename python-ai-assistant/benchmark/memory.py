@@ -0,0 +1,117 @@
+"""
+Memory per resident channel, at several numbers of channels.
+
+Each count runs in its own process: the agents of N channels are started like
+/start-ai-agents does (without the Stream calls) and built like on their first
+message, then the Python allocations are measured with tracemalloc. The shared
+clients are created before, they don't count:
+
+    python benchmark/memory.py --channels 1000 10000 100000
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+async def measure(count: int) -> dict:
+    import main
+    from helpers import create_bot_id
+    from registry import AgentBinding
+
+    def binding(channel_id: str, platform: str) -> AgentBinding:
+        return AgentBinding(
+            bot_id=create_bot_id(channel_id=channel_id),
+            channel_type="messaging",
+            channel_id=channel_id,
+            platform=platform,
+        )
+
+    await main.clients.start()
+    try:
+        # The LLM clients are created with the first agent of their platform
+        for platform in ("openai", "anthropic"):
+            main.create_agent(binding(f"warmup-{platform}", platform))
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        for index in range(count):
+            channel = binding(
+                f"bench-channel-{index}", "openai" if index % 2 else "anthropic"
+            )
+            await main.store.save_binding(channel)
+            main.agents.bind(channel)
+            main.agents.get(channel.bot_id)
+
+        gc.collect()
+        allocated = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        return {
+            "channels": count,
+            "resident": main.agents.resident_count,
+            "allocated_mb": round(allocated / 1e6, 1),
+            "bytes_per_channel": round(allocated / count),
+            "peak_rss_mb": round(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+            ),
+        }
+    finally:
+        await main.clients.close()
+
+
+def run_child(count: int) -> dict:
+    env = dict(
+        os.environ,
+        STREAM_API_KEY="bench",
+        STREAM_API_SECRET="bench-secret",
+        OPENAI_API_KEY="bench",
+        ANTHROPIC_API_KEY="bench",
+        AGENT_MAX_RESIDENT=str(count),
+        AGENT_SNAPSHOT_PATH="",
+    )
+    result = subprocess.run(
+        [sys.executable, __file__, "--child", str(count)],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--channels", type=int, nargs="+", default=[1000, 10000, 100000]
+    )
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(measure(args.child))))
+        return
+
+    results = [run_child(count) for count in args.channels]
+    for result in results:
+        print(
+            f"{result['channels']:>7} channels: {result['bytes_per_channel']:>6} "
+            f"bytes per channel, {result['allocated_mb']} MB, "
+            f"peak RSS {result['peak_rss_mb']} MB"
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
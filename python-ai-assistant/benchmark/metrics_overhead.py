@@ -0,0 +1,83 @@
+"""
+Overhead of the metrics on the streaming hot loop.
+
+Times Generation.append() and the metric calls of one response, with the real
+metrics and with metrics that do nothing:
+
+    python benchmark/metrics_overhead.py --tokens 1000000
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generation import Generation  # noqa: E402
+from metrics import GenerationMetrics, generation_metrics  # noqa: E402
+
+
+class _Nothing:
+    def observe(self, value: float):
+        pass
+
+    def inc(self, amount: float = 1):
+        pass
+
+
+class NoMetrics(GenerationMetrics):
+    """Metrics that record nothing, the baseline"""
+
+    def __init__(self):  # pylint: disable=super-init-not-called
+        for name in vars(generation_metrics("bench", "bench")):
+            setattr(self, name, _Nothing())
+
+
+async def append_loop(metrics: GenerationMetrics, tokens: int) -> float:
+    """Seconds per appended token, without starting the flusher"""
+    generation = Generation(None, None, "message", "bot", metrics, time.time())
+    started = time.perf_counter()
+    for _ in range(tokens):
+        generation.append("token ")
+    elapsed = time.perf_counter() - started
+    generation.flusher._closed = True
+    return elapsed / tokens
+
+
+def observe_loop(metrics: GenerationMetrics, count: int) -> float:
+    """Seconds per histogram observation"""
+    histogram = metrics.partial_update
+    started = time.perf_counter()
+    for index in range(count):
+        histogram.observe(index * 1e-6)
+    return (time.perf_counter() - started) / count
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", type=int, default=1_000_000)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    real = generation_metrics("bench", "bench")
+    none = NoMetrics()
+    results = {"append_ns": [], "append_baseline_ns": [], "observe_ns": []}
+    for _ in range(args.rounds):
+        results["append_baseline_ns"].append(await append_loop(none, args.tokens))
+        results["append_ns"].append(await append_loop(real, args.tokens))
+        results["observe_ns"].append(observe_loop(real, args.tokens))
+
+    best = {name: min(values) * 1e9 for name, values in results.items()}
+    print(f"append without metrics {best['append_baseline_ns']:8.1f} ns/token")
+    print(f"append with metrics    {best['append_ns']:8.1f} ns/token")
+    print(f"histogram observe      {best['observe_ns']:8.1f} ns/call")
+    print(
+        "overhead per token     "
+        f"{best['append_ns'] - best['append_baseline_ns']:8.1f} ns"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,403 @@
+"""
+Offline load and latency benchmark of the AI assistant.
+
+Runs the FastAPI app from main.py in this process against fake Stream and LLM
+servers running in a child process, replays `message.new` webhooks across N
+channels and writes the results to a JSON file:
+
+    python benchmark/run.py --channels 50 --messages 5 --output results.json
+
+Every channel sends its next message once the previous one was answered, so all
+channels are generating at the same time. Settings of the app can be changed with
+`--env NAME=VALUE`, e.g. `--env FLUSH_INTERVAL_MS=100`.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import asdict
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_servers import FakeConfig, serve  # noqa: E402
+
+# Compared against --baseline, lower is better for all of them
+KEY_METRICS = [
+    ("ttfvt_ms", "p50"),
+    ("ttfvt_ms", "p95"),
+    ("latency_ms", "p50"),
+    ("latency_ms", "p95"),
+    ("latency_ms", "p99"),
+    ("stream_calls_per_response", None),
+    ("upstream_bytes_per_response", None),
+    ("event_loop_lag_ms", "p99"),
+    ("peak_rss_benchmark_mb", None),
+]
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """Nearest rank percentiles of a list of values"""
+    if not values:
+        return {"count": 0, "min": None, "p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+
+    def rank(percent: float) -> float:
+        index = max(
+            0, min(len(ordered) - 1, int(len(ordered) * percent / 100 + 0.5) - 1)
+        )
+        return round(ordered[index], 2)
+
+    return {
+        "count": len(ordered),
+        "min": round(ordered[0], 2),
+        "p50": rank(50),
+        "p95": rank(95),
+        "p99": rank(99),
+        "max": round(ordered[-1], 2),
+        "mean": round(sum(ordered) / len(ordered), 2),
+    }
+
+
+async def sample_loop_lag(lags: List[float], interval: float = 0.01):
+    """Record how late the event loop wakes up a sleeping task, in milliseconds"""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected) * 1000)
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of this process. The app shares it with the webhook
+    clients and their records, so it is an upper bound of the memory of the app.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if platform.system() == "Darwin" else 1024), 1)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=3, help="per channel")
+    parser.add_argument("--platform", default="openai")
+    parser.add_argument("--think-time-ms", type=float, default=0.0)
+    parser.add_argument("--stream-latency-ms", type=float, default=20.0)
+    parser.add_argument(
+        "--stream-latency",
+        action="append",
+        default=[],
+        metavar="KIND=MS",
+        help="latency of one kind of Stream call, e.g. update_message_partial=50",
+    )
+    parser.add_argument(
+        "--stream-rate-limit",
+        type=float,
+        default=0.0,
+        help="calls per second of each kind before the fake answers 429",
+    )
+    parser.add_argument("--history-size", type=int, default=10)
+    parser.add_argument("--llm-ttft-ms", type=float, default=300.0)
+    parser.add_argument("--llm-tokens", type=int, default=200)
+    parser.add_argument("--llm-token-rate", type=float, default=80.0)
+    parser.add_argument("--timeout", type=float, default=120.0, help="per response")
+    parser.add_argument(
+        "--env", action="append", default=[], metavar="NAME=VALUE", help="app setting"
+    )
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--baseline", help="results file to compare with")
+    return parser.parse_args()
+
+
+def fake_config(args: argparse.Namespace) -> FakeConfig:
+    latencies = {}
+    for item in args.stream_latency:
+        kind, value = item.split("=", 1)
+        latencies[kind] = float(value)
+    return FakeConfig(
+        stream_latency_ms=args.stream_latency_ms,
+        stream_latencies_ms=latencies,
+        stream_rate_limit=args.stream_rate_limit,
+        history_size=args.history_size,
+        llm_ttft_ms=args.llm_ttft_ms,
+        llm_tokens=args.llm_tokens,
+        llm_token_rate=args.llm_token_rate,
+    )
+
+
+def configure_app(args: argparse.Namespace, stream_port: int, llm_port: int):
+    # Must run before main.py is imported, the settings are read on import
+    os.environ.update(
+        {
+            "STREAM_API_KEY": "bench",
+            "STREAM_API_SECRET": "bench-secret",
+            "OPENAI_API_KEY": "bench",
+            "ANTHROPIC_API_KEY": "bench",
+            "STREAM_CHAT_URL": f"http://127.0.0.1:{stream_port}",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{llm_port}/v1",
+            "ANTHROPIC_BASE_URL": f"http://127.0.0.1:{llm_port}",
+            # Every run starts without agents
+            "AGENT_SNAPSHOT_PATH": "",
+        }
+    )
+    for item in args.env:
+        name, value = item.split("=", 1)
+        os.environ[name] = value
+
+
+async def run_channel(
+    http,
+    stream_url: str,
+    args,
+    channel_id: str,
+    sent: Dict[str, List[float]],
+    shed: List[str],
+):
+    cid = f"messaging:{channel_id}"
+    index = 0
+    while index < args.messages:
+        webhook = {
+            "type": "message.new",
+            "cid": cid,
+            "channel_type": "messaging",
+            "channel_id": channel_id,
+            "message": {
+                "id": str(uuid.uuid4()),
+                "text": f"Question {index}: how fast can you answer this?",
+                "type": "regular",
+                "user": {"id": "bench-user"},
+            },
+            "user": {"id": "bench-user"},
+        }
+        sent[cid].append(time.monotonic())
+        response = await http.post("/new-message", json=webhook)
+        if response.status_code in (429, 503):
+            # Shed by the admission control, sent again like Stream retries
+            sent[cid].pop()
+            shed.append(cid)
+            await asyncio.sleep(float(response.headers.get("Retry-After", 1)))
+            continue
+        response.raise_for_status()
+        done = await http.get(
+            f"{stream_url}/_bench/wait",
+            params={"cid": cid, "count": index + 1, "timeout": args.timeout},
+            timeout=args.timeout + 5,
+        )
+        if done.status_code != 200:
+            print(f"Timed out waiting for the answer in {cid}")
+            return
+        if args.think_time_ms:
+            await asyncio.sleep(args.think_time_ms / 1000)
+        index += 1
+
+
+def summarize(
+    records: List[dict], sent: Dict[str, List[float]], upstream_bytes: int
+) -> dict:
+    rejected = [record for record in records if record.get("status") == 429]
+    records = [record for record in records if record.get("status") != 429]
+
+    # The k-th placeholder message of a channel answers its k-th webhook
+    responses: Dict[str, dict] = {}
+    placeholders: Dict[str, int] = defaultdict(int)
+    for record in records:
+        if record["kind"] == "send_message":
+            cid = record["cid"]
+            index = placeholders[cid]
+            placeholders[cid] += 1
+            if index < len(sent[cid]):
+                responses[record["message_id"]] = {
+                    "sent": sent[cid][index],
+                    "placeholder": record["received"],
+                    "calls": 0,
+                }
+
+    ttfvt, latency, placeholder, failed = [], [], [], 0
+    for record in records:
+        response = responses.get(record.get("message_id"))
+        if response is None:
+            continue
+        response["calls"] += 1
+        if (
+            record["kind"] == "update_message_partial"
+            and record["text_length"]
+            and "visible" not in response
+        ):
+            response["visible"] = record["received"]
+        if record["kind"] == "send_event" and record["event"] == "ai_indicator.clear":
+            response["done"] = record["received"]
+        if record.get("ai_state") == "AI_STATE_ERROR" or (
+            record["kind"] == "delete_message"
+        ):
+            response["failed"] = True
+
+    for response in responses.values():
+        if response.get("failed"):
+            failed += 1
+            continue
+        placeholder.append((response["placeholder"] - response["sent"]) * 1000)
+        if "visible" in response:
+            ttfvt.append((response["visible"] - response["sent"]) * 1000)
+        if "done" in response:
+            latency.append((response["done"] - response["sent"]) * 1000)
+
+    calls_by_kind: Dict[str, int] = defaultdict(int)
+    for record in records:
+        calls_by_kind[record["kind"]] += 1
+    answered = max(len(latency), 1)
+    return {
+        "responses": len(latency),
+        "failed": failed,
+        "ttfvt_ms": percentiles(ttfvt),
+        "latency_ms": percentiles(latency),
+        "placeholder_ms": percentiles(placeholder),
+        "stream_calls": dict(sorted(calls_by_kind.items())),
+        "stream_calls_rate_limited": len(rejected),
+        "stream_calls_per_response": round(len(records) / answered, 2),
+        "upstream_bytes": upstream_bytes,
+        "upstream_bytes_per_response": round(upstream_bytes / answered),
+    }
+
+
+def compare(results: dict, baseline: dict):
+    """Print the change of the key metrics against a previous run"""
+    print("\nChange against the baseline (lower is better):")
+    for name, key in KEY_METRICS:
+        old, new = baseline.get(name), results.get(name)
+        if key is not None:
+            old = old.get(key) if old else None
+            new = new.get(key) if new else None
+        label = f"{name}.{key}" if key else name
+        if not old or new is None:
+            print(f"  {label:34} {new}")
+            continue
+        change = (new - old) / old * 100
+        print(f"  {label:34} {old} -> {new} ({change:+.1f}%)")
+
+
+async def benchmark(args: argparse.Namespace, stream_port: int, llm_port: int) -> dict:
+    import httpx
+    import uvicorn
+    import main
+
+    stream_url = f"http://127.0.0.1:{stream_port}"
+    server = uvicorn.Server(
+        uvicorn.Config(main.app, host="127.0.0.1", port=0, log_level="warning")
+    )
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    app_port = server.servers[0].sockets[0].getsockname()[1]
+
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(
+        base_url=f"http://127.0.0.1:{app_port}", limits=limits, timeout=30
+    ) as http:
+        channel_ids = [f"bench-{index}" for index in range(args.channels)]
+        for channel_id in channel_ids:
+            response = await http.post(
+                "/start-ai-agent",
+                json={"channel_id": channel_id, "platform": args.platform},
+            )
+            response.raise_for_status()
+
+        # Only the replay is measured
+        await http.post(f"{stream_url}/_bench/reset")
+        llm_before = (
+            await http.get(f"http://127.0.0.1:{llm_port}/_bench/stats")
+        ).json()
+        rss_before = peak_rss_mb()
+        sent: Dict[str, List[float]] = defaultdict(list)
+        shed: List[str] = []
+        # The app, the fake clients and the sampler share the event loop
+        lags: List[float] = []
+        sampler = asyncio.create_task(sample_loop_lag(lags))
+        started = time.monotonic()
+        await asyncio.gather(
+            *(
+                run_channel(http, stream_url, args, channel_id, sent, shed)
+                for channel_id in channel_ids
+            )
+        )
+        duration = time.monotonic() - started
+        sampler.cancel()
+
+        stream = (await http.get(f"{stream_url}/_bench/records")).json()
+        llm = (await http.get(f"http://127.0.0.1:{llm_port}/_bench/stats")).json()
+        response_cache = (await http.get("/response-cache-stats")).json()
+
+        for channel_id in channel_ids:
+            await http.post("/stop-ai-agent", json={"channel_id": channel_id})
+
+    server.should_exit = True
+    await serving
+
+    upstream = (
+        stream["bytes_received"] + llm["bytes_received"] - llm_before["bytes_received"]
+    )
+    results = summarize(stream["records"], sent, upstream)
+    results.update(
+        {
+            "duration_s": round(duration, 2),
+            "responses_per_s": round(results["responses"] / duration, 2),
+            "shed_webhooks": len(shed),
+            "llm_requests": llm["requests"] - llm_before["requests"],
+            "llm_requests_closed": llm["closed_by_client"]
+            - llm_before["closed_by_client"],
+            "response_cache": response_cache,
+            "event_loop_lag_ms": percentiles(lags),
+            "peak_rss_benchmark_mb": peak_rss_mb(),
+            "peak_rss_benchmark_before_replay_mb": rss_before,
+        }
+    )
+    return results
+
+
+def main():
+    args = parse_args()
+    config = fake_config(args)
+
+    ports = multiprocessing.Queue()
+    fakes = multiprocessing.Process(target=serve, args=(config, ports), daemon=True)
+    fakes.start()
+    try:
+        stream_port, llm_port = ports.get(timeout=30)
+        configure_app(args, stream_port, llm_port)
+        results = asyncio.run(benchmark(args, stream_port, llm_port))
+    finally:
+        fakes.terminate()
+        fakes.join()
+
+    output = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "args": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("output", "baseline")
+        },
+        "fakes": asdict(config),
+        **results,
+    }
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(output, file, indent=2)
+
+    print(json.dumps({key: output[key] for key in results}, indent=2))
+    print(f"\nResults written to {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            compare(output, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Requests per second of /new-message on one core, by kind of webhook.
+
+Calls the ASGI app of main.py directly, without a server or sockets, so only the
+app's own cost is measured. Accepted messages are not queued, nothing is generated:
+
+    python benchmark/webhook_payloads.py --requests 20000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("STREAM_API_KEY", "bench")
+os.environ.setdefault("STREAM_API_SECRET", "bench-secret")
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+os.environ.setdefault("AGENT_SNAPSHOT_PATH", "")
+
+
+def user(user_id: str) -> dict:
+    return {
+        "id": user_id,
+        "role": "user",
+        "created_at": "2024-12-01T10:00:00.000000Z",
+        "updated_at": "2024-12-01T10:00:00.000000Z",
+        "last_active": "2024-12-16T09:00:00.000000Z",
+        "banned": False,
+        "online": True,
+        "name": f"User {user_id}",
+        "image": f"https://example.com/avatars/{user_id}.png",
+        "teams": [],
+    }
+
+
+def message(channel_id: str, text: str, sender: str, **extra) -> dict:
+    """A message.new webhook as sent by Stream"""
+    return {
+        "type": "message.new",
+        "cid": f"messaging:{channel_id}",
+        "channel_id": channel_id,
+        "channel_type": "messaging",
+        "message_id": str(uuid.uuid4()),
+        "message": {
+            "id": str(uuid.uuid4()),
+            "text": text,
+            "html": f"<p>{text}</p>\n",
+            "type": "regular",
+            "user": user(sender),
+            "attachments": [],
+            "latest_reactions": [],
+            "own_reactions": [],
+            "reaction_counts": {},
+            "reaction_scores": {},
+            "reply_count": 0,
+            "deleted_reply_count": 0,
+            "cid": f"messaging:{channel_id}",
+            "created_at": "2024-12-16T09:00:00.000000Z",
+            "updated_at": "2024-12-16T09:00:00.000000Z",
+            "shadowed": False,
+            "mentioned_users": [],
+            "silent": False,
+            "pinned": False,
+            "pinned_at": None,
+            "pinned_by": None,
+            "pin_expires": None,
+            **extra,
+        },
+        "user": user(sender),
+        "watcher_count": 2,
+        "created_at": "2024-12-16T09:00:00.000000Z",
+        "members": [
+            {"user_id": sender, "user": user(sender), "role": "owner"},
+            {"user_id": f"ai-bot-{channel_id}", "role": "member"},
+        ],
+    }
+
+
+def payloads() -> dict:
+    reaction = message("bench-agent", "Hello", "bench-user")
+    reaction.update(
+        {"type": "reaction.new", "reaction": {"type": "like", "user_id": "bench-user"}}
+    )
+    return {
+        "bot_echo": message(
+            "bench-agent", "Sure, here you go.", "ai-bot-bench-agent", ai_generated=True
+        ),
+        "reaction": reaction,
+        "no_agent": message("bench-other", "How are you?", "bench-user"),
+        "accepted": message("bench-agent", "How are you?", "bench-user"),
+    }
+
+
+async def call(app, body: bytes) -> int:
+    """Send one request to the ASGI app, returns the status"""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/new-message",
+        "raw_path": b"/new-message",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"localhost"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("127.0.0.1", 8000),
+    }
+    sent = False
+    status = 0
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {"type": "http.disconnect"}
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def main() -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000, help="per kind")
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    import main as app_main
+    from registry import AgentBinding
+
+    async def queued(*_):
+        pass
+
+    # Accepted messages stop at the dispatcher, nothing is generated
+    app_main.dispatcher.dispatch = queued
+    app_main.agents.bind(
+        AgentBinding("ai-bot-bench-agent", "messaging", "bench-agent", "openai")
+    )
+
+    results = {}
+    for kind, payload in payloads().items():
+        body = json.dumps(payload).encode()
+        status = await call(app_main.app, body)
+        best = 0.0
+        for _ in range(args.rounds):
+            started = time.perf_counter()
+            for _ in range(args.requests):
+                await call(app_main.app, body)
+            best = max(best, args.requests / (time.perf_counter() - started))
+        results[kind] = {"status": status, "bytes": len(body), "rps": round(best)}
+    return results
+
+
+if __name__ == "__main__":
+    # Whatever the app prints would be measured as well
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            results = asyncio.run(main())
+        finally:
+            sys.stdout = stdout
+    print(json.dumps(results, indent=2))
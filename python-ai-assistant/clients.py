@@ -0,0 +1,220 @@
+"""Process-wide Stream and LLM clients shared by all agents"""
+
+import asyncio
+from typing import Any, Callable, Dict, Optional
+import aiohttp
+import httpx
+from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient as AnthropicHttpxClient
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient as OpenAIHttpxClient
+from stream_chat import StreamChatAsync
+from stream_chat.base.exceptions import StreamAPIException
+from stream_chat.types.stream_response import StreamResponse
+from config import Settings
+from rate_limit import StreamRateGovernor, endpoint_class, retry_after
+
+
+class StreamRateLimited(StreamAPIException):
+    """A 429 answer of the Stream API, with the delay it asked for"""
+
+    def __init__(self, text: str, status_code: int, delay: Optional[float]):
+        super().__init__(text, status_code)
+        self.retry_after = delay
+
+
+class GovernedStreamChat(StreamChatAsync):
+    """
+    Stream client whose calls all go through the rate governor: they wait for the
+    budget of their endpoint and are retried after a 429.
+    """
+
+    def __init__(self, *args: Any, governor: StreamRateGovernor, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.governor = governor
+
+    async def _make_request(
+        self,
+        method: Callable,
+        relative_url: str,
+        params: Optional[Dict] = None,
+        data: Any = None,
+    ) -> StreamResponse:
+        endpoint = endpoint_class(method.__name__, relative_url)
+        attempt = 0
+        while True:
+            await self.governor.acquire(endpoint)
+            try:
+                response = await super()._make_request(
+                    method, relative_url, params, data
+                )
+            except StreamRateLimited as error:
+                delay = self.governor.rate_limited(endpoint, error.retry_after)
+                attempt += 1
+                if attempt > self.governor.max_retries:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            self.governor.succeeded(endpoint)
+            return response
+
+    async def _parse_response(self, response: aiohttp.ClientResponse) -> StreamResponse:
+        if response.status == 429:
+            raise StreamRateLimited(
+                await response.text(), response.status, retry_after(response.headers)
+            )
+        return await super()._parse_response(response)
+
+
+class ClientManager:
+    """
+    Owns one keep-alive connection pool per upstream (Stream, OpenAI, Anthropic).
+    Agents borrow the clients through a ClientLease and give them back on dispose,
+    the clients themselves are only closed when the application shuts down.
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._stream: Optional[StreamChatAsync] = None
+        self._openai: Optional[AsyncOpenAI] = None
+        self._anthropic: Optional[AsyncAnthropic] = None
+        self._compatible: Dict[str, AsyncOpenAI] = {}
+        self.borrowed = 0
+
+    async def start(self):
+        """Create the shared Stream client, must be called inside the event loop"""
+        if self._stream is not None:
+            return
+        client = GovernedStreamChat(
+            self.settings.stream_api_key,
+            self.settings.stream_api_secret,
+            timeout=self.settings.stream_timeout,
+            governor=StreamRateGovernor(
+                self.settings.stream_rate_limits,
+                self.settings.stream_max_retries,
+                self.settings.partial_update_reserve,
+            ),
+        )
+        # Replace the default session so the pool limits can be configured
+        await client.session.close()
+        client.set_http_session(
+            aiohttp.ClientSession(
+                base_url=client.base_url,
+                connector=aiohttp.TCPConnector(
+                    limit=self.settings.stream_pool_size,
+                    limit_per_host=self.settings.stream_pool_per_host,
+                    keepalive_timeout=self.settings.stream_keepalive_timeout,
+                ),
+            )
+        )
+        self._stream = client
+
+    async def close(self):
+        """Close every shared client"""
+        if self._stream is not None:
+            await self._stream.close()
+            self._stream = None
+        if self._openai is not None:
+            await self._openai.close()
+            self._openai = None
+        if self._anthropic is not None:
+            await self._anthropic.close()
+            self._anthropic = None
+        for client in self._compatible.values():
+            await client.close()
+        self._compatible.clear()
+
+    @property
+    def stream(self) -> StreamChatAsync:
+        """The shared Stream client"""
+        if self._stream is None:
+            raise RuntimeError("Client manager is not started")
+        return self._stream
+
+    def openai(self) -> AsyncOpenAI:
+        """The shared OpenAI client, created on first use"""
+        if self._openai is None:
+            if not self.settings.openai_api_key:
+                raise ValueError("OpenAI API key is required")
+            # By passing a base_url, we can use e.g. the DeepSeek API, or even local models
+            self._openai = AsyncOpenAI(
+                api_key=self.settings.openai_api_key,
+                http_client=OpenAIHttpxClient(limits=self._llm_limits()),
+            )
+        return self._openai
+
+    def anthropic(self) -> AsyncAnthropic:
+        """The shared Anthropic client, created on first use"""
+        if self._anthropic is None:
+            if not self.settings.anthropic_api_key:
+                raise ValueError("Anthropic API key is required")
+            self._anthropic = AsyncAnthropic(
+                api_key=self.settings.anthropic_api_key,
+                http_client=AnthropicHttpxClient(limits=self._llm_limits()),
+            )
+        return self._anthropic
+
+    def openai_compatible(
+        self, base_url: str, api_key: Optional[str] = None
+    ) -> AsyncOpenAI:
+        """A shared client of an API compatible with OpenAI, created on first use"""
+        client = self._compatible.get(base_url)
+        if client is None:
+            client = self._compatible[base_url] = AsyncOpenAI(
+                api_key=api_key or self.settings.openai_api_key or "none",
+                base_url=base_url,
+                http_client=OpenAIHttpxClient(limits=self._llm_limits()),
+            )
+        return client
+
+    def lease(self) -> "ClientLease":
+        """Borrow the shared clients for an agent"""
+        self.borrowed += 1
+        return ClientLease(self)
+
+    def _release(self):
+        self.borrowed -= 1
+
+    def _llm_limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.settings.llm_pool_size,
+            max_keepalive_connections=self.settings.llm_keepalive_connections,
+            keepalive_expiry=self.settings.llm_keepalive_expiry,
+        )
+
+
+class ClientLease:
+    """The clients borrowed by a single agent"""
+
+    def __init__(self, manager: ClientManager):
+        self._manager: Optional[ClientManager] = manager
+
+    @property
+    def manager(self) -> ClientManager:
+        """The manager this lease was borrowed from"""
+        if self._manager is None:
+            raise RuntimeError("Client lease was already released")
+        return self._manager
+
+    @property
+    def stream(self) -> StreamChatAsync:
+        """The shared Stream client"""
+        return self.manager.stream
+
+    def openai(self) -> AsyncOpenAI:
+        """The shared OpenAI client"""
+        return self.manager.openai()
+
+    def anthropic(self) -> AsyncAnthropic:
+        """The shared Anthropic client"""
+        return self.manager.anthropic()
+
+    def openai_compatible(
+        self, base_url: str, api_key: Optional[str] = None
+    ) -> AsyncOpenAI:
+        """The shared client of an API compatible with OpenAI"""
+        return self.manager.openai_compatible(base_url, api_key)
+
+    def release(self):
+        """Give the clients back without closing them, safe to call twice"""
+        if self._manager is not None:
+            self._manager._release()
+            self._manager = None
@@ -0,0 +1,243 @@
+"""Runtime configuration read from the environment"""
+
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_budgets(name: str) -> Dict[str, int]:
+    # Format: "model=tokens,model=tokens"
+    budgets = {}
+    for item in (os.getenv(name) or "").split(","):
+        if "=" in item:
+            model, tokens = item.split("=", 1)
+            budgets[model.strip()] = int(tokens)
+    return budgets
+
+
+def _env_rates(name: str) -> Dict[str, float]:
+    # Format: "endpoint=requests per second,endpoint=requests per second"
+    rates = {}
+    for item in (os.getenv(name) or "").split(","):
+        if "=" in item:
+            endpoint, rate = item.split("=", 1)
+            rates[endpoint.strip()] = float(rate)
+    return rates
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Settings for the AI assistant server"""
+
+    stream_api_key: Optional[str]
+    stream_api_secret: Optional[str]
+    openai_api_key: Optional[str]
+    anthropic_api_key: Optional[str]
+
+    # Connection pool for the shared Stream client (aiohttp). A limit of 0
+    # means unlimited, same as aiohttp.
+    stream_pool_size: int = 100
+    stream_pool_per_host: int = 0
+    stream_keepalive_timeout: float = 59.0
+    stream_timeout: float = 6.0
+    # Requests per second to each class of Stream endpoint (update_message,
+    # send_event, send_message, search, default) for the whole process, calls
+    # rejected with a 429 are retried
+    stream_rate_limits: Dict[str, float] = field(default_factory=dict)
+    stream_max_retries: int = 3
+    # Share of the update budget partial updates leave to the final updates
+    partial_update_reserve: float = 0.2
+
+    # Connection pool for each shared LLM client (httpx)
+    llm_pool_size: int = 100
+    llm_keepalive_connections: int = 20
+    llm_keepalive_expiry: float = 30.0
+
+    # Partial message updates while a response streams: send at most every
+    # interval, or sooner once enough new characters are pending
+    flush_interval_ms: int = 250
+    flush_min_chars: int = 200
+    # Send only the new text as custom events, with the full text as a partial
+    # update every checkpoint interval and at the end
+    delta_streaming: bool = False
+    delta_checkpoint_ms: int = 2000
+
+    # Incoming messages are queued per channel, and at most this many LLM
+    # streams run at the same time across all channels
+    max_concurrent_generations: int = 50
+    merge_queued_messages: bool = False
+    # Stop the running answer when a newer user message arrives in the channel
+    cancel_on_new_message: bool = False
+    # Send the placeholder message and load the context at the same time, and
+    # call the LLM as soon as the context is ready
+    pipelined_startup: bool = True
+
+    # Messages are shed while this worker is overloaded: too many generations in
+    # flight, messages queued, or a slow recent first token (0 = not checked).
+    # Channels with a message admitted in the active window keep going until the
+    # load is `admission_active_headroom` times over the limits.
+    admission_max_in_flight: int = 0
+    admission_max_queued: int = 1000
+    admission_max_first_token_ms: int = 0
+    admission_active_window: float = 300.0
+    admission_active_headroom: float = 2.0
+    # Shed messages get this status with a Retry-After header, or the busy reply
+    # in the channel when one is set
+    shed_status: int = 503
+    shed_retry_after: int = 5
+    busy_reply: str = ""
+
+    # Bot users and memberships created less than the TTL (seconds) ago are not
+    # written again when an agent is restarted. Bulk starts add the bots to at most
+    # this many channels at a time.
+    provisioning_cache_ttl: float = 3600.0
+    provisioning_concurrency: int = 10
+
+    # Agents idle for longer than the TTL (seconds), or the least recently used
+    # ones above the max, are disposed and rebuilt on their next message
+    agent_idle_ttl: float = 1800.0
+    agent_max_resident: int = 1000
+    agent_reap_interval: float = 60.0
+
+    # Agent state shared between workers: memory://, sqlite:///path/to/file.db or
+    # redis://host:port/db. A channel is handled by the worker holding its lease.
+    state_store_url: str = "memory://"
+    channel_lease_ttl: float = 30.0
+    queue_poll_interval: float = 0.2
+
+    # Records are written by a background thread, as text or json. Debug records
+    # are limited to this many per second for each message (0 = no limit), and
+    # dropped while the queue of the thread is full.
+    log_level: str = "INFO"
+    log_format: str = "text"
+    log_debug_rate: float = 10.0
+    log_queue_size: int = 10000
+
+    # Timelines of the slowest generations kept for /debug/slow-generations
+    # (0 = profiling off)
+    profile_slowest: int = 0
+
+    # On shutdown, running answers get this many seconds to finish before their
+    # partial text is saved. The bindings of the agents are written to the snapshot
+    # file (empty = none) and restored on startup into an empty state store.
+    shutdown_timeout: float = 20.0
+    agent_snapshot_path: str = "agents-snapshot.json"
+
+    # Recent messages cached per channel and thread instead of searching on every
+    # message
+    history_max_channels: int = 10000
+    history_max_messages: int = 50
+    history_max_threads: int = 10000
+
+    # Token budget for the conversation sent to the LLM, per model with a default,
+    # longer messages are truncated to the per message limit
+    context_token_budget: int = 3000
+    context_token_budgets: Dict[str, int] = field(default_factory=dict)
+    context_max_message_tokens: int = 1000
+
+    # Also send the request to a hedge provider when the first token didn't arrive
+    # after this many milliseconds (0 = off), and answer with the fastest one. The
+    # hedge is an OpenAI compatible base URL, or else another platform.
+    hedge_after_ms: int = 0
+    hedge_platform: str = ""
+    hedge_base_url: str = ""
+    hedge_api_key: Optional[str] = None
+    hedge_model: str = ""
+
+    # Mark the earlier turns as a cacheable prompt prefix for Anthropic, OpenAI
+    # caches long prefixes on its own
+    prompt_caching: bool = True
+    # Answers kept for repeated prompts with the same model and conversation,
+    # for `response_cache_ttl` seconds. 0 turns the cache off.
+    response_cache_size: int = 0
+    response_cache_ttl: float = 300.0
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """Build the settings from environment variables"""
+        return cls(
+            stream_api_key=os.getenv("STREAM_API_KEY"),
+            stream_api_secret=os.getenv("STREAM_API_SECRET"),
+            openai_api_key=os.getenv("OPENAI_API_KEY"),
+            anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"),
+            stream_pool_size=_env_int("STREAM_POOL_SIZE", 100),
+            stream_pool_per_host=_env_int("STREAM_POOL_PER_HOST", 0),
+            stream_keepalive_timeout=_env_float("STREAM_KEEPALIVE_TIMEOUT", 59.0),
+            stream_timeout=_env_float("STREAM_TIMEOUT", 6.0),
+            stream_rate_limits=_env_rates("STREAM_RATE_LIMITS"),
+            stream_max_retries=_env_int("STREAM_MAX_RETRIES", 3),
+            partial_update_reserve=_env_float("PARTIAL_UPDATE_RESERVE", 0.2),
+            llm_pool_size=_env_int("LLM_POOL_SIZE", 100),
+            llm_keepalive_connections=_env_int("LLM_KEEPALIVE_CONNECTIONS", 20),
+            llm_keepalive_expiry=_env_float("LLM_KEEPALIVE_EXPIRY", 30.0),
+            flush_interval_ms=_env_int("FLUSH_INTERVAL_MS", 250),
+            flush_min_chars=_env_int("FLUSH_MIN_CHARS", 200),
+            delta_streaming=_env_bool("DELTA_STREAMING", False),
+            delta_checkpoint_ms=_env_int("DELTA_CHECKPOINT_MS", 2000),
+            max_concurrent_generations=_env_int("MAX_CONCURRENT_GENERATIONS", 50),
+            merge_queued_messages=_env_bool("MERGE_QUEUED_MESSAGES", False),
+            cancel_on_new_message=_env_bool("CANCEL_ON_NEW_MESSAGE", False),
+            pipelined_startup=_env_bool("PIPELINED_STARTUP", True),
+            admission_max_in_flight=_env_int("ADMISSION_MAX_IN_FLIGHT", 0),
+            admission_max_queued=_env_int("ADMISSION_MAX_QUEUED", 1000),
+            admission_max_first_token_ms=_env_int("ADMISSION_MAX_FIRST_TOKEN_MS", 0),
+            admission_active_window=_env_float("ADMISSION_ACTIVE_WINDOW", 300.0),
+            admission_active_headroom=_env_float("ADMISSION_ACTIVE_HEADROOM", 2.0),
+            shed_status=_env_int("SHED_STATUS", 503),
+            shed_retry_after=_env_int("SHED_RETRY_AFTER", 5),
+            busy_reply=os.getenv("BUSY_REPLY", ""),
+            provisioning_cache_ttl=_env_float("PROVISIONING_CACHE_TTL", 3600.0),
+            provisioning_concurrency=_env_int("PROVISIONING_CONCURRENCY", 10),
+            agent_idle_ttl=_env_float("AGENT_IDLE_TTL", 1800.0),
+            agent_max_resident=_env_int("AGENT_MAX_RESIDENT", 1000),
+            agent_reap_interval=_env_float("AGENT_REAP_INTERVAL", 60.0),
+            state_store_url=os.getenv("STATE_STORE_URL", "memory://"),
+            channel_lease_ttl=_env_float("CHANNEL_LEASE_TTL", 30.0),
+            queue_poll_interval=_env_float("QUEUE_POLL_INTERVAL", 0.2),
+            log_level=os.getenv("LOG_LEVEL", "INFO"),
+            log_format=os.getenv("LOG_FORMAT", "text"),
+            log_debug_rate=_env_float("LOG_DEBUG_RATE", 10.0),
+            log_queue_size=_env_int("LOG_QUEUE_SIZE", 10000),
+            profile_slowest=_env_int("PROFILE_SLOWEST", 0),
+            shutdown_timeout=_env_float("SHUTDOWN_TIMEOUT", 20.0),
+            agent_snapshot_path=os.getenv(
+                "AGENT_SNAPSHOT_PATH", "agents-snapshot.json"
+            ),
+            history_max_channels=_env_int("HISTORY_MAX_CHANNELS", 10000),
+            history_max_messages=_env_int("HISTORY_MAX_MESSAGES", 50),
+            history_max_threads=_env_int("HISTORY_MAX_THREADS", 10000),
+            context_token_budget=_env_int("CONTEXT_TOKEN_BUDGET", 3000),
+            context_token_budgets=_env_budgets("CONTEXT_TOKEN_BUDGETS"),
+            context_max_message_tokens=_env_int("CONTEXT_MAX_MESSAGE_TOKENS", 1000),
+            hedge_after_ms=_env_int("HEDGE_AFTER_MS", 0),
+            hedge_platform=os.getenv("HEDGE_PLATFORM", ""),
+            hedge_base_url=os.getenv("HEDGE_BASE_URL", ""),
+            hedge_api_key=os.getenv("HEDGE_API_KEY"),
+            hedge_model=os.getenv("HEDGE_MODEL", ""),
+            prompt_caching=_env_bool("PROMPT_CACHING", True),
+            response_cache_size=_env_int("RESPONSE_CACHE_SIZE", 0),
+            response_cache_ttl=_env_float("RESPONSE_CACHE_TTL", 300.0),
+        )
+
+
+settings = Settings.from_env()
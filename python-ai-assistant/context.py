@@ -0,0 +1,124 @@
+"""Token-budgeted assembly of the conversation sent to the LLM"""
+
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# Han, Kana and Hangul characters, BPE tokenizers use at least a token for each
+_CJK = (
+    "\u1100-\u11ff\u3040-\u30ff\u3130-\u318f\u3400-\u4dbf\u4e00-\u9fff"
+    "\uac00-\ud7af\uf900-\ufaff\uff66-\uff9f\U00020000-\U0002fa1f"
+)
+
+# Words, numbers, single CJK characters and single punctuation marks, roughly how
+# BPE tokenizers split text
+_PIECE_RE = re.compile(rf"[{_CJK}]|[^\W{_CJK}]+|[^\w\s]")
+
+# Tokens added by the chat format around every message
+MESSAGE_OVERHEAD = 4
+
+TRUNCATION_MARKER = "\n[…]\n"
+
+
+def _piece_tokens(piece: str) -> int:
+    # Long words are split into several tokens
+    return 1 + len(piece) // 6
+
+
+def count_tokens(text: str) -> int:
+    """Estimate the number of tokens in a text without calling a tokenizer service"""
+    return sum(_piece_tokens(piece) for piece in _PIECE_RE.findall(text))
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """Keep the start and the end of a text that is longer than `max_tokens`"""
+    pieces = [
+        (match.start(), _piece_tokens(match.group()))
+        for match in _PIECE_RE.finditer(text)
+    ]
+    if sum(tokens for _, tokens in pieces) <= max_tokens:
+        return text
+
+    # Two thirds of the budget for the start of the message, the rest for its end
+    head_budget = max_tokens * 2 // 3
+    tail_budget = max_tokens - head_budget
+    head_end = 0
+    used = 0
+    for start, tokens in pieces:
+        if used + tokens > head_budget:
+            head_end = start
+            break
+        used += tokens
+    tail_start = len(text)
+    used = 0
+    for start, tokens in reversed(pieces):
+        if used + tokens > tail_budget:
+            break
+        used += tokens
+        tail_start = start
+    return text[:head_end].rstrip() + TRUNCATION_MARKER + text[tail_start:].lstrip()
+
+
+class ContextBuilder:
+    """
+    Packs as many recent turns as fit in the token budget of a model. Messages that
+    are too long on their own are truncated. Token counts are cached per message id,
+    so a warm channel only counts the new messages.
+    """
+
+    def __init__(
+        self,
+        default_budget: int,
+        max_message_tokens: int,
+        budgets: Optional[Dict[str, int]] = None,
+        cache_size: int = 50000,
+    ):
+        self.default_budget = default_budget
+        self.max_message_tokens = max_message_tokens
+        self.budgets = budgets or {}
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, Tuple[int, str, int]]" = OrderedDict()
+
+    def budget_for(self, model: str) -> int:
+        """The token budget of a model"""
+        return self.budgets.get(model, self.default_budget)
+
+    def build(self, messages: List[Dict[str, str]], model: str) -> List[Dict[str, str]]:
+        """
+        Build the LLM messages, oldest first, from the channel messages (newest first).
+        The newest message is always included.
+        """
+        budget = self.budget_for(model)
+        context: List[Dict[str, str]] = []
+        used = 0
+        for message in messages:
+            content, tokens = self._prepare(message)
+            tokens += MESSAGE_OVERHEAD
+            if context and used + tokens > budget:
+                break
+            if not context and tokens > budget:
+                content = truncate_text(content, max(budget - MESSAGE_OVERHEAD, 1))
+            context.append({"role": message["role"], "content": content})
+            used += tokens
+        context.reverse()
+        return context
+
+    def _prepare(self, message: Dict[str, str]) -> Tuple[str, int]:
+        """The (possibly truncated) content of a message and its token count"""
+        message_id = message.get("id")
+        content = message["content"]
+        if message_id:
+            cached = self._cache.get(message_id)
+            if cached is not None and cached[0] == len(content):
+                self._cache.move_to_end(message_id)
+                return cached[1], cached[2]
+
+        tokens = count_tokens(content)
+        if tokens > self.max_message_tokens:
+            content = truncate_text(content, self.max_message_tokens)
+            tokens = count_tokens(content)
+        if message_id:
+            self._cache[message_id] = (len(message["content"]), content, tokens)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return content, tokens
@@ -0,0 +1,178 @@
+"""Routing of channel messages to the worker that owns the channel"""
+
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Set
+from model import NewMessageRequest
+from state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+Deliver = Callable[[str, NewMessageRequest], Awaitable[None]]
+# Called with the key and cid of a channel when its lease is taken, not renewed
+Acquired = Callable[[str, str], None]
+
+
+def create_worker_id() -> str:
+    """A unique id for this worker process"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class ChannelDispatcher:
+    """
+    Makes sure the messages of a channel are handled by exactly one worker.
+
+    Every message is pushed to the channel queue in the shared store. The worker that
+    holds the lease on the channel pumps the queue and delivers the messages to its
+    local scheduler. When the channel has no more work the lease is released, and the
+    next worker that receives a message for the channel takes it over.
+    `on_acquire` is told when this worker takes over a channel, another worker
+    might have answered in it meanwhile.
+    """
+
+    def __init__(
+        self,
+        store: StateStore,
+        deliver: Deliver,
+        is_busy: Callable[[str], bool],
+        lease_ttl: float,
+        poll_interval: float,
+        worker_id: str = "",
+        on_acquire: Optional[Acquired] = None,
+    ):
+        self.store = store
+        self.deliver = deliver
+        self.is_busy = is_busy
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or create_worker_id()
+        self.on_acquire = on_acquire
+        self._pumps: Dict[str, asyncio.Task] = {}
+        self._wakeups: Dict[str, asyncio.Event] = {}
+        # Channels whose pump was stopped while holding the lease
+        self._held: Set[str] = set()
+        self.stopped = False
+
+    @property
+    def owned_count(self) -> int:
+        """Number of channels this worker currently owns"""
+        return len(self._pumps)
+
+    async def dispatch(self, key: str, request: NewMessageRequest):
+        """Queue a message for a channel and pump the queue if this worker owns it"""
+        await self.store.push_message(key, request.model_dump_json())
+        if self.stopped:
+            # Left in the queue for the next owner of the channel
+            return
+        if key in self._wakeups:
+            self._wakeups[key].set()
+            return
+
+        # Registered before taking the lease, so concurrent messages don't start
+        # a second pump for the same channel
+        wakeup = asyncio.Event()
+        self._wakeups[key] = wakeup
+        owned = False
+        try:
+            owned = await self.store.acquire_lease(key, self.worker_id, self.lease_ttl)
+        finally:
+            if not owned and self._wakeups.get(key) is wakeup:
+                del self._wakeups[key]
+        if owned and self.stopped:
+            await self.store.release_lease(key, self.worker_id)
+        elif owned:
+            self._acquired(key, request.cid)
+            self._pumps[key] = asyncio.create_task(self._pump(key, wakeup, request.cid))
+
+    async def stop(self):
+        """Stop delivering messages, the leases are kept until close()"""
+        self.stopped = True
+        self._held.update(self._pumps)
+        pumps = list(self._pumps.values())
+        for pump in pumps:
+            pump.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+
+    async def close(self):
+        """Stop pumping and release the leases of this worker"""
+        await self.stop()
+        keys, self._held = self._held, set()
+        for key in keys:
+            try:
+                await self.store.release_lease(key, self.worker_id)
+            except Exception as error:
+                logger.warning("Failed to release lease for %s: %s", key, error)
+
+    def _acquired(self, key: str, cid: Optional[str]):
+        if self.on_acquire is not None and cid:
+            self.on_acquire(key, cid)
+
+    async def _pump(self, key: str, wakeup: asyncio.Event, cid: Optional[str]):
+        renewed = time.monotonic()
+        try:
+            while True:
+                wakeup.clear()
+                delivered = False
+                while True:
+                    payload = await self.store.pop_message(key)
+                    if payload is None:
+                        break
+                    delivered = True
+                    try:
+                        request = NewMessageRequest.model_validate_json(payload)
+                        cid = request.cid or cid
+                        await self.deliver(key, request)
+                    except asyncio.CancelledError:
+                        # Stopped while delivering, the next owner delivers it
+                        await self.store.return_message(key, payload)
+                        raise
+                    except Exception:
+                        logger.exception("Failed to deliver message for %s", key)
+
+                if not delivered and not self.is_busy(key):
+                    # From here on new messages try to take the lease themselves
+                    del self._wakeups[key]
+                    await self.store.release_lease(key, self.worker_id)
+                    # A message queued right before the release could not take the
+                    # lease, so take it back unless another pump already did
+                    if not await self.store.queue_length(key) or key in self._wakeups:
+                        return
+                    if not await self.store.acquire_lease(
+                        key, self.worker_id, self.lease_ttl
+                    ):
+                        return
+                    if key in self._wakeups:
+                        return
+                    self._wakeups[key] = wakeup
+                    self._acquired(key, cid)
+                    renewed = time.monotonic()
+                    continue
+
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                if time.monotonic() - renewed > self.lease_ttl / 3:
+                    if not await self.store.acquire_lease(
+                        key, self.worker_id, self.lease_ttl
+                    ):
+                        logger.warning("Lost the lease on channel %s", key)
+                        return
+                    renewed = time.monotonic()
+        except Exception:
+            logger.exception("Failed to pump messages for %s", key)
+            try:
+                await self.store.release_lease(key, self.worker_id)
+            except Exception as error:
+                # Likely the store failing again, the lease expires after its TTL
+                logger.warning("Failed to release lease for %s: %s", key, error)
+        finally:
+            if self._wakeups.get(key) is wakeup:
+                del self._wakeups[key]
+            if self._pumps.get(key) is asyncio.current_task():
+                del self._pumps[key]
@@ -0,0 +1,171 @@
+"""Background flushing of partial message updates while a response streams"""
+
+import asyncio
+import logging
+import time
+from typing import List, Optional
+from config import settings
+from metrics import GenerationMetrics
+from profiling import Timeline
+from sequencer import OutboundSequencer
+
+logger = logging.getLogger(__name__)
+
+
+class PartialUpdateFlusher:
+    """
+    Collects the streamed text of one message and sends it to Stream in the background.
+
+    The LLM reader only calls append(), which never awaits. A single background task
+    sends the latest text at most every `interval` seconds, or sooner once `min_chars`
+    new characters are pending. Newer text replaces whatever was waiting to be sent,
+    so there is never more than one update in flight for the message.
+
+    In delta mode only the text added since the previous flush is sent, as a custom
+    event with its offset in the text. The full text is still sent as a partial
+    update every `checkpoint_interval` seconds, so clients that missed an event
+    catch up.
+
+    While profiling, the updates and the flushes skipped for the rate budget are
+    spans of `timeline`.
+    """
+
+    def __init__(
+        self,
+        outbound: OutboundSequencer,
+        interval: Optional[float] = None,
+        min_chars: Optional[int] = None,
+        metrics: Optional[GenerationMetrics] = None,
+        deltas: Optional[bool] = None,
+        checkpoint_interval: Optional[float] = None,
+        timeline: Optional[Timeline] = None,
+    ):
+        self.outbound = outbound
+        self.metrics = metrics
+        self.timeline = timeline
+        self.interval = (
+            interval if interval is not None else settings.flush_interval_ms / 1000
+        )
+        self.min_chars = (
+            min_chars if min_chars is not None else settings.flush_min_chars
+        )
+        self.deltas = deltas if deltas is not None else settings.delta_streaming
+        self.checkpoint_interval = (
+            checkpoint_interval
+            if checkpoint_interval is not None
+            else settings.delta_checkpoint_ms / 1000
+        )
+
+        self.updates_sent = 0
+        self.deltas_sent = 0
+        self.deferred = 0
+        self._parts: List[str] = []
+        # Chunks not sent yet in delta mode, they share the strings of _parts
+        self._unsent: List[str] = []
+        self._text = ""
+        self._length = 0
+        self._sent_length = 0
+        self._last_sent = 0.0
+        self._last_checkpoint = 0.0
+        self._pending = asyncio.Event()
+        self._burst = asyncio.Event()
+        self._closed = False
+        self._stopped = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def text(self) -> str:
+        """The full text received so far"""
+        if len(self._parts) > 1:
+            self._text = "".join(self._parts)
+            self._parts = [self._text]
+        elif self._parts:
+            self._text = self._parts[0]
+        return self._text
+
+    def start(self):
+        """Start the background flush task"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def append(self, delta: str):
+        """Add streamed text, the flush task picks it up later"""
+        if not delta or self._closed:
+            return
+        self._parts.append(delta)
+        if self.deltas:
+            self._unsent.append(delta)
+        self._length += len(delta)
+        self._pending.set()
+        if self._length - self._sent_length >= self.min_chars:
+            self._burst.set()
+
+    async def close(self) -> str:
+        """Stop flushing, wait for the update in flight and return the full text"""
+        if not self._closed:
+            self._closed = True
+            self._pending.set()
+            self._burst.set()
+            self._stopped.set()
+        if self._task is not None:
+            await self._task
+        return self.text
+
+    async def _run(self):
+        while True:
+            await self._pending.wait()
+            if self._closed:
+                return
+
+            delay = self._last_sent + self.interval - time.monotonic()
+            if delay > 0 and not self._burst.is_set():
+                try:
+                    await asyncio.wait_for(self._burst.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                if self._closed:
+                    return
+
+            if not self.outbound.can_update():
+                # Too many updates across all messages: skip this flush, the text
+                # goes out with a later one or with the final update
+                self.deferred += 1
+                self._last_sent = time.monotonic()
+                began = time.time() if self.timeline is not None else 0.0
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), self.interval)
+                except asyncio.TimeoutError:
+                    pass
+                if self.timeline is not None:
+                    self.timeline.span("flush;deferred", began)
+                continue
+
+            self._pending.clear()
+            self._burst.clear()
+            now = time.monotonic()
+            self._last_sent = now
+            began = time.time() if self.timeline is not None else 0.0
+            try:
+                if (
+                    self.deltas
+                    and now - self._last_checkpoint < self.checkpoint_interval
+                ):
+                    offset = self._sent_length
+                    delta = "".join(self._unsent)
+                    self._unsent.clear()
+                    self._sent_length += len(delta)
+                    await self.outbound.delta(offset, delta)
+                    self.deltas_sent += 1
+                else:
+                    self._unsent.clear()
+                    text = self.text
+                    self._sent_length = len(text)
+                    self._last_checkpoint = now
+                    await self.outbound.partial(text)
+                    self.updates_sent += 1
+                if self.metrics is not None:
+                    self.metrics.partial_update.observe(time.monotonic() - now)
+                if self.timeline is not None:
+                    self.timeline.span("flush;update", began)
+            except Exception as error:
+                logger.warning("Error updating message: %s", error)
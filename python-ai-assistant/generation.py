@@ -0,0 +1,308 @@
+"""Per-message state of a response being generated"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+from flusher import PartialUpdateFlusher
+from metrics import GenerationMetrics
+from profiling import Timeline
+from sequencer import OutboundSequencer
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a placeholder still being created when the startup fails,
+# to delete it once it exists
+PLACEHOLDER_WAIT = 10.0
+
+
+class Generation:
+    """State of one AI response, kept off the agent so channels don't share it"""
+
+    def __init__(
+        self,
+        chat_client: Any,
+        channel: Any,
+        message_id: str,
+        bot_id: str,
+        metrics: GenerationMetrics,
+        started: float,
+        timeline: Optional[Timeline] = None,
+    ):
+        self.chat_client = chat_client
+        self.message_id = message_id
+        self.bot_id = bot_id
+        self.metrics = metrics
+        # Wall clock time the webhook was received, the stages are measured from it
+        self.started = started
+        self.message_text = ""
+        self.chunk_counter = 0
+        self.outcome: Optional[str] = None
+        # Prompt tokens reported by the LLM, and whether part of them was cached
+        self.prompt_tokens = 0
+        self.prompt_cached: Optional[bool] = None
+        self.requested_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        # Only set while profiling, see profiling.py
+        self.timeline = timeline
+        if timeline is not None:
+            timeline.message_id = message_id
+        self.outbound = OutboundSequencer(chat_client, channel, message_id, bot_id)
+        self.flusher = PartialUpdateFlusher(
+            self.outbound, metrics=metrics, timeline=timeline
+        )
+
+    def start(self):
+        """Start sending partial updates in the background"""
+        self.flusher.start()
+
+    def append(self, delta: str):
+        """Add a streamed chunk of text"""
+        if self.chunk_counter == 0:
+            self.first_token_at = time.time()
+            self.metrics.first_token.observe(self.first_token_at - self.started)
+            self.metrics.recent_first_token.observe(self.first_token_at - self.started)
+            self._observe_llm_first_token()
+        self.flusher.append(delta)
+        self.chunk_counter += 1
+
+    def usage(self, input_tokens: int, cache_read: int = 0, cache_write: int = 0):
+        """Record the prompt tokens reported by the LLM, `input_tokens` not cached"""
+        self.prompt_tokens = input_tokens + cache_read + cache_write
+        self.prompt_cached = cache_read > 0
+        self.metrics.input_tokens.inc(input_tokens)
+        self.metrics.cache_read_tokens.inc(cache_read)
+        self.metrics.cache_write_tokens.inc(cache_write)
+        self._observe_llm_first_token()
+
+    async def replay(self, text: str) -> str:
+        """Send a cached answer with the same updates as a streamed one"""
+        await self.indicator("AI_STATE_GENERATING")
+        self.append(text)
+        return await self.complete()
+
+    async def indicator(self, state: str):
+        """Update the AI indicator, in order with the message updates"""
+        began = time.time() if self.timeline is not None else 0.0
+        await self.outbound.indicator(state)
+        if self.timeline is not None:
+            self.timeline.span("indicator", began)
+
+    async def finish(self) -> str:
+        """Wait for the pending partial update and return the full text"""
+        self.message_text = await self.flusher.close()
+        return self.message_text
+
+    async def finalize(self) -> str:
+        """Send the full text once the pending partial update completed"""
+        message_text = await self.finish()
+        first = not self.outbound.final_sent
+        began = time.time() if self.timeline is not None else 0.0
+        await self.outbound.final(message_text)
+        if first:
+            self.metrics.final_update.observe(time.time() - self.started)
+            if self.timeline is not None:
+                self.timeline.span("complete;final_update", began)
+        return message_text
+
+    async def complete(self) -> str:
+        """Send the final update and clear the indicator, only once"""
+        message_text = await self.finalize()
+        first = not self.outbound.cleared
+        began = time.time() if self.timeline is not None else 0.0
+        await self.outbound.clear()
+        if first and self.timeline is not None:
+            self.timeline.span("complete;clear", began)
+        self._record(self.metrics.completed, "completed")
+        return message_text
+
+    async def abort(self) -> str:
+        """Save the text generated so far and clear the indicator after a cancel"""
+        self._record(self.metrics.cancelled, "cancelled")
+        try:
+            return await self.complete()
+        except Exception as error:
+            logger.warning("Failed to finalize stopped message: %s", error)
+        return self.message_text
+
+    async def fail(self):
+        """Stop sending partial updates and show the error state"""
+        self._record(self.metrics.failed, "failed")
+        await self.finish()
+        await self.outbound.indicator("AI_STATE_ERROR")
+
+    def _observe_llm_first_token(self):
+        # Usage comes before the first token from Anthropic, after it from OpenAI,
+        # the latency is observed once both are known
+        if None in (self.requested_at, self.first_token_at, self.prompt_cached):
+            return
+        histogram = (
+            self.metrics.llm_first_token_cached
+            if self.prompt_cached
+            else self.metrics.llm_first_token_uncached
+        )
+        histogram.observe(self.first_token_at - self.requested_at)
+        self.requested_at = None
+
+    def _record(self, counter: Any, outcome: str):
+        # The first outcome counts, e.g. a failed response that is cleared later
+        if self.outcome is None:
+            self.outcome = outcome
+            if self.timeline is not None:
+                self.timeline.outcome = outcome
+            counter.inc()
+            self.metrics.chunks.inc(self.chunk_counter)
+
+
+async def create_placeholder(
+    chat_client: Any, channel: Any, bot_id: str, parent_id: Optional[str] = None
+) -> str:
+    """
+    Send the empty AI message, in the thread of `parent_id` if set, and the thinking
+    indicator. Returns the message id. The message is deleted again if the
+    indicator fails or is cancelled.
+    """
+    message = {"text": "", "ai_generated": True}
+    if parent_id:
+        message["parent_id"] = parent_id
+    channel_message = await channel.send_message(message, bot_id)
+    message_id = channel_message["message"]["id"]
+    try:
+        await channel.send_event(
+            {
+                "type": "ai_indicator.update",
+                "ai_state": "AI_STATE_THINKING",
+                "message_id": message_id,
+            },
+            bot_id,
+        )
+    except BaseException:
+        try:
+            await chat_client.delete_message(message_id, hard=True)
+        except Exception as error:
+            logger.warning("Failed to delete placeholder message: %s", error)
+        raise
+    return message_id
+
+
+async def open_generation(
+    chat_client: Any,
+    channel: Any,
+    bot_id: str,
+    load_context: Callable[[], Awaitable[List[dict]]],
+    open_stream: Callable[[List[dict]], Awaitable[Any]],
+    metrics: GenerationMetrics,
+    started: float,
+    pipelined: bool = True,
+    parent_id: Optional[str] = None,
+    timeline: Optional[Timeline] = None,
+) -> Tuple[Generation, Any]:
+    """
+    Create the placeholder message, in the thread of `parent_id` if set, and open
+    the LLM stream for it.
+
+    When pipelined, the placeholder is sent while the context loads and the LLM is
+    called without waiting for the placeholder. The stream is only read once the
+    message exists, so early tokens wait in the response until they can be applied.
+    If the context or the placeholder fail, the placeholder is deleted; if the LLM
+    call fails, the placeholder is marked with the error state.
+    The stages are spans of `timeline` when profiling.
+    """
+
+    def mark(stage: Any, name: str, began: float):
+        ended = time.time()
+        stage.observe(ended - started)
+        if timeline is not None:
+            timeline.span(name, began, ended)
+
+    async def load():
+        began = time.time() if timeline is not None else 0.0
+        messages = await load_context()
+        mark(metrics.history, "startup;history", began)
+        return messages
+
+    async def create():
+        began = time.time() if timeline is not None else 0.0
+        message_id = await create_placeholder(chat_client, channel, bot_id, parent_id)
+        mark(metrics.placeholder, "startup;placeholder", began)
+        return message_id
+
+    requested_at = None
+
+    async def request(messages: List[dict]):
+        nonlocal requested_at
+        requested_at = time.time()
+        metrics.llm_request.observe(requested_at - started)
+        stream = await open_stream(messages)
+        if timeline is not None:
+            timeline.span("startup;llm_request", requested_at)
+        return stream
+
+    placeholder: Optional[asyncio.Task] = None
+    stream_task: Optional[asyncio.Task] = None
+    try:
+        if pipelined:
+            placeholder = asyncio.create_task(create())
+            messages = await load()
+            stream_task = asyncio.create_task(request(messages))
+            message_id = await placeholder
+        else:
+            messages = await load()
+            placeholder = asyncio.create_task(create())
+            message_id = await placeholder
+            stream_task = asyncio.create_task(request(messages))
+    except BaseException as error:
+        failed = not isinstance(error, asyncio.CancelledError)
+        (metrics.failed if failed else metrics.cancelled).inc()
+        await _discard_startup(chat_client, placeholder, stream_task)
+        raise
+
+    generation = Generation(
+        chat_client, channel, message_id, bot_id, metrics, started, timeline
+    )
+    generation.start()
+    try:
+        stream = await stream_task
+        generation.requested_at = requested_at
+        return generation, stream
+    except asyncio.CancelledError:
+        await generation.abort()
+        raise
+    except Exception:
+        try:
+            await generation.fail()
+        except Exception as error:
+            logger.warning("Failed to send ai indicator update: %s", error)
+        raise
+
+
+async def _discard_startup(
+    chat_client: Any,
+    placeholder: Optional[asyncio.Task],
+    stream_task: Optional[asyncio.Task],
+):
+    # Nothing is left behind when a branch of the startup failed or was cancelled
+    if stream_task is not None and not stream_task.done():
+        stream_task.cancel()
+    if placeholder is not None and not placeholder.done():
+        # Stream might have received the request already, cancelling the task would
+        # leave the message in the channel. It is awaited and deleted instead.
+        await asyncio.wait({placeholder}, timeout=PLACEHOLDER_WAIT)
+        if not placeholder.done():
+            logger.warning("Gave up waiting for the placeholder message to delete it")
+            placeholder.cancel()
+    tasks = [task for task in (placeholder, stream_task) if task is not None]
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    if stream_task is not None and not stream_task.cancelled():
+        if stream_task.exception() is None:
+            try:
+                await stream_task.result().close()
+            except Exception as error:
+                logger.warning("Failed to close LLM stream: %s", error)
+    if placeholder is not None and not placeholder.cancelled():
+        if placeholder.exception() is None:
+            try:
+                await chat_client.delete_message(placeholder.result(), hard=True)
+            except Exception as error:
+                logger.warning("Failed to delete placeholder message: %s", error)
@@ -18,27 +18,32 @@ def create_bot_id(channel_id: str) -> str:
     return f"ai-bot-{channel_id.replace('!', '')}"
 
 
-async def get_last_messages_from_channel(
+def is_bot_user(user_id: str) -> bool:
+    """Check if a user id belongs to an AI bot"""
+    return user_id.startswith("ai-bot")
+
+
+def is_user_message(message: Any) -> bool:
+    """Check if a webhook message was written by a user and has text"""
+    return (
+        isinstance(message, dict)
+        and not message.get("ai_generated")
+        and bool(message.get("text"))
+    )
+
+
+async def search_last_messages(
     chat_client: Any, channel_id: str, limit: int = 5
 ) -> List[Any]:
-    """Get the last messages from the channel"""
+    """Search the last non-empty messages of the channel, newest first"""
     channel_filters = {"cid": channel_id}
     message_filters = {"type": {"$eq": "regular"}}
     sort = {"updated_at": -1}
     message_search = await chat_client.search(
         channel_filters, message_filters, sort, limit=limit
     )
-
-    messages = [
-        {
-            "content": message["message"]["text"].strip(),
-            "role": (
-                "assistant"
-                if message["message"]["user"]["id"].startswith("ai-bot")
-                else "user"
-            ),
-        }
-        for message in message_search["results"]
-        if message["message"]["text"] != ""
+    return [
+        result["message"]
+        for result in message_search["results"]
+        if result["message"]["text"] != ""
     ]
-    return messages
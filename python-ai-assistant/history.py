@@ -0,0 +1,212 @@
+"""In-memory cache of the recent conversation in each channel and thread"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from helpers import is_bot_user, search_last_messages
+
+# Types of the messages of a thread, the replies and the ones also shown in the
+# channel
+THREAD_MESSAGE_TYPES = ("regular", "reply")
+
+
+class ChannelHistory:
+    """The most recent messages of one channel, oldest first"""
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self.messages: "OrderedDict[str, Tuple[str, str]]" = OrderedDict()
+        # A channel only counts as warm once it was seeded from the search API,
+        # messages recorded before that are not the full history
+        self.warm = False
+
+    def put(self, message_id: str, role: str, text: str):
+        """Add a message or replace the text of a known one"""
+        if message_id in self.messages:
+            self.messages[message_id] = (role, text)
+            return
+        self.messages[message_id] = (role, text)
+        while len(self.messages) > self.max_messages:
+            self.messages.popitem(last=False)
+
+    def seed(self, results: List[Dict[str, Any]]):
+        """Put messages from a search (newest first) before the recorded ones"""
+        recorded = self.messages
+        self.messages = OrderedDict()
+        for message in reversed(results):
+            if message["id"] not in recorded:
+                self.put(message["id"], _role_of(message), message["text"].strip())
+        for message_id, (role, text) in recorded.items():
+            self.put(message_id, role, text)
+        self.warm = True
+
+    def last(self, limit: int) -> List[Dict[str, str]]:
+        """The last messages, newest first"""
+        items = list(self.messages.items())[-limit:] if limit > 0 else []
+        return [
+            {"id": message_id, "content": text, "role": role}
+            for message_id, (role, text) in reversed(items)
+        ]
+
+
+class ThreadHistory(ChannelHistory):
+    """The parent message of a thread and its most recent replies"""
+
+    def __init__(self, max_messages: int):
+        super().__init__(max_messages)
+        self.parent: Optional[Dict[str, str]] = None
+
+    def seed_thread(self, parent: Dict[str, Any], replies: List[Dict[str, Any]]):
+        """Set the parent and put the replies (oldest first) before the recorded ones"""
+        text = (parent.get("text") or "").strip()
+        self.parent = None
+        if text:
+            self.parent = {
+                "id": parent["id"],
+                "content": text,
+                "role": _role_of(parent),
+            }
+        self.seed(
+            [
+                reply
+                for reply in reversed(replies)
+                if reply.get("type", "reply") in THREAD_MESSAGE_TYPES
+                and (reply.get("text") or "").strip()
+            ]
+        )
+
+    def last(self, limit: int) -> List[Dict[str, str]]:
+        """The last replies, newest first, then the parent message"""
+        if self.parent is None or limit <= 0:
+            return super().last(limit)
+        return super().last(limit - 1) + [dict(self.parent)]
+
+
+class HistoryCache:
+    """
+    Keeps the recent turns of each channel in bounded buffers, so the search API is
+    only hit on a cold miss or an explicit resync. Threads are kept apart with their
+    parent message, and loaded from the replies of the parent instead of a search.
+    The least recently used channels and threads are evicted once `max_channels`
+    and `max_threads` are reached.
+    """
+
+    def __init__(self, max_channels: int, max_messages: int, max_threads: int = 10000):
+        self.max_channels = max_channels
+        self.max_messages = max_messages
+        self.max_threads = max_threads
+        self._channels: "OrderedDict[str, ChannelHistory]" = OrderedDict()
+        self._threads: "OrderedDict[Tuple[str, str], ThreadHistory]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def record(self, cid: str, message: Optional[Dict[str, Any]]):
+        """Record a message from a /new-message webhook, in its thread if it has one"""
+        if not isinstance(message, dict) or not message.get("id"):
+            return
+        parent_id = message.get("parent_id")
+        allowed = THREAD_MESSAGE_TYPES if parent_id else ("regular",)
+        if message.get("type", "regular") not in allowed:
+            return
+        text = (message.get("text") or "").strip()
+        if not text:
+            return
+        history = self._thread(cid, parent_id) if parent_id else self._channel(cid)
+        history.put(message["id"], _role_of(message), text)
+
+    def record_reply(
+        self, cid: str, message_id: str, text: str, parent_id: Optional[str] = None
+    ):
+        """Record the final text of a reply sent by the agent"""
+        if text:
+            history = self._thread(cid, parent_id) if parent_id else self._channel(cid)
+            history.put(message_id, "assistant", text.strip())
+
+    def invalidate(self, cid: str):
+        """Forget a channel and its threads, the next read will resync them"""
+        self._channels.pop(cid, None)
+        for key in [key for key in self._threads if key[0] == cid]:
+            del self._threads[key]
+
+    async def get(
+        self, chat_client: Any, cid: str, limit: int, resync: bool = False
+    ) -> List[Dict[str, str]]:
+        """The last messages of a channel, newest first, like the search helper"""
+        history = self._channel(cid)
+        if history.warm and not resync:
+            self.hits += 1
+        else:
+            self.misses += 1
+            results = await search_last_messages(
+                chat_client, cid, max(limit, self.max_messages)
+            )
+            history.seed(results)
+        return history.last(limit)
+
+    async def get_thread(
+        self,
+        chat_client: Any,
+        channel: Any,
+        cid: str,
+        parent_id: str,
+        limit: int,
+        resync: bool = False,
+    ) -> List[Dict[str, str]]:
+        """The last replies of a thread, newest first, then its parent message"""
+        thread = self._thread(cid, parent_id)
+        if thread.warm and not resync:
+            self.hits += 1
+        else:
+            self.misses += 1
+            parent, replies = await asyncio.gather(
+                chat_client.get_message(parent_id),
+                channel.get_replies(parent_id, limit=max(limit, self.max_messages)),
+            )
+            thread.seed_thread(parent["message"], replies["messages"])
+        return thread.last(limit)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters to size the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "channels": len(self._channels),
+            "maxChannels": self.max_channels,
+            "threads": len(self._threads),
+            "maxThreads": self.max_threads,
+            "maxMessages": self.max_messages,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def _channel(self, cid: str) -> ChannelHistory:
+        history = self._channels.get(cid)
+        if history is None:
+            history = ChannelHistory(self.max_messages)
+            self._channels[cid] = history
+            while len(self._channels) > self.max_channels:
+                self._channels.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._channels.move_to_end(cid)
+        return history
+
+    def _thread(self, cid: str, parent_id: str) -> ThreadHistory:
+        key = (cid, parent_id)
+        thread = self._threads.get(key)
+        if thread is None:
+            thread = ThreadHistory(self.max_messages)
+            self._threads[key] = thread
+            while len(self._threads) > self.max_threads:
+                self._threads.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._threads.move_to_end(key)
+        return thread
+
+
+def _role_of(message: Dict[str, Any]) -> str:
+    user_id = (message.get("user") or {}).get("id", "")
+    return "assistant" if is_bot_user(user_id) else "user"
@@ -0,0 +1,201 @@
+"""Agents answering in the channels with the LLM provider chosen for each"""
+
+import asyncio
+import logging
+import time
+from typing import Any, List, Optional
+from clients import ClientLease
+from config import settings
+from generation import Generation, open_generation
+from model import NewMessageRequest
+from context import ContextBuilder
+from history import HistoryCache
+from metrics import generation_metrics
+from profiling import Profiler
+from registry import AgentBinding
+from providers import DONE, TEXT, USAGE, Event
+from response_cache import CachedRequest, CachedResponse, ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+class ChannelAgent:
+    """The agent of one channel: its binding and the shared engine of its provider"""
+
+    __slots__ = ("binding", "engine")
+
+    def __init__(self, binding: AgentBinding, engine: "LLMAgent"):
+        self.binding = binding
+        self.engine = engine
+
+    async def handle_message(self, event: NewMessageRequest):
+        """Handle a new message of the channel"""
+        await self.engine.handle_message(self.binding, event)
+
+    async def dispose(self):
+        """Nothing to release, the engine is shared by the channels"""
+
+
+class LLMAgent:
+    """
+    Engine of an LLM provider, see providers.py, shared by all the channels using
+    it. It keeps nothing per channel, the channel handle is built for each message.
+    """
+
+    def __init__(
+        self,
+        clients: ClientLease,
+        history: HistoryCache,
+        context: ContextBuilder,
+        responses: ResponseCache,
+        provider: Any,
+        profiler: Profiler,
+    ):
+        self.clients = clients
+        self.history = history
+        self.context = context
+        self.responses = responses
+        self.provider = provider
+        self.profiler = profiler
+        self.model = provider.model
+        self.chat_client = clients.stream
+        self.metrics = generation_metrics(provider.name, provider.model)
+
+    async def dispose(self):
+        """Dispose of the engine, once no channel uses it"""
+        self.clients.release()
+
+    async def handle_message(self, binding: AgentBinding, event: NewMessageRequest):
+        """Handle a new message of a channel, with its timeline while profiling"""
+        generation = None
+        timeline = None
+
+        try:
+            if not event.message or event.message.get("ai_generated"):
+                logger.debug("Skip handling ai generated message")
+                return
+
+            message = event.message.get("text")
+            if not message:
+                logger.debug("Skip handling empty message")
+                return
+
+            # Answered in the thread of the message, with the thread as context
+            parent_id = event.message.get("parent_id")
+            channel = self.chat_client.channel(binding.channel_type, binding.channel_id)
+            started = event.received_at or time.time()
+            timeline = self.profiler.begin(
+                event.cid, binding.bot_id, self.model, event.received_at
+            )
+            request = CachedRequest(self.responses, self.model, {"max_tokens": 1024})
+            try:
+                generation, llm_stream = await open_generation(
+                    self.chat_client,
+                    channel,
+                    binding.bot_id,
+                    lambda: self.load_context(channel, event, message, parent_id),
+                    lambda messages: request.open(
+                        self.context.build(messages, self.model), self.provider.open
+                    ),
+                    self.metrics,
+                    started,
+                    pipelined=settings.pipelined_startup,
+                    parent_id=parent_id,
+                    timeline=timeline,
+                )
+            except Exception as error:
+                logger.error("Failed to start generation: %s", error)
+                return
+            message_id = generation.message_id
+            logger.debug("Generation started as message %s", message_id)
+
+            try:
+                try:
+                    if isinstance(llm_stream, CachedResponse):
+                        message_text = await generation.replay(llm_stream.text)
+                    else:
+                        events = (
+                            llm_stream
+                            if timeline is None
+                            else timeline.stream(llm_stream)
+                        )
+                        async for llm_event in events:
+                            await self.handle(llm_event, generation)
+
+                        # Only sent if the stream didn't complete the message already
+                        message_text = await generation.complete()
+                        request.store(generation, message_text)
+                finally:
+                    # Also when stopped, superseded or failed: stop paying for
+                    # tokens nobody will see and free the connection
+                    await llm_stream.close()
+                # Remember the reply so the next turn doesn't need a search
+                self.history.record_reply(
+                    event.cid, message_id, message_text, parent_id
+                )
+                logger.debug("Generation completed with %s chars", len(message_text))
+            except asyncio.CancelledError:
+                # Stopped or superseded, keep what was generated so far
+                message_text = await generation.abort()
+                self.history.record_reply(
+                    event.cid, message_id, message_text, parent_id
+                )
+                raise
+            except Exception:
+                logger.exception("Error in message handling")
+                await generation.fail()
+        finally:
+            if generation:
+                await generation.finish()
+            if timeline is not None:
+                self.profiler.end(timeline)
+
+    async def load_context(
+        self,
+        channel: Any,
+        event: NewMessageRequest,
+        message: str,
+        parent_id: Optional[str] = None,
+    ) -> List[dict]:
+        """
+        The recent messages of the channel, or of the thread of `parent_id`, newest
+        first, with the new message
+        """
+        if parent_id:
+            messages = await self.history.get_thread(
+                self.chat_client,
+                channel,
+                event.cid,
+                parent_id,
+                self.history.max_messages,
+            )
+        else:
+            messages = await self.history.get(
+                self.chat_client, event.cid, self.history.max_messages
+            )
+
+        try:
+            if messages[0]["content"] != message.strip():
+                messages.insert(0, {"role": "user", "content": message})
+        except IndexError:
+            logger.debug("No messages found in channel")
+
+        return messages
+
+    async def handle(self, llm_event: Event, generation: Generation):
+        """Handle an event of the LLM stream"""
+        kind, value = llm_event
+
+        if kind == TEXT:
+            if generation.chunk_counter == 0:
+                await generation.indicator("AI_STATE_GENERATING")
+            # Partial updates are sent in the background
+            generation.append(value)
+
+        elif kind == DONE:
+            # Sent after the pending partial update, then the indicator is cleared
+            await generation.complete()
+
+        elif kind == USAGE:
+            input_tokens, cache_read, cache_write = value
+            generation.usage(input_tokens, cache_read, cache_write)
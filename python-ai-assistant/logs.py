@@ -0,0 +1,161 @@
+"""
+Logging off the event loop. Records are put in a queue by the code logging them and
+formatted and written by a background thread, with the correlation ids (channel,
+message and bot) of the task that logged them.
+"""
+
+import contextvars
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from typing import Any, Dict, Optional, Tuple
+import orjson
+from metrics import REGISTRY, Counter
+
+CID = contextvars.ContextVar("cid", default="-")
+MESSAGE_ID = contextvars.ContextVar("message_id", default="-")
+BOT_ID = contextvars.ContextVar("bot_id", default="-")
+
+# Loggers of the HTTP clients, one INFO record per request, kept at WARNING
+QUIET_LOGGERS = ("httpx", "httpcore")
+
+TEXT_FORMAT = (
+    "%(asctime)s %(levelname)s %(name)s "
+    "cid=%(cid)s message_id=%(message_id)s bot_id=%(bot_id)s %(message)s"
+)
+
+DROPPED = REGISTRY.register(
+    Counter(
+        "ai_log_records_dropped_total",
+        "Log records dropped, by reason: rate (debug records over the rate limit) "
+        "or queue (the writer thread fell behind)",
+        ("reason",),
+    )
+)
+
+
+def set_log_context(
+    cid: Optional[str] = None,
+    bot_id: Optional[str] = None,
+    message_id: Optional[str] = None,
+):
+    """
+    Set the correlation ids of the records logged by the current task and the tasks
+    it creates from now on
+    """
+    if cid is not None:
+        CID.set(cid)
+    if bot_id is not None:
+        BOT_ID.set(bot_id)
+    if message_id is not None:
+        MESSAGE_ID.set(message_id)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the correlation ids of the logging task to the record"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.cid = CID.get()
+        record.message_id = MESSAGE_ID.get()
+        record.bot_id = BOT_ID.get()
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `rate` debug records per second through for each logged message
+    (the format string, not the formatted text), with bursts of up to `burst`.
+    Other levels always go through. A rate of 0 is not limited.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        # Tokens left and time of the last refill, per logger and message
+        self._buckets: Dict[Tuple[str, Any], Tuple[float, float]] = {}
+        self._dropped = DROPPED.labels("rate")
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.rate <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[key] = (tokens, now)
+            self._dropped.inc()
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "cid": getattr(record, "cid", "-"),
+            "message_id": getattr(record, "message_id", "-"),
+            "bot_id": getattr(record, "bot_id", "-"),
+        }
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return orjson.dumps(data, default=str).decode()
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts the records in the queue as they are, the message is formatted by the
+    writer thread. Records are dropped while the queue is full, logging never
+    waits for the writer.
+    """
+
+    def __init__(self, records: "queue.Queue[logging.LogRecord]"):
+        super().__init__(records)
+        self._dropped = DROPPED.labels("queue")
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self._dropped.inc()
+
+
+def setup_logging(
+    level: str = "INFO",
+    log_format: str = "text",
+    debug_rate: float = 10.0,
+    queue_size: int = 10000,
+) -> logging.handlers.QueueListener:
+    """
+    Send the records of every logger through a queue to a thread writing them to
+    stdout. The returned listener must be started, and stopped on shutdown to flush
+    the queue.
+    """
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(queue_size)
+    handler = QueueHandler(records)
+    handler.addFilter(ContextFilter())
+    handler.addFilter(RateLimitFilter(debug_rate))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(
+        JSONFormatter() if log_format == "json" else logging.Formatter(TEXT_FORMAT)
+    )
+
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level.upper())
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(root.level, logging.WARNING))
+    return logging.handlers.QueueListener(records, output)
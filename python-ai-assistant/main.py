@@ -3,24 +3,202 @@ This is the main file for the AI assistant.
 It is a FastAPI application that listens for messages from the client and responds to them.
 """
 
-import os
+import asyncio
 import json
-from fastapi import FastAPI, Response
+import logging
+import time
+from typing import Dict, List, Optional
+from contextlib import asynccontextmanager
+from fastapi import BackgroundTasks, FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from stream_chat import StreamChatAsync
-from dotenv import load_dotenv
-from model import StartAgentRequest, StopAgentRequest, NewMessageRequest
-from helpers import clean_channel_id, create_bot_id
+from admission import AdmissionController
+from config import settings
+from clients import ClientManager
+from model import (
+    StartAgentRequest,
+    StartAgentsRequest,
+    StopAgentRequest,
+    NewMessageRequest,
+    ResyncHistoryRequest,
+)
+from helpers import clean_channel_id, create_bot_id, is_user_message
+from context import ContextBuilder
+from dispatcher import ChannelDispatcher
+from history import HistoryCache
+from logs import set_log_context, setup_logging
+from metrics import (
+    LOOP_LAG_SECONDS,
+    RECENT_FIRST_TOKEN,
+    REGISTRY,
+    WEBHOOKS,
+    Gauge,
+    LoopLagMonitor,
+)
+from profiling import Profiler
+from providers import create_provider
+from provisioning import Provisioner, ProvisioningCache
+from registry import AgentBinding, AgentRegistry
+from response_cache import ResponseCache
+from scheduler import ChannelScheduler
+from snapshot import load_snapshot, save_snapshot
+from state_store import create_state_store
+from webhooks import DROPPED, compact_message, drop_reason, read_webhook, type_label
+
+from ai_agent import AgentPlatform
+from llm_agent import ChannelAgent, LLMAgent
+
+# Records are formatted and written by a background thread, started with the app
+log_listener = setup_logging(
+    settings.log_level,
+    settings.log_format,
+    settings.log_debug_rate,
+    settings.log_queue_size,
+)
+logger = logging.getLogger(__name__)
+
+api_key = settings.stream_api_key
 
-from openai_agent import OpenAIAgent
+PLATFORMS = {platform.value for platform in AgentPlatform}
 
-load_dotenv()
+# Control message queued to stop the agent of a channel on the worker that owns it
+STOP_AGENT_EVENT = "ai_agent.stop"
 
-api_key = os.getenv("STREAM_API_KEY")
-api_secret = os.getenv("STREAM_API_SECRET")
+# Seconds the generations cancelled on shutdown get to save their partial text
+FINALIZE_TIMEOUT = 5.0
 
+# Shared keep-alive clients, agents borrow them instead of opening their own
+clients = ClientManager(settings)
+
+# Messages are handled in the background, in order per channel
+scheduler = ChannelScheduler(
+    settings.max_concurrent_generations, settings.merge_queued_messages
+)
+
+# Sheds new messages while the scheduler is overloaded, active channels first
+admission = AdmissionController(
+    in_flight=lambda: scheduler.in_flight,
+    queued=lambda: scheduler.queue_depth,
+    first_token=RECENT_FIRST_TOKEN.value,
+    max_in_flight=settings.admission_max_in_flight,
+    max_queued=settings.admission_max_queued,
+    max_first_token=settings.admission_max_first_token_ms / 1000,
+    active_window=settings.admission_active_window,
+    active_headroom=settings.admission_active_headroom,
+)
+
+# Recent conversation per channel and thread, fed by the webhooks and the agents' replies
+history = HistoryCache(
+    settings.history_max_channels,
+    settings.history_max_messages,
+    settings.history_max_threads,
+)
+
+# Packs the recent turns into the token budget of each model
+context = ContextBuilder(
+    settings.context_token_budget,
+    settings.context_max_message_tokens,
+    settings.context_token_budgets,
+)
+
+# Answers to repeated prompts, off unless RESPONSE_CACHE_SIZE is set
+responses = ResponseCache(settings.response_cache_size, settings.response_cache_ttl)
+
+# Bot users and memberships that exist already, restarts skip those writes
+provisioner = Provisioner(
+    ProvisioningCache(settings.provisioning_cache_ttl),
+    settings.provisioning_concurrency,
+)
+
+# Agent bindings, channel leases and queues shared with the other workers
+store = create_state_store(settings.state_store_url)
+
+# How late the event loop runs its callbacks, exported as ai_event_loop_lag_seconds
+loop_lag = LoopLagMonitor(LOOP_LAG_SECONDS)
+
+# Timelines of the slowest generations, off unless PROFILE_SLOWEST is set
+profiler = Profiler(settings.profile_slowest)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """Start the shared clients with the app, and shut down gracefully"""
+    log_listener.start()
+    loop_lag.start()
+    profiler.start()
+    await clients.start()
+    await restore_bindings()
+    agents.start()
+    try:
+        yield
+    finally:
+        # New messages are shed and left in the shared queues for other workers
+        admission.close()
+        await dispatcher.stop()
+        cancelled = await scheduler.drain(settings.shutdown_timeout, FINALIZE_TIMEOUT)
+        if cancelled:
+            logger.info(
+                "Saved the partial answers of %s generations on shutdown", cancelled
+            )
+        await return_queued_messages()
+        await dispatcher.close()
+        await scheduler.close()
+        await agents.close()
+        await dispose_engines()
+        await clients.close()
+        await snapshot_bindings()
+        await store.close()
+        await loop_lag.close()
+        await profiler.close()
+        log_listener.stop()
+
+
+async def return_queued_messages():
+    """
+    Put the messages that were not started back in front of their channel queue,
+    while this worker still holds the leases, so the next owner answers them
+    """
+    queued = scheduler.take_queued()
+    if not queued:
+        return
+    if not store.shared:
+        logger.warning("Dropped %s queued messages on shutdown", len(queued))
+        return
+    # In reverse, each one goes in front of the newer ones of its channel
+    for bot_id, request in reversed(queued):
+        await store.return_message(bot_id, request.model_dump_json())
+    logger.info("Returned %s queued messages to the shared queues", len(queued))
+
+
+async def restore_bindings():
+    """
+    Restore the agents of the last snapshot into an empty state store, e.g. the
+    memory store after a restart. The agents are built on their next message.
+    """
+    if not settings.agent_snapshot_path:
+        return
+    bindings = load_snapshot(settings.agent_snapshot_path)
+    if not bindings or await store.list_bindings():
+        return
+    for binding in bindings:
+        agents.bind(binding)
+        await store.save_binding(binding)
+    logger.info(
+        "Restored %s agents from %s", len(bindings), settings.agent_snapshot_path
+    )
+
+
+async def snapshot_bindings():
+    """Write the bindings of the agents to the snapshot file"""
+    if not settings.agent_snapshot_path:
+        return
+    try:
+        save_snapshot(settings.agent_snapshot_path, await store.list_bindings())
+    except Exception:
+        logger.exception("Failed to write snapshot")
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS
 origins = [
@@ -36,7 +214,117 @@ app.add_middleware(
 )
 
 
-agents = {}
+# One engine per platform, shared by the agents of all its channels
+engines: Dict[str, LLMAgent] = {}
+
+
+def create_agent(binding: AgentBinding) -> ChannelAgent:
+    """Create the agent of a channel over the shared engine of its platform"""
+    engine = engines.get(binding.platform)
+    if engine is None:
+        lease = clients.lease()
+        try:
+            provider = create_provider(binding.platform, lease, settings)
+        except Exception:
+            lease.release()
+            raise
+        engine = LLMAgent(lease, history, context, responses, provider, profiler)
+        engines[binding.platform] = engine
+    return ChannelAgent(binding, engine)
+
+
+async def dispose_engines():
+    """Release the clients of the engines, once every agent is disposed"""
+    for engine in engines.values():
+        await engine.dispose()
+    engines.clear()
+
+
+# Idle agents are evicted and rebuilt lazily when their channel gets a new message
+agents = AgentRegistry(
+    create_agent,
+    idle_ttl=settings.agent_idle_ttl,
+    max_size=settings.agent_max_resident,
+    reap_interval=settings.agent_reap_interval,
+    is_busy=scheduler.is_busy,
+)
+
+
+def forget_history(_bot_id: str, cid: str):
+    """
+    Drop the cached history of a channel this worker takes over, another worker
+    might have answered in it since. A memory store has no other workers.
+    """
+    if store.shared:
+        history.invalidate(cid)
+
+
+async def deliver_message(bot_id: str, request: NewMessageRequest):
+    """
+    Handle a message of a channel owned by this worker.
+    It is called by the dispatcher in the order the messages were queued.
+    """
+    if request.control == STOP_AGENT_EVENT:
+        await remove_agent(bot_id)
+        return
+    set_log_context(request.cid, bot_id, message_id(request))
+
+    # The agent might have been started or stopped on another worker
+    binding = await store.load_binding(bot_id)
+    if binding is None:
+        await remove_agent(bot_id)
+        return
+    agents.bind(binding)
+
+    # The user pressed "stop" while the answer was streaming
+    if request.type == "ai_indicator.stop":
+        scheduler.cancel(bot_id)
+        return
+
+    if settings.cancel_on_new_message and is_user_message(request.message):
+        scheduler.cancel(bot_id)
+
+    history.record(request.cid, request.message)
+    scheduler.submit(bot_id, handle_agent_message, request)
+    logger.debug("Message queued for the agent")
+
+
+# Makes sure only one worker answers in a channel at a time
+dispatcher = ChannelDispatcher(
+    store,
+    deliver_message,
+    is_busy=scheduler.is_busy,
+    lease_ttl=settings.channel_lease_ttl,
+    poll_interval=settings.queue_poll_interval,
+    on_acquire=forget_history,
+)
+
+
+# Read when /metrics is scraped
+for gauge in (
+    Gauge("ai_active_agents", "Channels with an AI agent", lambda: len(agents)),
+    Gauge(
+        "ai_resident_agents",
+        "Agents in memory on this worker",
+        lambda: agents.resident_count,
+    ),
+    Gauge(
+        "ai_inflight_generations",
+        "Responses being generated on this worker",
+        lambda: scheduler.in_flight,
+    ),
+    Gauge(
+        "ai_queued_messages",
+        "Messages waiting for their channel on this worker",
+        lambda: scheduler.queue_depth,
+    ),
+    Gauge(
+        "ai_owned_channels",
+        "Channels this worker holds the lease of",
+        lambda: dispatcher.owned_count,
+    ),
+):
+    REGISTRY.register(gauge)
 
 
 @app.get("/")
@@ -49,6 +337,10 @@ async def root():
         "message": "GetStream AI Server is running",
         "apiKey": api_key,
         "activeAgents": len(agents),
+        "residentAgents": agents.resident_count,
+        "evictedAgents": agents.evicted_count,
+        "workerId": dispatcher.worker_id,
+        "ownedChannels": dispatcher.owned_count,
     }
 
 
@@ -56,35 +348,26 @@ async def root():
 async def start_ai_agent(request: StartAgentRequest, response: Response):
     """
     This endpoint starts an AI agent for a given channel.
-    It creates a bot user and adds it to the channel.
-    It also creates an agent and adds it to the agents dictionary.
+    It creates a bot user and adds it to the channel, unless both were done recently.
+    It also creates an agent and adds it to the agents registry. Starting it again
+    with the same platform leaves the running agent as it is.
     """
-    server_client = StreamChatAsync(api_key, api_secret)
-
-    # Clean up channel id to remove the channel type - if necessary
-    channel_id_updated = clean_channel_id(request.channel_id)
-
-    # Create a bot id
-    bot_id = create_bot_id(channel_id=channel_id_updated)
-
-    # Upsert the bot user
-    await server_client.upsert_user(
-        {
-            "id": bot_id,
-            "name": "AI Bot",
-            "role": "admin",
-        }
-    )
+    if request.platform not in PLATFORMS:
+        response.status_code = 400
+        response.body = str.encode(
+            json.dumps({"error": f"Unknown platform {request.platform}"})
+        )
+        return response
 
-    # Create a channel
-    channel = server_client.channel(request.channel_type, channel_id_updated)
+    binding = agent_binding(request)
+    # Started already, e.g. the channel was opened again: keep the agent and its
+    # running answer
+    if await store.load_binding(binding.bot_id) == binding:
+        agents.bind(binding)
+        return {"message": "AI agent started"}
 
-    # Add the bot to the channel
-    try:
-        await channel.add_members([bot_id])
-    except Exception as error:
-        print("Failed to add members to the channel: ", error)
-        await server_client.close()
+    errors = await provision_bots([binding])
+    if errors[binding.bot_id] is not None:
         response.status_code = 405
         response.body = str.encode(
             json.dumps({"error": "Not possible to add the AI to distinct channels"})
@@ -92,67 +375,276 @@ async def start_ai_agent(request: StartAgentRequest, response: Response):
         return response
 
     # Create an agent
-    # agent = AnthropicAgent(server_client, channel)
-    agent = OpenAIAgent(server_client, channel)
+    agent = create_agent(binding)
 
-    if bot_id in agents:
-        print("Disposing agent")
-        await agents[bot_id].dispose()
-    else:
-        agents[bot_id] = agent
+    if binding.bot_id in agents:
+        logger.info("Disposing agent %s", binding.bot_id)
+        await stop_generation(binding.bot_id)
+    previous = agents.register(binding, agent)
+    if previous is not None:
+        await previous.dispose()
+    await store.save_binding(binding)
 
     return {"message": "AI agent started"}
 
 
+@app.post("/start-ai-agents")
+async def start_ai_agents(request: StartAgentsRequest):
+    """
+    This endpoint starts the AI agents of many channels, e.g. to onboard a tenant.
+    The bot users are created in batches and added to the channels concurrently.
+    The agents are built when their channel gets a message.
+    """
+    failed: Dict[str, str] = {}
+    bindings = []
+    for channel in request.channels:
+        if channel.platform not in PLATFORMS:
+            failed[channel.channel_id] = f"Unknown platform {channel.platform}"
+        else:
+            bindings.append(agent_binding(channel))
+
+    errors = await provision_bots(bindings)
+    started = 0
+    for binding in bindings:
+        error = errors[binding.bot_id]
+        if error is not None:
+            failed[binding.channel_id] = error
+            continue
+        agents.bind(binding)
+        await store.save_binding(binding)
+        started += 1
+
+    return {"started": started, "failed": failed}
+
+
+def agent_binding(request: StartAgentRequest) -> AgentBinding:
+    """The binding of the agent to start in a channel"""
+    # Clean up channel id to remove the channel type - if necessary
+    channel_id = clean_channel_id(request.channel_id)
+    return AgentBinding(
+        bot_id=create_bot_id(channel_id=channel_id),
+        channel_type=request.channel_type,
+        channel_id=channel_id,
+        platform=request.platform,
+    )
+
+
+async def provision_bots(bindings: List[AgentBinding]) -> Dict[str, Optional[str]]:
+    """Create the bot users and add them to their channels, returns their errors"""
+    # A cached membership is stale if the agent was stopped, maybe by another worker
+    stored = await asyncio.gather(
+        *(store.load_binding(binding.bot_id) for binding in bindings)
+    )
+    bound = {binding.bot_id for binding in stored if binding is not None}
+    return await provisioner.provision(
+        clients.stream,
+        [
+            (binding.channel_type, binding.channel_id, binding.bot_id)
+            for binding in bindings
+        ],
+        bound,
+    )
+
+
 @app.post("/stop-ai-agent")
 async def stop_ai_agent(request: StopAgentRequest):
     """
     This endpoint stops an AI agent for a given channel.
-    It removes the agent from the agents dictionary and closes the server client.
+    It removes the agent from the agents registry and removes the bot from the channel.
     """
-    server_client = StreamChatAsync(api_key, api_secret)
+    server_client = clients.stream
 
     bot_id = create_bot_id(request.channel_id)
 
-    if bot_id in agents:
-        await agents[bot_id].dispose()
-        del agents[bot_id]
+    # The worker that owns the channel stops the generation and the agent
+    await store.delete_binding(bot_id)
+    await dispatcher.dispatch(
+        bot_id,
+        NewMessageRequest(
+            cid=f"messaging:{request.channel_id}",
+            type=None,
+            message=None,
+            control=STOP_AGENT_EVENT,
+        ),
+    )
+    if not scheduler.is_busy(bot_id):
+        await remove_agent(bot_id)
 
     channel = server_client.channel("messaging", request.channel_id)
+    provisioner.cache.remove_member("messaging", request.channel_id)
     await channel.remove_members([bot_id])
-    await server_client.close()
     return {"message": "AI agent stopped"}
 
 
 @app.post("/new-message")
-async def new_message(request: NewMessageRequest):
+async def new_message(request: Request, background_tasks: BackgroundTasks):
     """
     This endpoint handles a new message from the client.
-    It cleans the channel id and creates a bot id.
-    It then checks if the bot id is in the agents dictionary and if it is, it handles the message.
+    Webhooks no agent would answer are dropped before the message is parsed: other
+    event types, AI generated or empty messages, and channels without an agent.
+    Otherwise the message is queued for the worker owning the channel and the
+    endpoint returns right away. While the worker is overloaded, new user messages
+    are shed with a busy status or reply instead.
     """
-    print(request)
-    if not request.cid:
+    received_at = time.time()
+    try:
+        event = read_webhook(await request.body())
+    except ValueError:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+    event_type = event.get("type")
+    WEBHOOKS.labels(type_label(event_type)).inc()
+
+    reason = drop_reason(event)
+    if reason is not None:
+        DROPPED.labels(reason).inc()
+        logger.debug("Webhook dropped: %s", reason)
+        return Response()
+
+    cid = event.get("cid")
+    if not cid or not isinstance(cid, str):
         return {"error": "Missing required fields", "code": 400}
 
-    channel_id = clean_channel_id(request.cid)
+    channel_id = clean_channel_id(cid)
     bot_id = create_bot_id(channel_id=channel_id)
+    set_log_context(cid, bot_id)
+
+    if bot_id not in agents and await store.load_binding(bot_id) is None:
+        DROPPED.labels("no_agent").inc()
+        logger.debug("Webhook dropped: %s", "no_agent")
+        return Response()
+
+    # Validated above, the message only keeps the fields the agents use
+    message = NewMessageRequest.model_construct(
+        cid=cid,
+        type=event_type,
+        message=compact_message(event.get("message")),
+        received_at=received_at,
+    )
+    set_log_context(message_id=message_id(message))
+    reason = is_user_message(message.message) and admission.admit(bot_id)
+    if reason:
+        # On shutdown the webhook is retried against another worker instead
+        if settings.busy_reply and reason != "shutdown":
+            background_tasks.add_task(send_busy_reply, message)
+            return {"message": "AI agent is busy"}
+        return JSONResponse(
+            {"error": "AI agent is busy, retry later"},
+            status_code=settings.shed_status,
+            headers={"Retry-After": str(settings.shed_retry_after)},
+        )
+
+    await dispatcher.dispatch(bot_id, message)
+    return Response()
+
+
+async def send_busy_reply(request: NewMessageRequest):
+    """Tell the user in the channel or thread that the message won't be answered"""
+    channel_type, _, channel_id = request.cid.rpartition(":")
+    channel = clients.stream.channel(channel_type or "messaging", channel_id)
+    reply = {"text": settings.busy_reply, "ai_generated": True}
+    if request.message.get("parent_id"):
+        reply["parent_id"] = request.message["parent_id"]
+    try:
+        await channel.send_message(reply, create_bot_id(channel_id=channel_id))
+    except Exception as error:
+        logger.warning("Failed to send busy reply: %s", error)
+
+
+async def handle_agent_message(request: NewMessageRequest):
+    """
+    Hand a queued message to the agent of its channel.
+    The agent is looked up when the message is handled, it might have been restarted
+    or evicted in the meantime.
+    """
+    bot_id = create_bot_id(channel_id=clean_channel_id(request.cid))
+    set_log_context(request.cid, bot_id, message_id(request))
+    agent = agents.get(bot_id)
+    if agent is None:
+        logger.info("AI agent was stopped before handling the message")
+        return
+    await agent.handle_message(request)
 
-    if bot_id in agents:
-        if not agents[bot_id].processing:
-            await agents[bot_id].handle_message(request)
-        else:
-            print("AI agent is already processing a message")
-    else:
-        print("AI agent not found for bot", bot_id)
+
+def message_id(request: NewMessageRequest) -> str:
+    """The id of the message of a webhook, for the logs"""
+    return (request.message or {}).get("id") or "-"
+
+
+async def remove_agent(bot_id: str):
+    """Stop the generation of an agent and dispose it"""
+    scheduler.discard(bot_id)
+    await stop_generation(bot_id)
+    agent = agents.remove(bot_id)
+    if agent is not None:
+        await agent.dispose()
+
+
+async def stop_generation(bot_id: str):
+    """Cancel the running generation of an agent and wait until its text is saved"""
+    task = scheduler.cancel(bot_id)
+    if task is not None:
+        await asyncio.wait({task})
+
+
+@app.post("/resync-history")
+async def resync_history(request: ResyncHistoryRequest):
+    """
+    This endpoint drops the cached history of a channel.
+    The next message in the channel reloads it from the search API.
+    """
+    channel_id = clean_channel_id(request.channel_id)
+    history.invalidate(f"{request.channel_type}:{channel_id}")
+    return {"message": "History will be resynced"}
+
+
+@app.get("/history-stats")
+async def history_stats():
+    """
+    This endpoint returns the hit and miss counts of the history cache.
+    """
+    return history.stats()
+
+
+@app.get("/response-cache-stats")
+async def response_cache_stats():
+    """
+    This endpoint returns the hit rate and savings of the response cache.
+    """
+    return responses.stats()
+
+
+@app.get("/debug/slow-generations")
+async def slow_generations(format: str = "json"):
+    """
+    This endpoint returns the timelines of the slowest generations, when profiling
+    is on (PROFILE_SLOWEST). With format=folded, their spans are returned in the
+    collapsed stack format of flame graph tools.
+    """
+    if format == "folded":
+        return Response(profiler.folded(), media_type="text/plain; charset=utf-8")
+    return profiler.report()
 
 
 @app.get("/get-ai-agents")
 async def get_ai_agents():
     """
-    This endpoint returns a list of all the AI agents.
+    This endpoint returns a list of all the AI agents, resident or evicted.
     """
-    return {"agents": list(agents.keys())}
+    return {
+        "agents": agents.keys(),
+        "resident": agents.resident_count,
+        "evicted": agents.evicted_count,
+    }
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    This endpoint returns the metrics in the Prometheus text format.
+    """
+    return Response(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 if __name__ == "__main__":
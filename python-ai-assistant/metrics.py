@@ -0,0 +1,365 @@
+"""Counters, gauges and histograms served in the Prometheus text format"""
+
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import deque
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Seconds, from a fast Stream call to a long LLM response
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """
+    A metric with labels. Children are created once per label values with
+    labels() and should be kept, so recording a value is a single call without
+    allocations. Everything runs on the event loop, so nothing is locked.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def labels(self, *values: str):
+        """The child of the metric for these label values"""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            child = self._children[values] = self._child()
+        return child
+
+    @abstractmethod
+    def _child(self):
+        """A new child, recording the values of one set of label values"""
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """The lines of the metric in the text format"""
+
+    def render(self) -> str:
+        """The metric in the text format"""
+        head = (
+            f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        )
+        return head + "".join(line + "\n" for line in self.samples())
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        """Add to the counter"""
+        self.value += amount
+
+
+class Counter(Metric):
+    """A value that only goes up"""
+
+    kind = "counter"
+
+    def _child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        """Add to the counter without labels"""
+        self.labels().inc(amount)
+
+    def samples(self) -> List[str]:
+        return [
+            f"{self.name}{_labels(self.labelnames, values)} {_number(child.value)}"
+            for values, child in self._children.items()
+        ]
+
+
+class Gauge(Metric):
+    """A value read from a function when the metrics are collected"""
+
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        function: Optional[Callable[[], float]] = None,
+    ):
+        super().__init__(name, documentation)
+        self.function = function
+        self.value = 0
+
+    def set(self, value: float):
+        """Set the value, used when there is no function"""
+        self.value = value
+
+    def _child(self):
+        # Gauges have no labels, the gauge is its own child
+        return self
+
+    def samples(self) -> List[str]:
+        value = self.function() if self.function is not None else self.value
+        return [f"{self.name} {_number(value)}"]
+
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        # Not cumulative, the last one counts the values above every bound
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """Record a value"""
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    """Counts of values in buckets, with their sum"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for values, child in self._children.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), child.counts):
+                total += count
+                le = 'le="' + _number(bound) + '"'
+                lines.append(
+                    f"{self.name}_bucket{_labels(self.labelnames, values, le)} {total}"
+                )
+            labels = _labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_number(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class RecentMean:
+    """The mean of the values recorded in the last `window` seconds"""
+
+    def __init__(self, window: float, max_values: int = 1000):
+        self.window = window
+        self._values: "deque[Tuple[float, float]]" = deque(maxlen=max_values)
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        """Record a value"""
+        if len(self._values) == self._values.maxlen:
+            self._sum -= self._values[0][1]
+        self._values.append((time.monotonic(), value))
+        self._sum += value
+
+    def value(self) -> float:
+        """The mean, 0 when nothing was recorded in the window"""
+        expired = time.monotonic() - self.window
+        while self._values and self._values[0][0] < expired:
+            self._sum -= self._values.popleft()[1]
+        return self._sum / len(self._values) if self._values else 0.0
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up a task sleeping `interval` seconds,
+    i.e. how long something blocked the loop, into a histogram
+    """
+
+    def __init__(self, histogram: "Histogram", interval: float = 0.1):
+        self.histogram = histogram
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start measuring, must be called inside the event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop measuring"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        observe = self.histogram.labels().observe
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            observe(max(0.0, loop.time() - expected))
+
+
+class Registry:
+    """The metrics served by the app"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric, replacing the one with the same name"""
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text format"""
+        return "".join(metric.render() for metric in self._metrics.values())
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "ai_stage_seconds",
+        "Time from the webhook to each stage of a response",
+        ("provider", "model", "stage"),
+    )
+)
+PARTIAL_UPDATE_SECONDS = REGISTRY.register(
+    Histogram(
+        "ai_partial_update_seconds",
+        "Duration of the partial message updates sent while streaming",
+        ("provider", "model"),
+    )
+)
+GENERATIONS = REGISTRY.register(
+    Counter(
+        "ai_generations_total",
+        "Responses by outcome: completed, cancelled or failed",
+        ("provider", "model", "outcome"),
+    )
+)
+STREAM_CHUNKS = REGISTRY.register(
+    Counter(
+        "ai_stream_chunks_total",
+        "Text chunks received from the LLM",
+        ("provider", "model"),
+    )
+)
+PROMPT_TOKENS = REGISTRY.register(
+    Counter(
+        "ai_prompt_tokens_total",
+        "Prompt tokens reported by the LLM: input, cache_read or cache_write",
+        ("provider", "model", "kind"),
+    )
+)
+LLM_FIRST_TOKEN_SECONDS = REGISTRY.register(
+    Histogram(
+        "ai_llm_first_token_seconds",
+        "Time from the LLM request to the first token, by use of the prompt cache",
+        ("provider", "model", "prompt_cache"),
+    )
+)
+# Recent time to the first token of every response, read by the admission control
+RECENT_FIRST_TOKEN = RecentMean(window=60.0)
+REGISTRY.register(
+    Gauge(
+        "ai_recent_first_token_seconds",
+        "Mean time from the webhook to the first token over the last minute",
+        RECENT_FIRST_TOKEN.value,
+    )
+)
+WEBHOOKS = REGISTRY.register(
+    Counter("ai_webhooks_total", "Webhooks received on /new-message", ("type",))
+)
+LOOP_LAG_SECONDS = REGISTRY.register(
+    Histogram(
+        "ai_event_loop_lag_seconds",
+        "Delay of the event loop in waking up a sleeping task",
+        buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+    )
+)
+
+
+class GenerationMetrics:
+    """The metrics of one provider and model, bound once and shared by its agents"""
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.history = STAGE_SECONDS.labels(provider, model, "history")
+        self.placeholder = STAGE_SECONDS.labels(provider, model, "placeholder")
+        self.llm_request = STAGE_SECONDS.labels(provider, model, "llm_request")
+        self.first_token = STAGE_SECONDS.labels(provider, model, "first_token")
+        self.recent_first_token = RECENT_FIRST_TOKEN
+        self.final_update = STAGE_SECONDS.labels(provider, model, "final_update")
+        self.partial_update = PARTIAL_UPDATE_SECONDS.labels(provider, model)
+        self.completed = GENERATIONS.labels(provider, model, "completed")
+        self.cancelled = GENERATIONS.labels(provider, model, "cancelled")
+        self.failed = GENERATIONS.labels(provider, model, "failed")
+        self.chunks = STREAM_CHUNKS.labels(provider, model)
+        self.input_tokens = PROMPT_TOKENS.labels(provider, model, "input")
+        self.cache_read_tokens = PROMPT_TOKENS.labels(provider, model, "cache_read")
+        self.cache_write_tokens = PROMPT_TOKENS.labels(provider, model, "cache_write")
+        self.llm_first_token_cached = LLM_FIRST_TOKEN_SECONDS.labels(
+            provider, model, "hit"
+        )
+        self.llm_first_token_uncached = LLM_FIRST_TOKEN_SECONDS.labels(
+            provider, model, "miss"
+        )
+
+
+_generation_metrics: Dict[Tuple[str, str], GenerationMetrics] = {}
+
+
+def generation_metrics(provider: str, model: str) -> GenerationMetrics:
+    """The shared metrics of a provider and model"""
+    key = (provider, model)
+    metrics = _generation_metrics.get(key)
+    if metrics is None:
+        metrics = _generation_metrics[key] = GenerationMetrics(provider, model)
+    return metrics
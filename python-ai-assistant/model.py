@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional, TypedDict
 
 
 class StartAgentRequest(BaseModel):
@@ -8,11 +8,38 @@ class StartAgentRequest(BaseModel):
     platform: str = "anthropic"
 
 
+class StartAgentsRequest(BaseModel):
+    channels: List[StartAgentRequest]
+
+
 class StopAgentRequest(BaseModel):
     channel_id: str
 
 
+class ResyncHistoryRequest(BaseModel):
+    channel_id: str
+    channel_type: str = "messaging"
+
+
+class WebhookUser(TypedDict):
+    id: str
+
+
+class WebhookMessage(TypedDict, total=False):
+    """The fields of a webhook message used by the agents"""
+
+    id: str
+    text: str
+    type: str
+    parent_id: str
+    user: WebhookUser
+
+
 class NewMessageRequest(BaseModel):
     cid: Optional[str]
     type: Optional[str]
     message: Optional[object]
+    # Set when the webhook is received, to measure the stages of the response
+    received_at: Optional[float] = None
+    # Control messages queued by the server itself, never read from a webhook
+    control: Optional[str] = None
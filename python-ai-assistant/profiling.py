@@ -0,0 +1,215 @@
+"""
+Opt-in profiling of the generations: a timeline per response and the slowest ones
+kept for the /debug/slow-generations endpoint
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Tuple
+from providers import Event
+
+# Seconds between two samples of the event loop lag while profiling
+LAG_INTERVAL = 0.01
+# Samples kept to attach to the generations, a minute of them
+LAG_SAMPLES = 6000
+# Lags shorter than this are only counted, not listed in the timeline
+LAG_MIN = 0.002
+
+
+class Timeline:
+    """
+    What one generation waited for. Spans are (name, start, duration) with the start
+    relative to when the message was handled, concurrent spans overlap. The gaps
+    between the chunks of the LLM stream are kept one by one.
+    """
+
+    __slots__ = (
+        "cid",
+        "bot_id",
+        "model",
+        "message_id",
+        "outcome",
+        "received_at",
+        "started",
+        "finished",
+        "spans",
+        "gaps",
+        "lags",
+        "lag_count",
+        "lag_max",
+    )
+
+    def __init__(self, cid: str, bot_id: str, model: str, received_at: float):
+        self.cid = cid
+        self.bot_id = bot_id
+        self.model = model
+        self.message_id: Optional[str] = None
+        self.outcome: Optional[str] = None
+        self.received_at = received_at
+        self.started = time.time()
+        self.finished = self.started
+        self.spans: List[Tuple[str, float, float]] = []
+        # Seconds waited for each chunk of the LLM stream
+        self.gaps: List[float] = []
+        # Event loop lags over LAG_MIN while the generation ran, (start, lag)
+        self.lags: List[Tuple[float, float]] = []
+        self.lag_count = 0
+        self.lag_max = 0.0
+
+    @property
+    def duration(self) -> float:
+        """Seconds from the webhook to the end of the generation"""
+        return self.finished - self.received_at
+
+    def span(self, name: str, began: float, ended: Optional[float] = None):
+        """Record a span of wall clock time, nested names are joined with ';'"""
+        if ended is None:
+            ended = time.time()
+        self.spans.append((name, began - self.started, ended - began))
+
+    async def stream(self, events: AsyncIterator[Event]) -> AsyncIterator[Event]:
+        """Pass the events of the LLM stream through, timing the wait for each one"""
+        waited = time.time()
+        async for event in events:
+            self.gaps.append(time.time() - waited)
+            yield event
+            waited = time.time()
+
+    def folded(self) -> List[str]:
+        """
+        The time of each span name in the collapsed stack format of flame graph
+        tools, in microseconds. Concurrent spans add up.
+        """
+        totals: Dict[str, float] = defaultdict(float)
+        totals["queued"] = self.started - self.received_at
+        for name, _, duration in self.spans:
+            totals[name] += duration
+        if self.gaps:
+            totals["stream;llm_wait"] = sum(self.gaps)
+        return [
+            f"generation;{name} {round(seconds * 1e6)}"
+            for name, seconds in totals.items()
+            if seconds > 0
+        ]
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The timeline as JSON data, in milliseconds"""
+        gaps = sorted(self.gaps)
+        return {
+            "cid": self.cid,
+            "bot_id": self.bot_id,
+            "model": self.model,
+            "message_id": self.message_id,
+            "outcome": self.outcome,
+            "received_at": self.received_at,
+            "duration_ms": _ms(self.duration),
+            "queued_ms": _ms(self.started - self.received_at),
+            "spans": [
+                {"name": name, "start_ms": _ms(start), "duration_ms": _ms(duration)}
+                for name, start, duration in self.spans
+            ],
+            "chunks": {
+                "count": len(gaps),
+                "gap_p50_ms": _ms(gaps[len(gaps) // 2]) if gaps else None,
+                "gap_max_ms": _ms(gaps[-1]) if gaps else None,
+                "gaps_ms": [_ms(gap) for gap in self.gaps],
+            },
+            "loop_lag": {
+                "samples": self.lag_count,
+                "max_ms": _ms(self.lag_max),
+                "over_min_ms": [[_ms(start), _ms(lag)] for start, lag in self.lags],
+            },
+            "folded": self.folded(),
+        }
+
+
+class Profiler:
+    """
+    Keeps the timelines of the `slowest` longest generations, from the webhook to
+    the end of the response. With `slowest` at 0 it is disabled: no timeline is
+    created and the streaming loop runs unchanged.
+    """
+
+    def __init__(self, slowest: int):
+        self.slowest = slowest
+        self.profiled = 0
+        self._slowest: List[Tuple[float, int, Timeline]] = []
+        self._order = itertools.count()
+        # Event loop lag samples, (time the sleep started, lag)
+        self._lags: Deque[Tuple[float, float]] = deque(maxlen=LAG_SAMPLES)
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.slowest > 0
+
+    def start(self):
+        """Start sampling the event loop lag, must be called inside the event loop"""
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._sample())
+
+    async def close(self):
+        """Stop sampling"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def begin(
+        self, cid: str, bot_id: str, model: str, received_at: Optional[float]
+    ) -> Optional[Timeline]:
+        """The timeline of a new generation, None while disabled"""
+        if not self.enabled:
+            return None
+        return Timeline(cid, bot_id, model, received_at or time.time())
+
+    def end(self, timeline: Timeline):
+        """Keep the timeline if it is one of the slowest"""
+        timeline.finished = time.time()
+        for began, lag in reversed(self._lags):
+            if began < timeline.started:
+                break
+            timeline.lag_count += 1
+            timeline.lag_max = max(timeline.lag_max, lag)
+            if lag >= LAG_MIN:
+                timeline.lags.append((began - timeline.started, lag))
+        timeline.lags.reverse()
+
+        self.profiled += 1
+        entry = (timeline.duration, next(self._order), timeline)
+        if len(self._slowest) < self.slowest:
+            heapq.heappush(self._slowest, entry)
+        elif entry[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def report(self) -> Dict[str, Any]:
+        """The kept timelines, slowest first"""
+        return {
+            "enabled": self.enabled,
+            "profiled": self.profiled,
+            "generations": [timeline.to_dict() for timeline in self._sorted()],
+        }
+
+    def folded(self) -> str:
+        """The kept timelines in the collapsed stack format, one frame per message"""
+        return "".join(
+            f"{timeline.message_id or timeline.cid};{line}\n"
+            for timeline in self._sorted()
+            for line in timeline.folded()
+        )
+
+    def _sorted(self) -> List[Timeline]:
+        return [timeline for _, _, timeline in sorted(self._slowest, reverse=True)]
+
+    async def _sample(self):
+        while True:
+            began = time.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            self._lags.append((began, max(0.0, time.time() - began - LAG_INTERVAL)))
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 2)
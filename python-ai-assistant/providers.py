@@ -0,0 +1,294 @@
+"""LLM providers behind one interface, their streams normalized to text events"""
+
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from ai_agent import AgentPlatform
+from config import Settings
+from metrics import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+# Kinds of the events of an LLMStream
+TEXT = "text"
+USAGE = "usage"
+DONE = "done"
+
+Event = Tuple[str, Any]
+
+HEDGED = REGISTRY.register(
+    Counter(
+        "ai_llm_hedged_requests_total",
+        "Requests also sent to the hedge provider, by the provider that answered",
+        ("winner",),
+    )
+)
+
+
+class LLMStream:
+    """
+    The streamed answer of a provider as (kind, value) events: TEXT with a chunk of
+    text, USAGE with the (input, cache_read, cache_write) prompt tokens, and DONE
+    once the answer is complete. USAGE may come before the text or after DONE.
+    """
+
+    def __init__(self, response: Any, events: AsyncIterator[Event], provider: Any):
+        self.response = response
+        self.provider = provider
+        self._events = events
+
+    def __aiter__(self) -> AsyncIterator[Event]:
+        return self._events
+
+    async def close(self):
+        """Stop the response, no more tokens are paid for"""
+        await self.response.close()
+
+
+class Provider(ABC):
+    """One model of an LLM provider"""
+
+    name = ""
+    default_model = ""
+
+    def __init__(self, client: Any, model: Optional[str] = None):
+        self.client = client
+        self.model = model or self.default_model
+
+    async def open(self, messages: List[dict], params: Dict[str, Any]) -> LLMStream:
+        """Send the conversation, oldest first, and stream the answer"""
+        response = await self._create(messages, params)
+        return LLMStream(response, self._events(response), self)
+
+    @abstractmethod
+    async def _create(self, messages: List[dict], params: Dict[str, Any]) -> Any:
+        """Send the request, returns the streamed response of the client"""
+
+    @abstractmethod
+    def _events(self, response: Any) -> AsyncIterator[Event]:
+        """The events of the streamed response"""
+
+
+class OpenAIProvider(Provider):
+    """OpenAI Chat Completions, or any API compatible with it"""
+
+    name = AgentPlatform.OPENAI.value
+    default_model = "gpt-4o-mini"
+
+    async def _create(self, messages: List[dict], params: Dict[str, Any]) -> Any:
+        # Long prompt prefixes are cached by OpenAI, the usage says how much
+        return await self.client.chat.completions.create(
+            messages=messages,
+            model=self.model,
+            stream=True,
+            stream_options={"include_usage": True},
+            **params,
+        )
+
+    async def _events(self, response: Any) -> AsyncIterator[Event]:
+        async for chunk in response:
+            if chunk.choices:
+                choice = chunk.choices[0]
+                if choice.delta is not None and choice.delta.content:
+                    yield TEXT, choice.delta.content
+                if choice.finish_reason is not None:
+                    yield DONE, None
+
+            # Last chunk, cached tokens are part of the prompt tokens
+            usage = getattr(chunk, "usage", None)
+            if usage is not None:
+                details = getattr(usage, "prompt_tokens_details", None)
+                cached = getattr(details, "cached_tokens", None) or 0
+                yield USAGE, (usage.prompt_tokens - cached, cached, 0)
+
+
+class AnthropicProvider(Provider):
+    """Anthropic Messages, with the earlier turns as a cached prompt prefix"""
+
+    name = AgentPlatform.ANTHROPIC.value
+    default_model = "claude-3-5-sonnet-20241022"
+
+    def __init__(
+        self, client: Any, model: Optional[str] = None, prompt_caching: bool = True
+    ):
+        super().__init__(client, model)
+        self.prompt_caching = prompt_caching
+
+    async def _create(self, messages: List[dict], params: Dict[str, Any]) -> Any:
+        if not self.prompt_caching:
+            return await self.client.messages.create(
+                messages=messages, model=self.model, stream=True, **params
+            )
+        return await self.client.beta.prompt_caching.messages.create(
+            messages=with_cache_breakpoint(messages),
+            model=self.model,
+            stream=True,
+            **params,
+        )
+
+    async def _events(self, response: Any) -> AsyncIterator[Event]:
+        async for event in response:
+            if event.type == "message_start":
+                usage = event.message.usage
+                yield USAGE, (
+                    usage.input_tokens,
+                    getattr(usage, "cache_read_input_tokens", None) or 0,
+                    getattr(usage, "cache_creation_input_tokens", None) or 0,
+                )
+            elif event.type == "content_block_delta":
+                if event.delta.type == "text_delta":
+                    yield TEXT, event.delta.text
+            elif event.type == "message_delta":
+                yield DONE, None
+
+
+class HedgedProvider:
+    """
+    Sends a request to the primary provider, and to the hedge provider as well when
+    no text arrived after `delay` seconds or the primary failed before answering.
+    The first one to stream text is used and the other one is closed.
+    """
+
+    def __init__(self, primary: Provider, hedge: Provider, delay: float):
+        self.primary = primary
+        self.hedge = hedge
+        self.delay = delay
+        self.name = primary.name
+        self.model = primary.model
+        self._winners = {
+            primary: HEDGED.labels("primary"),
+            hedge: HEDGED.labels("hedge"),
+        }
+
+    async def open(self, messages: List[dict], params: Dict[str, Any]) -> LLMStream:
+        """Stream the answer of the fastest provider"""
+        first = asyncio.create_task(_first_text(self.primary, messages, params))
+        tasks = {first: self.primary}
+        winner: Optional[asyncio.Task] = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.delay)
+            if done and first.exception() is None:
+                winner = first
+                return first.result()
+
+            second = asyncio.create_task(_first_text(self.hedge, messages, params))
+            tasks[second] = self.hedge
+            pending = set(tasks)
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # In the order of the tasks, the primary wins when both answered
+                for task in [task for task in tasks if task in done]:
+                    if task.exception() is None:
+                        winner = task
+                        self._winners[tasks[task]].inc()
+                        return task.result()
+                    # The error of the primary is raised if both failed
+                    if error is None or tasks[task] is self.primary:
+                        error = task.exception()
+            raise error
+        finally:
+            await _discard_losers(tasks, winner)
+
+
+async def _first_text(
+    provider: Provider, messages: List[dict], params: Dict[str, Any]
+) -> LLMStream:
+    # Opens the stream and reads it up to the first text, which is replayed
+    stream = await provider.open(messages, params)
+    try:
+        events = stream.__aiter__()
+        buffered: List[Event] = []
+        try:
+            while not buffered or buffered[-1][0] == USAGE:
+                buffered.append(await events.__anext__())
+        except StopAsyncIteration:
+            pass
+        return LLMStream(stream.response, _replay(buffered, events), provider)
+    except BaseException:
+        await stream.close()
+        raise
+
+
+async def _replay(
+    buffered: List[Event], events: AsyncIterator[Event]
+) -> AsyncIterator[Event]:
+    for event in buffered:
+        yield event
+    async for event in events:
+        yield event
+
+
+async def _discard_losers(
+    tasks: Dict[asyncio.Task, Provider], winner: Optional[asyncio.Task]
+):
+    # Every stream but the winner's is closed, cancelled requests close theirs
+    for task in tasks:
+        if task is not winner and not task.done():
+            task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for task in tasks:
+        if task is winner or task.cancelled() or task.exception() is not None:
+            continue
+        try:
+            await task.result().close()
+        except Exception as error:
+            logger.warning("Failed to close LLM stream: %s", error)
+
+
+def with_cache_breakpoint(messages: List[dict]) -> List[dict]:
+    """
+    Mark the turns before the new message as a prompt prefix to cache, so the next
+    turn of the conversation only pays full price for what was added since.
+    Prefixes shorter than the minimum of the model are not cached.
+    """
+    if len(messages) < 2:
+        return messages
+    prefix = messages[-2]
+    marked = {
+        "role": prefix["role"],
+        "content": [
+            {
+                "type": "text",
+                "text": prefix["content"],
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
+    }
+    return messages[:-2] + [marked, messages[-1]]
+
+
+def create_provider(platform: str, clients: Any, settings: Settings) -> Any:
+    """
+    The provider of a platform, hedged when HEDGE_AFTER_MS is set. Raises a
+    ValueError for an unknown platform.
+    """
+    provider = _platform_provider(AgentPlatform(platform), clients, settings, None)
+    if settings.hedge_after_ms <= 0:
+        return provider
+    if settings.hedge_base_url:
+        hedge = OpenAIProvider(
+            clients.openai_compatible(settings.hedge_base_url, settings.hedge_api_key),
+            settings.hedge_model or None,
+        )
+    elif settings.hedge_platform:
+        hedge = _platform_provider(
+            AgentPlatform(settings.hedge_platform),
+            clients,
+            settings,
+            settings.hedge_model or None,
+        )
+    else:
+        return provider
+    return HedgedProvider(provider, hedge, settings.hedge_after_ms / 1000)
+
+
+def _platform_provider(
+    platform: AgentPlatform, clients: Any, settings: Settings, model: Optional[str]
+) -> Provider:
+    if platform == AgentPlatform.ANTHROPIC:
+        return AnthropicProvider(clients.anthropic(), model, settings.prompt_caching)
+    return OpenAIProvider(clients.openai(), model)
@@ -0,0 +1,153 @@
+"""Bot users and channel memberships created in Stream for the agents"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Collection, Dict, List, Optional, Tuple
+from metrics import REGISTRY, Counter
+
+logger = logging.getLogger(__name__)
+
+# Users per upsert_users call allowed by Stream
+UPSERT_BATCH_SIZE = 100
+
+PROVISIONING = REGISTRY.register(
+    Counter(
+        "ai_provisioning_total",
+        "Bot users and memberships provisioned, by kind and by result: "
+        "cached (write skipped), written or failed",
+        ("kind", "result"),
+    )
+)
+
+
+def bot_user(bot_id: str) -> Dict[str, str]:
+    """The Stream user of an AI bot"""
+    return {"id": bot_id, "name": "AI Bot", "role": "admin"}
+
+
+class ProvisioningCache:
+    """
+    Bot users and memberships known to exist in Stream, for `ttl` seconds. Starting
+    an agent again skips the writes while they are cached.
+    """
+
+    def __init__(self, ttl: float, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires: "OrderedDict[str, float]" = OrderedDict()
+
+    def has_user(self, bot_id: str) -> bool:
+        """Whether the bot user was upserted recently"""
+        return self._get(f"user:{bot_id}")
+
+    def add_user(self, bot_id: str):
+        """Remember that the bot user exists"""
+        self._put(f"user:{bot_id}")
+
+    def is_member(self, channel_type: str, channel_id: str) -> bool:
+        """Whether the bot of the channel was added to it recently"""
+        return self._get(f"member:{channel_type}:{channel_id}")
+
+    def add_member(self, channel_type: str, channel_id: str):
+        """Remember that the bot of the channel is a member"""
+        self._put(f"member:{channel_type}:{channel_id}")
+
+    def remove_member(self, channel_type: str, channel_id: str):
+        """Forget the membership, e.g. when the bot leaves the channel"""
+        self._expires.pop(f"member:{channel_type}:{channel_id}", None)
+
+    def _get(self, key: str) -> bool:
+        expires = self._expires.get(key)
+        if expires is None:
+            return False
+        if expires <= time.monotonic():
+            del self._expires[key]
+            return False
+        return True
+
+    def _put(self, key: str):
+        if self.ttl <= 0:
+            return
+        self._expires[key] = time.monotonic() + self.ttl
+        self._expires.move_to_end(key)
+        while len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+
+
+class Provisioner:
+    """Creates the bot users and adds them to their channels, skipping cached ones"""
+
+    def __init__(self, cache: ProvisioningCache, max_concurrent_adds: int = 10):
+        self.cache = cache
+        self.max_concurrent_adds = max_concurrent_adds
+        self._counters = {
+            (kind, result): PROVISIONING.labels(kind, result)
+            for kind in ("user", "member")
+            for result in ("cached", "written", "failed")
+        }
+
+    async def provision(
+        self,
+        client: Any,
+        channels: List[Tuple[str, str, str]],
+        bound: Collection[str] = (),
+    ) -> Dict[str, Optional[str]]:
+        """
+        Provision the bots of (channel_type, channel_id, bot_id) channels. A cached
+        membership is only trusted for the bot ids in `bound`, the agents that were
+        not stopped since, possibly by another worker. Returns the error of each bot
+        id, None if it succeeded.
+        """
+        errors: Dict[str, Optional[str]] = {bot_id: None for _, _, bot_id in channels}
+        await self._upsert_users(client, [bot_id for _, _, bot_id in channels], errors)
+
+        semaphore = asyncio.Semaphore(self.max_concurrent_adds)
+
+        async def add(channel_type: str, channel_id: str, bot_id: str):
+            if errors[bot_id] is not None:
+                return
+            if bot_id in bound and self.cache.is_member(channel_type, channel_id):
+                self._counters["member", "cached"].inc()
+                return
+            async with semaphore:
+                try:
+                    await client.channel(channel_type, channel_id).add_members([bot_id])
+                except Exception as error:
+                    logger.error("Failed to add members to the channel: %s", error)
+                    self._counters["member", "failed"].inc()
+                    errors[bot_id] = str(error)
+                    return
+            self._counters["member", "written"].inc()
+            self.cache.add_member(channel_type, channel_id)
+
+        await asyncio.gather(*(add(*channel) for channel in channels))
+        return errors
+
+    async def _upsert_users(
+        self, client: Any, bot_ids: List[str], errors: Dict[str, Optional[str]]
+    ):
+        missing = []
+        for bot_id in dict.fromkeys(bot_ids):
+            if self.cache.has_user(bot_id):
+                self._counters["user", "cached"].inc()
+            else:
+                missing.append(bot_id)
+
+        for start in range(0, len(missing), UPSERT_BATCH_SIZE):
+            batch = missing[start : start + UPSERT_BATCH_SIZE]
+            try:
+                if len(batch) == 1:
+                    await client.upsert_user(bot_user(batch[0]))
+                else:
+                    await client.upsert_users([bot_user(bot_id) for bot_id in batch])
+            except Exception as error:
+                logger.error("Failed to upsert bot users: %s", error)
+                self._counters["user", "failed"].inc(len(batch))
+                for bot_id in batch:
+                    errors[bot_id] = str(error)
+                continue
+            self._counters["user", "written"].inc(len(batch))
+            for bot_id in batch:
+                self.cache.add_user(bot_id)
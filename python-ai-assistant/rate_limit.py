@@ -0,0 +1,197 @@
+"""Process-wide rate limiting of the calls made to the Stream API"""
+
+import asyncio
+import time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Mapping, Optional
+from metrics import REGISTRY, Counter
+
+# Requests per second allowed for each class of endpoint, the burst is one second
+DEFAULT_RATES = {
+    "update_message": 100.0,
+    "send_event": 100.0,
+    "send_message": 50.0,
+    "search": 20.0,
+    "default": 50.0,
+}
+
+THROTTLED = REGISTRY.register(
+    Counter(
+        "ai_stream_throttled_total",
+        "Stream calls that waited for the rate budget",
+        ("endpoint",),
+    )
+)
+RATE_LIMITED = REGISTRY.register(
+    Counter(
+        "ai_stream_rate_limited_total",
+        "Stream calls rejected with a 429 status",
+        ("endpoint",),
+    )
+)
+DEFERRED = REGISTRY.register(
+    Counter(
+        "ai_stream_deferred_updates_total",
+        "Partial updates postponed to the next flush because the budget was tight",
+    )
+)
+
+
+def endpoint_class(method: str, relative_url: str) -> str:
+    """The class of endpoint of a Stream API call, each class has its own budget"""
+    parts = relative_url.strip("/").split("/")
+    if parts[0] == "messages" and len(parts) == 2 and method in ("put", "post"):
+        return "update_message"
+    if parts[0] == "channels" and parts[-1] == "event":
+        return "send_event"
+    if parts[0] == "channels" and parts[-1] == "message":
+        return "send_message"
+    if parts[0] == "search":
+        return "search"
+    return "default"
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds to wait from the Retry-After or X-RateLimit-Reset header"""
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get("X-RateLimit-Reset") or headers.get("x-ratelimit-reset")
+    if reset:
+        try:
+            return max(0.0, float(reset.split(",")[0]) - time.time())
+        except ValueError:
+            pass
+    return None
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second with bursts of up to `burst` calls.
+
+    The rate adapts: it is halved when Stream answers with a 429, down to
+    `min_rate`, and grows back by a twentieth of `max_rate` per second without one.
+    """
+
+    def __init__(self, max_rate: float, burst: Optional[float] = None):
+        self.max_rate = max_rate
+        self.min_rate = max(max_rate / 20, 0.1)
+        self.rate = max_rate
+        self.burst = burst if burst is not None else max(max_rate, 1.0)
+        self.tokens = self.burst
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated
+        self._updated = now
+        if elapsed <= 0:
+            return
+        if self.rate < self.max_rate and now >= self.blocked_until:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20 * elapsed)
+        self.tokens = min(self.burst, self.tokens + self.rate * elapsed)
+
+    def available(self, reserve: float = 0.0) -> bool:
+        """Whether a call can go out right away, leaving `reserve` of the burst"""
+        now = time.monotonic()
+        self._refill(now)
+        return now >= self.blocked_until and self.tokens >= 1 + reserve * self.burst
+
+    async def acquire(self) -> bool:
+        """Wait for a token, returns whether the call had to wait"""
+        waited = False
+        # Waiting calls are served in order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    delay = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                else:
+                    delay = (1 - self.tokens) / self.rate
+                waited = True
+                await asyncio.sleep(delay)
+
+    def back_off(self, delay: float):
+        """Slow down after a 429 and send nothing for `delay` seconds"""
+        now = time.monotonic()
+        self._refill(now)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+        self.blocked_until = max(self.blocked_until, now + delay)
+
+
+class StreamRateGovernor:
+    """
+    A token bucket per class of Stream endpoint, shared by every agent of the
+    process. Calls wait for their budget instead of failing; partial updates ask
+    first with can_update() and are postponed while the budget is tight, so final
+    updates and events keep a share of it.
+    """
+
+    def __init__(
+        self,
+        rates: Optional[Mapping[str, float]] = None,
+        max_retries: int = 3,
+        update_reserve: float = 0.2,
+    ):
+        self.rates = {**DEFAULT_RATES, **(rates or {})}
+        self.max_retries = max_retries
+        self.update_reserve = update_reserve
+        self.buckets: Dict[str, TokenBucket] = {
+            name: TokenBucket(rate) for name, rate in self.rates.items()
+        }
+        self._throttled = {name: THROTTLED.labels(name) for name in self.buckets}
+        self._rate_limited = {name: RATE_LIMITED.labels(name) for name in self.buckets}
+        self._deferred = DEFERRED.labels()
+        self._failures: Dict[str, int] = {name: 0 for name in self.buckets}
+
+    def bucket(self, endpoint: str) -> TokenBucket:
+        """The bucket of a class of endpoint"""
+        return self.buckets.get(endpoint) or self.buckets["default"]
+
+    def can_update(self) -> bool:
+        """Whether a partial update can be sent now, counts it as deferred if not"""
+        if self.buckets["update_message"].available(self.update_reserve):
+            return True
+        self._deferred.inc()
+        return False
+
+    async def acquire(self, endpoint: str):
+        """Wait until a call to the endpoint fits in the budget"""
+        endpoint = endpoint if endpoint in self.buckets else "default"
+        if await self.buckets[endpoint].acquire():
+            self._throttled[endpoint].inc()
+
+    def rate_limited(self, endpoint: str, delay: Optional[float]) -> float:
+        """Back off after a 429, returns the seconds to wait before retrying"""
+        endpoint = endpoint if endpoint in self.buckets else "default"
+        self._rate_limited[endpoint].inc()
+        self._failures[endpoint] += 1
+        if delay is None:
+            # Exponential backoff when Stream didn't say how long to wait
+            delay = min(30.0, 0.5 * 2 ** (self._failures[endpoint] - 1))
+        self.buckets[endpoint].back_off(delay)
+        return delay
+
+    def succeeded(self, endpoint: str):
+        """Reset the backoff of the endpoint"""
+        if endpoint in self._failures:
+            self._failures[endpoint] = 0
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Current rate and tokens of every bucket"""
+        return {
+            name: {"rate": round(bucket.rate, 2), "tokens": round(bucket.tokens, 2)}
+            for name, bucket in self.buckets.items()
+        }
@@ -0,0 +1,191 @@
+"""Registry of the agents running in this process"""
+
+import asyncio
+import logging
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+from ai_agent import AIAgent
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AgentBinding:
+    """What is needed to (re)build the agent of a channel, kept for every channel"""
+
+    __slots__ = ("bot_id", "channel_type", "channel_id", "platform")
+
+    bot_id: str
+    channel_type: str
+    channel_id: str
+    platform: str
+
+    def __post_init__(self):
+        # Shared by most channels, one copy of each string per process
+        self.channel_type = sys.intern(self.channel_type)
+        self.platform = sys.intern(self.platform)
+
+    @property
+    def cid(self) -> str:
+        """The full channel id, type:id"""
+        return f"{self.channel_type}:{self.channel_id}"
+
+
+class AgentRegistry:
+    """
+    Keeps the agents of the channels the AI was started in. Agents that were idle for
+    longer than `idle_ttl` seconds, or the least recently used ones above `max_size`,
+    are evicted and disposed by a background reaper. Their binding is kept, so the
+    agent is rebuilt with `factory` the next time a message arrives for the channel.
+    """
+
+    def __init__(
+        self,
+        factory: Callable[[AgentBinding], AIAgent],
+        idle_ttl: float,
+        max_size: int,
+        reap_interval: float,
+        is_busy: Callable[[str], bool] = lambda bot_id: False,
+    ):
+        self.factory = factory
+        self.idle_ttl = idle_ttl
+        self.max_size = max_size
+        self.reap_interval = reap_interval
+        self.is_busy = is_busy
+
+        self._bindings: Dict[str, AgentBinding] = {}
+        # Resident agents, least recently used first
+        self._agents: "OrderedDict[str, AIAgent]" = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._disposals: List[AIAgent] = []
+        self._reaper: Optional[asyncio.Task] = None
+        self.evictions = 0
+        self.rehydrations = 0
+
+    def __contains__(self, bot_id: str) -> bool:
+        return bot_id in self._bindings
+
+    def __len__(self) -> int:
+        return len(self._bindings)
+
+    def keys(self) -> List[str]:
+        """The bot ids of all agents, resident or evicted"""
+        return list(self._bindings.keys())
+
+    @property
+    def resident_count(self) -> int:
+        """Number of agents currently in memory"""
+        return len(self._agents)
+
+    @property
+    def evicted_count(self) -> int:
+        """Number of agents that were evicted and will be rebuilt on demand"""
+        return len(self._bindings) - len(self._agents)
+
+    def register(self, binding: AgentBinding, agent: AIAgent) -> Optional[AIAgent]:
+        """Add the agent of a channel, returns the agent it replaces if it was resident"""
+        previous = self._agents.pop(binding.bot_id, None)
+        self._bindings[binding.bot_id] = binding
+        self._agents[binding.bot_id] = agent
+        self._last_used[binding.bot_id] = time.monotonic()
+        self._evict_overflow()
+        return previous
+
+    def bind(self, binding: AgentBinding):
+        """
+        Add or update the binding of a channel without building its agent, e.g. for
+        a channel that was started on another worker
+        """
+        if self._bindings.get(binding.bot_id) == binding:
+            return
+        if binding.bot_id in self._agents and self.is_busy(binding.bot_id):
+            # Keep the agent that is answering, it is replaced on a later message
+            return
+        self._bindings[binding.bot_id] = binding
+        agent = self._agents.pop(binding.bot_id, None)
+        if agent is not None:
+            self._disposals.append(agent)
+
+    def get(self, bot_id: str) -> Optional[AIAgent]:
+        """The agent of a channel, rebuilt if it was evicted"""
+        agent = self._agents.get(bot_id)
+        if agent is not None:
+            self._agents.move_to_end(bot_id)
+        else:
+            binding = self._bindings.get(bot_id)
+            if binding is None:
+                return None
+            agent = self.factory(binding)
+            self._agents[bot_id] = agent
+            self.rehydrations += 1
+            self._evict_overflow()
+        self._last_used[bot_id] = time.monotonic()
+        return agent
+
+    def remove(self, bot_id: str) -> Optional[AIAgent]:
+        """Forget the agent of a channel, returns it if it was resident"""
+        self._bindings.pop(bot_id, None)
+        self._last_used.pop(bot_id, None)
+        return self._agents.pop(bot_id, None)
+
+    def start(self):
+        """Start the background reaper"""
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the reaper and dispose every resident agent"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            await asyncio.gather(self._reaper, return_exceptions=True)
+            self._reaper = None
+        self._disposals.extend(self._agents.values())
+        self._agents.clear()
+        await self._dispose_evicted()
+
+    async def reap(self):
+        """Evict idle agents and dispose the evicted ones"""
+        deadline = time.monotonic() - self.idle_ttl
+        for bot_id in list(self._agents.keys()):
+            if self._last_used.get(bot_id, 0) < deadline and not self.is_busy(bot_id):
+                self._evict(bot_id)
+        self._evict_overflow()
+        await self._dispose_evicted()
+
+    def stats(self) -> Dict[str, int]:
+        """Counters of the registry"""
+        return {
+            "resident": self.resident_count,
+            "evicted": self.evicted_count,
+            "evictions": self.evictions,
+            "rehydrations": self.rehydrations,
+        }
+
+    def _evict(self, bot_id: str):
+        self._disposals.append(self._agents.pop(bot_id))
+        self.evictions += 1
+
+    def _evict_overflow(self):
+        if len(self._agents) <= self.max_size:
+            return
+        for bot_id in list(self._agents.keys()):
+            if len(self._agents) <= self.max_size:
+                break
+            if not self.is_busy(bot_id):
+                self._evict(bot_id)
+
+    async def _dispose_evicted(self):
+        disposals, self._disposals = self._disposals, []
+        for agent in disposals:
+            try:
+                await agent.dispose()
+            except Exception as error:
+                logger.warning("Failed to dispose agent: %s", error)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            await self.reap()
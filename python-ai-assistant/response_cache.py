@@ -0,0 +1,169 @@
+"""Answers to repeated prompts, replayed instead of calling the LLM again"""
+
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from context import count_tokens
+from metrics import REGISTRY, Counter
+
+_SPACES_RE = re.compile(r"\s+")
+
+LOOKUPS = REGISTRY.register(
+    Counter(
+        "ai_response_cache_lookups_total",
+        "Lookups in the response cache by result: hit or miss",
+        ("result",),
+    )
+)
+SAVED_TOKENS = REGISTRY.register(
+    Counter(
+        "ai_response_cache_saved_tokens_total",
+        "Estimated prompt and completion tokens not sent to the LLM",
+    )
+)
+SAVED_SECONDS = REGISTRY.register(
+    Counter(
+        "ai_response_cache_saved_seconds_total",
+        "LLM time of the cached answers, saved on every hit",
+    )
+)
+
+
+class CachedResponse:
+    """A cached answer, returned by the agents in place of an LLM stream"""
+
+    __slots__ = ("text", "tokens", "seconds", "expires")
+
+    def __init__(self, text: str, tokens: int, seconds: float, expires: float):
+        self.text = text
+        self.tokens = tokens
+        self.seconds = seconds
+        self.expires = expires
+
+    async def close(self):
+        """Nothing to close, the agents close their streams when done"""
+
+
+class ResponseCache:
+    """
+    Least recently used answers keyed on a hash of the model, the parameters and
+    the conversation sent to the LLM, with whitespace normalized. Answers expire
+    after `ttl` seconds. A `max_size` of 0 turns the cache off.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_seconds = 0.0
+        self._hit = LOOKUPS.labels("hit")
+        self._miss = LOOKUPS.labels("miss")
+        self._saved_tokens = SAVED_TOKENS.labels()
+        self._saved_seconds = SAVED_SECONDS.labels()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether answers are cached at all"""
+        return self.max_size > 0
+
+    @staticmethod
+    def key(model: str, params: Dict[str, Any], messages: List[Dict[str, str]]) -> str:
+        """The cache key of an LLM request"""
+        normalized = [
+            [message["role"], _SPACES_RE.sub(" ", message["content"]).strip()]
+            for message in messages
+        ]
+        payload = json.dumps(
+            [model, params, normalized], sort_keys=True, separators=(",", ":")
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """The cached answer of a request, counted as a hit or a miss"""
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires <= time.monotonic():
+            del self._entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            self._miss.inc()
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        self.saved_tokens += entry.tokens
+        self.saved_seconds += entry.seconds
+        self._hit.inc()
+        self._saved_tokens.inc(entry.tokens)
+        self._saved_seconds.inc(entry.seconds)
+        return entry
+
+    def put(self, key: str, text: str, prompt_tokens: int, seconds: float):
+        """Cache the answer of a request that took `seconds` to generate"""
+        if not self.enabled or not text:
+            return
+        tokens = prompt_tokens + count_tokens(text)
+        self._entries[key] = CachedResponse(
+            text, tokens, seconds, time.monotonic() + self.ttl
+        )
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate and savings of the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "savedTokens": self.saved_tokens,
+            "savedSeconds": round(self.saved_seconds, 3),
+        }
+
+
+class CachedRequest:
+    """One LLM request of an agent, answered from the cache when possible"""
+
+    def __init__(self, cache: ResponseCache, model: str, params: Dict[str, Any]):
+        self.cache = cache
+        self.model = model
+        self.params = params
+        self.key: Optional[str] = None
+        self.prompt_tokens = 0
+        self.requested = 0.0
+
+    async def open(
+        self,
+        messages: List[Dict[str, str]],
+        create: Callable[[List[Dict[str, str]], Dict[str, Any]], Awaitable[Any]],
+    ) -> Any:
+        """The cached answer, or the LLM stream opened with `create`"""
+        if self.cache.enabled:
+            self.key = self.cache.key(self.model, self.params, messages)
+            cached = self.cache.get(self.key)
+            if cached is not None:
+                return cached
+            self.prompt_tokens = sum(
+                count_tokens(message["content"]) for message in messages
+            )
+        self.requested = time.monotonic()
+        return await create(messages, self.params)
+
+    def store(self, generation: Any, text: str):
+        """Cache the answer once the generation completed"""
+        if self.key is None or generation.outcome != "completed":
+            return
+        self.cache.put(
+            self.key,
+            text,
+            generation.prompt_tokens or self.prompt_tokens,
+            time.monotonic() - self.requested,
+        )
@@ -0,0 +1,183 @@
+"""Per-channel work queues for incoming messages"""
+
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+from model import NewMessageRequest
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[NewMessageRequest], Awaitable[None]]
+
+
+class ChannelScheduler:
+    """
+    Queues messages per channel and handles them in FIFO order, one at a time per
+    channel, while a global semaphore limits how many LLM streams run at once.
+    """
+
+    def __init__(self, max_concurrent: int, merge_queued: bool = False):
+        self.merge_queued = merge_queued
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._queues: Dict[str, Deque[Tuple[Handler, NewMessageRequest]]] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self._current: Dict[str, asyncio.Task] = {}
+        self.in_flight = 0
+        # Channels whose next message waits for a free generation slot
+        self.waiting = 0
+        self.cancelled = 0
+        self.closing = False
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of messages waiting in all channels, for their turn or a slot"""
+        return self.waiting + sum(len(queue) for queue in self._queues.values())
+
+    def is_busy(self, key: str) -> bool:
+        """Check if a channel has queued or running work"""
+        return key in self._workers
+
+    def submit(self, key: str, handler: Handler, request: NewMessageRequest):
+        """
+        Queue a message for a channel without waiting for it to be handled. On
+        shutdown it is only kept for take_queued().
+        """
+        self._queues.setdefault(key, deque()).append((handler, request))
+        if key not in self._workers and not self.closing:
+            self._workers[key] = asyncio.create_task(self._drain(key))
+
+    def discard(self, key: str) -> int:
+        """Drop the messages still queued for a channel"""
+        queue = self._queues.get(key)
+        if not queue:
+            return 0
+        dropped = len(queue)
+        queue.clear()
+        return dropped
+
+    def take_queued(self) -> List[Tuple[str, NewMessageRequest]]:
+        """Remove the messages not started yet, in order per channel"""
+        queued = [
+            (key, request)
+            for key, queue in self._queues.items()
+            for _, request in queue
+        ]
+        self._queues.clear()
+        return queued
+
+    def cancel(self, key: str) -> Optional[asyncio.Task]:
+        """
+        Cancel the generation running for a channel, if any. The returned task can be
+        awaited to wait until the partial answer was saved.
+        """
+        task = self._current.get(key)
+        if task is None or task.done():
+            return None
+        task.cancel()
+        return task
+
+    async def drain(self, timeout: float, finalize_timeout: float) -> int:
+        """
+        Stop taking work and wait up to `timeout` seconds for the running generations.
+        The ones still running are cancelled, so they save their partial answer, and
+        get `finalize_timeout` seconds to do it. Returns the number of cancelled ones.
+        The messages not started stay queued, see take_queued().
+        """
+        self.closing = True
+        running = set(self._current.values())
+        pending = set()
+        if running:
+            _, pending = await asyncio.wait(running, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending, timeout=finalize_timeout)
+        # The workers waiting for a slot put their message back in the queue
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        return len(pending)
+
+    async def close(self):
+        """Drop queued work and cancel the channel workers"""
+        for queue in self._queues.values():
+            queue.clear()
+        for task in list(self._current.values()):
+            task.cancel()
+        workers = list(self._workers.values())
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _drain(self, key: str):
+        queue = self._queues[key]
+        try:
+            while queue:
+                handler, request = self._next(queue)
+                self.waiting += 1
+                try:
+                    await self._semaphore.acquire()
+                except asyncio.CancelledError:
+                    queue.appendleft((handler, request))
+                    raise
+                finally:
+                    self.waiting -= 1
+                try:
+                    if self.closing:
+                        queue.appendleft((handler, request))
+                        break
+                    self.in_flight += 1
+                    # The generation runs in its own task so it can be cancelled
+                    # without stopping the worker of the channel
+                    task = asyncio.create_task(handler(request))
+                    self._current[key] = task
+                    try:
+                        await asyncio.wait({task})
+                    finally:
+                        self._current.pop(key, None)
+                        self.in_flight -= 1
+                    if task.cancelled():
+                        self.cancelled += 1
+                    elif task.exception():
+                        logger.error(
+                            "Error handling message for channel %s: %s",
+                            key,
+                            task.exception(),
+                        )
+                finally:
+                    self._semaphore.release()
+        finally:
+            self._workers.pop(key, None)
+            if not queue:
+                self._queues.pop(key, None)
+
+    def _next(self, queue: Deque) -> Tuple[Handler, NewMessageRequest]:
+        if not self.merge_queued or len(queue) < 2:
+            return queue.popleft()
+
+        # Answer everything that piled up in one go by answering the latest user
+        # message: the earlier ones are in the history already, so the context
+        # has them all. Only messages of its thread are merged, the others stay
+        # queued.
+        pending = list(queue)
+        handler, request = next(
+            (item for item in reversed(pending) if _user_text(item[1])), pending[-1]
+        )
+        thread = _thread_of(request)
+        queue.clear()
+        queue.extend(item for item in pending if _thread_of(item[1]) != thread)
+        return handler, request
+
+
+def _thread_of(request: NewMessageRequest) -> Optional[str]:
+    message = request.message
+    return message.get("parent_id") if isinstance(message, dict) else None
+
+
+def _user_text(request: NewMessageRequest) -> Optional[str]:
+    message = request.message
+    if not isinstance(message, dict) or message.get("ai_generated"):
+        return None
+    return message.get("text")
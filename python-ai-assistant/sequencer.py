@@ -0,0 +1,149 @@
+"""Ordered delivery of the events and updates of one AI message"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Optional
+
+# Custom channel event with the text added to a message, in delta streaming mode
+DELTA_EVENT = "ai_text.delta"
+
+
+class OutboundSequencer:
+    """
+    Sends the indicator events and message updates of one AI message to Stream.
+
+    Every call gets the next sequence number and only starts once the previous one
+    completed, so the UI sees indicator -> partial updates -> final update -> clear
+    in the order they were produced, without waiting on timers. Calls that would
+    break that order or repeat a step are dropped: a partial update or delta after
+    the final update, a second final update or clear, the same indicator state
+    twice in a row, and anything after the clear.
+    """
+
+    def __init__(self, chat_client: Any, channel: Any, message_id: str, bot_id: str):
+        self.chat_client = chat_client
+        self.channel = channel
+        self.message_id = message_id
+        self.bot_id = bot_id
+
+        self.sequence = 0
+        self.completed = 0
+        self.dropped = 0
+        self._tail: Optional[asyncio.Task] = None
+        self._indicator: Optional[str] = None
+        self._final: Optional[asyncio.Task] = None
+        self._clear: Optional[asyncio.Task] = None
+
+    async def indicator(self, state: str):
+        """Update the AI indicator of the message"""
+        if self._clear is not None or state == self._indicator:
+            self.dropped += 1
+            return
+        self._indicator = state
+        await asyncio.shield(
+            self._enqueue(
+                lambda: self.channel.send_event(
+                    {
+                        "type": "ai_indicator.update",
+                        "ai_state": state,
+                        "message_id": self.message_id,
+                    },
+                    self.bot_id,
+                )
+            )
+        )
+
+    def can_update(self) -> bool:
+        """Whether the Stream rate budget allows a partial update right now"""
+        governor = getattr(self.chat_client, "governor", None)
+        return governor is None or governor.can_update()
+
+    async def partial(self, text: str):
+        """Send the text generated so far"""
+        if self._final is not None or self._clear is not None:
+            self.dropped += 1
+            return
+        await asyncio.shield(self._enqueue(lambda: self._update(text, True)))
+
+    async def delta(self, offset: int, text: str):
+        """Send the text added at `offset` of the message text"""
+        if self._final is not None or self._clear is not None:
+            self.dropped += 1
+            return
+        await asyncio.shield(
+            self._enqueue(
+                lambda: self.channel.send_event(
+                    {
+                        "type": DELTA_EVENT,
+                        "message_id": self.message_id,
+                        "offset": offset,
+                        "delta": text,
+                    },
+                    self.bot_id,
+                )
+            )
+        )
+
+    async def final(self, text: str):
+        """Send the full text and mark the message as generated"""
+        if self._final is None:
+            self._final = self._enqueue(lambda: self._update(text, False))
+        else:
+            self.dropped += 1
+        await asyncio.shield(self._final)
+
+    @property
+    def final_sent(self) -> bool:
+        """Whether the final update was sent or is being sent"""
+        return self._final is not None
+
+    @property
+    def cleared(self) -> bool:
+        """Whether the indicator was cleared or is being cleared"""
+        return self._clear is not None
+
+    async def clear(self):
+        """Clear the AI indicator, nothing is sent for the message afterwards"""
+        if self._clear is None:
+            self._clear = self._enqueue(
+                lambda: self.channel.send_event(
+                    {
+                        "type": "ai_indicator.clear",
+                        "message_id": self.message_id,
+                    },
+                    self.bot_id,
+                )
+            )
+        else:
+            self.dropped += 1
+        await asyncio.shield(self._clear)
+
+    def _update(self, text: str, generating: bool) -> Awaitable:
+        return self.chat_client.update_message_partial(
+            self.message_id,
+            {"set": {"text": text, "generating": generating}},
+            self.bot_id,
+        )
+
+    def _enqueue(self, call: Callable[[], Awaitable]) -> asyncio.Task:
+        self.sequence += 1
+        task = asyncio.create_task(self._run(self.sequence, self._tail, call))
+        # Errors are raised to the caller, don't warn when it stopped waiting
+        task.add_done_callback(
+            lambda done: done.cancelled() or done.exception() is None
+        )
+        self._tail = task
+        return task
+
+    async def _run(
+        self,
+        sequence: int,
+        previous: Optional[asyncio.Task],
+        call: Callable[[], Awaitable],
+    ):
+        if previous is not None:
+            # Waits for the previous call without failing with it
+            await asyncio.wait({previous})
+        try:
+            await call()
+        finally:
+            self.completed = sequence
@@ -0,0 +1,56 @@
+"""Snapshot of the agent bindings, written on shutdown and restored on startup"""
+
+import logging
+import os
+from typing import List
+import orjson
+from helpers import create_bot_id
+from registry import AgentBinding
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+def save_snapshot(path: str, bindings: List[AgentBinding]):
+    """
+    Write the bindings as [channel_type, channel_id, platform] rows, the bot id is
+    derived from the channel id. The file is replaced at once, never half written.
+    """
+    data = orjson.dumps(
+        {
+            "version": SNAPSHOT_VERSION,
+            "bindings": [
+                [binding.channel_type, binding.channel_id, binding.platform]
+                for binding in bindings
+            ],
+        }
+    )
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+def load_snapshot(path: str) -> List[AgentBinding]:
+    """The bindings of a snapshot, none if there is no readable snapshot"""
+    try:
+        with open(path, "rb") as file:
+            data = orjson.loads(file.read())
+        if data.get("version") != SNAPSHOT_VERSION:
+            logger.warning("Ignoring snapshot with unknown version %s", path)
+            return []
+        return [
+            AgentBinding(
+                bot_id=create_bot_id(channel_id=channel_id),
+                channel_type=channel_type,
+                channel_id=channel_id,
+                platform=platform,
+            )
+            for channel_type, channel_id, platform in data["bindings"]
+        ]
+    except FileNotFoundError:
+        return []
+    except (ValueError, TypeError, KeyError, AttributeError) as error:
+        logger.error("Failed to read snapshot %s: %s", path, error)
+        return []
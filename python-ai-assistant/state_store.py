@@ -0,0 +1,409 @@
+"""Agent state shared between workers: channel bindings, leases and message queues"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import asdict
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+from registry import AgentBinding
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(ABC):
+    """
+    Interface of the shared state. A lease gives one worker the ownership of a key
+    (a channel) until it is released or its TTL runs out.
+    """
+
+    # Whether other workers see the state, i.e. can own the channels in turn
+    shared = True
+
+    @abstractmethod
+    async def save_binding(self, binding: AgentBinding):
+        """Store the binding of a channel"""
+
+    @abstractmethod
+    async def load_binding(self, bot_id: str) -> Optional[AgentBinding]:
+        """Load the binding of a channel"""
+
+    @abstractmethod
+    async def delete_binding(self, bot_id: str):
+        """Delete the binding of a channel"""
+
+    @abstractmethod
+    async def list_bindings(self) -> List[AgentBinding]:
+        """All stored bindings"""
+
+    @abstractmethod
+    async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        """Take or renew the lease on a key, False if another owner holds it"""
+
+    @abstractmethod
+    async def release_lease(self, key: str, owner: str):
+        """Give up the lease on a key if it is held by `owner`"""
+
+    @abstractmethod
+    async def push_message(self, key: str, payload: str):
+        """Append a message to the queue of a key"""
+
+    @abstractmethod
+    async def pop_message(self, key: str) -> Optional[str]:
+        """Take the oldest message from the queue of a key"""
+
+    @abstractmethod
+    async def return_message(self, key: str, payload: str):
+        """Put a message taken from the queue of a key back in front of it"""
+
+    @abstractmethod
+    async def queue_length(self, key: str) -> int:
+        """Number of messages in the queue of a key"""
+
+    async def close(self):
+        """Release the resources of the store"""
+
+
+class MemoryStateStore(StateStore):
+    """State kept in this process, for a single worker"""
+
+    shared = False
+
+    def __init__(self):
+        self._bindings: Dict[str, AgentBinding] = {}
+        self._leases: Dict[str, Tuple[str, float]] = {}
+        self._queues: Dict[str, Deque[str]] = {}
+
+    async def save_binding(self, binding: AgentBinding):
+        self._bindings[binding.bot_id] = binding
+
+    async def load_binding(self, bot_id: str) -> Optional[AgentBinding]:
+        return self._bindings.get(bot_id)
+
+    async def delete_binding(self, bot_id: str):
+        self._bindings.pop(bot_id, None)
+
+    async def list_bindings(self) -> List[AgentBinding]:
+        return list(self._bindings.values())
+
+    async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        now = time.monotonic()
+        lease = self._leases.get(key)
+        if lease is not None and lease[0] != owner and lease[1] > now:
+            return False
+        self._leases[key] = (owner, now + ttl)
+        return True
+
+    async def release_lease(self, key: str, owner: str):
+        lease = self._leases.get(key)
+        if lease is not None and lease[0] == owner:
+            del self._leases[key]
+
+    async def push_message(self, key: str, payload: str):
+        self._queues.setdefault(key, deque()).append(payload)
+
+    async def pop_message(self, key: str) -> Optional[str]:
+        queue = self._queues.get(key)
+        if not queue:
+            return None
+        payload = queue.popleft()
+        if not queue:
+            del self._queues[key]
+        return payload
+
+    async def return_message(self, key: str, payload: str):
+        self._queues.setdefault(key, deque()).appendleft(payload)
+
+    async def queue_length(self, key: str) -> int:
+        return len(self._queues.get(key, ()))
+
+
+class SQLiteStateStore(StateStore):
+    """State in a SQLite file, shared by the workers of one host"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = asyncio.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS bindings (bot_id TEXT PRIMARY KEY, data TEXT);
+            CREATE TABLE IF NOT EXISTS leases (
+                key TEXT PRIMARY KEY, owner TEXT, expires REAL
+            );
+            CREATE TABLE IF NOT EXISTS queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, payload TEXT
+            );
+            CREATE INDEX IF NOT EXISTS queue_key ON queue (key, id);
+            """)
+        self._db.commit()
+
+    async def _run(self, sql: str, params: tuple = ()) -> List[tuple]:
+        # sqlite3 blocks, run it off the event loop one statement at a time
+        async with self._lock:
+            return await asyncio.to_thread(self._execute, sql, params)
+
+    def _execute(self, sql: str, params: tuple) -> List[tuple]:
+        with self._db:
+            return self._db.execute(sql, params).fetchall()
+
+    async def save_binding(self, binding: AgentBinding):
+        await self._run(
+            "INSERT OR REPLACE INTO bindings (bot_id, data) VALUES (?, ?)",
+            (binding.bot_id, json.dumps(asdict(binding))),
+        )
+
+    async def load_binding(self, bot_id: str) -> Optional[AgentBinding]:
+        rows = await self._run("SELECT data FROM bindings WHERE bot_id = ?", (bot_id,))
+        return AgentBinding(**json.loads(rows[0][0])) if rows else None
+
+    async def delete_binding(self, bot_id: str):
+        await self._run("DELETE FROM bindings WHERE bot_id = ?", (bot_id,))
+
+    async def list_bindings(self) -> List[AgentBinding]:
+        rows = await self._run("SELECT data FROM bindings")
+        return [AgentBinding(**json.loads(row[0])) for row in rows]
+
+    async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        # Wall clock time, the workers don't share a monotonic clock
+        now = time.time()
+        rows = await self._run(
+            """
+            INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET owner = excluded.owner,
+                expires = excluded.expires
+            WHERE leases.owner = excluded.owner OR leases.expires < ?
+            RETURNING owner
+            """,
+            (key, owner, now + ttl, now),
+        )
+        return bool(rows)
+
+    async def release_lease(self, key: str, owner: str):
+        await self._run("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+    async def push_message(self, key: str, payload: str):
+        await self._run(
+            "INSERT INTO queue (key, payload) VALUES (?, ?)", (key, payload)
+        )
+
+    async def pop_message(self, key: str) -> Optional[str]:
+        rows = await self._run(
+            """
+            DELETE FROM queue WHERE id = (
+                SELECT id FROM queue WHERE key = ? ORDER BY id LIMIT 1
+            ) RETURNING payload
+            """,
+            (key,),
+        )
+        return rows[0][0] if rows else None
+
+    async def return_message(self, key: str, payload: str):
+        # Below the lowest id of the table, so it is the first of its key
+        await self._run(
+            """
+            INSERT INTO queue (id, key, payload)
+            VALUES ((SELECT COALESCE(MIN(id), 1) - 1 FROM queue), ?, ?)
+            """,
+            (key, payload),
+        )
+
+    async def queue_length(self, key: str) -> int:
+        rows = await self._run("SELECT COUNT(*) FROM queue WHERE key = ?", (key,))
+        return rows[0][0]
+
+    async def close(self):
+        self._db.close()
+
+
+# Take the lease if it is free or renew it if `owner` holds it, in one step so it
+# can't expire and be taken by another worker between the check and the renewal
+_ACQUIRE_LEASE = """
+local holder = redis.call('GET', KEYS[1])
+if holder == false or holder == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+# Delete the lease only if `owner` still holds it
+_RELEASE_LEASE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RedisStateStore(StateStore):
+    """
+    State in Redis, shared by workers on several hosts. The leases are checked and
+    updated atomically by Lua scripts. Servers speaking the Redis protocol without
+    EVAL are supported with plain commands, a lease can then be lost when it
+    expires between the check and the update.
+    """
+
+    def __init__(
+        self, host: str, port: int, db: int = 0, password: Optional[str] = None
+    ):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self._lock = asyncio.Lock()
+        # Cleared when the server doesn't know EVAL
+        self.scripts = True
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def execute(self, *args):
+        """Send a command and return its reply"""
+        async with self._lock:
+            if self._writer is None:
+                await self._connect()
+            try:
+                return await self._command(*args)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Reconnect once, the server might have closed an idle connection
+                await self._disconnect()
+                await self._connect()
+                return await self._command(*args)
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._command("AUTH", self.password)
+        if self.db:
+            await self._command("SELECT", self.db)
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+        self._reader = self._writer = None
+
+    async def _command(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            value = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$%d\r\n%s\r\n" % (len(value), value))
+        self._writer.write(b"".join(parts))
+        await self._writer.drain()
+        return await self._read_reply()
+
+    async def _read_reply(self):
+        line = await self._reader.readuntil(b"\r\n")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RuntimeError(f"Redis error: {rest.decode()}")
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode()
+        if kind == b"*":
+            length = int(rest)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RuntimeError(f"Unexpected Redis reply: {line!r}")
+
+    async def save_binding(self, binding: AgentBinding):
+        await self.execute(
+            "HSET", "ai:bindings", binding.bot_id, json.dumps(asdict(binding))
+        )
+
+    async def load_binding(self, bot_id: str) -> Optional[AgentBinding]:
+        data = await self.execute("HGET", "ai:bindings", bot_id)
+        return AgentBinding(**json.loads(data)) if data else None
+
+    async def delete_binding(self, bot_id: str):
+        await self.execute("HDEL", "ai:bindings", bot_id)
+
+    async def list_bindings(self) -> List[AgentBinding]:
+        reply = await self.execute("HGETALL", "ai:bindings") or []
+        return [AgentBinding(**json.loads(data)) for data in reply[1::2]]
+
+    async def _script(self, script: str, key: str, *args) -> Optional[int]:
+        # The reply of a script, None if the server doesn't run scripts
+        if not self.scripts:
+            return None
+        try:
+            return await self.execute("EVAL", script, 1, key, *args)
+        except RuntimeError as error:
+            if "unknown command" not in str(error).lower():
+                raise
+        logger.warning("Redis server without EVAL, leases use plain commands")
+        self.scripts = False
+        return None
+
+    async def acquire_lease(self, key: str, owner: str, ttl: float) -> bool:
+        lease_key = f"ai:lease:{key}"
+        ttl_ms = int(ttl * 1000)
+        reply = await self._script(_ACQUIRE_LEASE, lease_key, owner, ttl_ms)
+        if reply is not None:
+            return reply == 1
+        if await self.execute("SET", lease_key, owner, "NX", "PX", ttl_ms) == "OK":
+            return True
+        if await self.execute("GET", lease_key) == owner:
+            await self.execute("PEXPIRE", lease_key, ttl_ms)
+            return True
+        return False
+
+    async def release_lease(self, key: str, owner: str):
+        lease_key = f"ai:lease:{key}"
+        if await self._script(_RELEASE_LEASE, lease_key, owner) is not None:
+            return
+        if await self.execute("GET", lease_key) == owner:
+            await self.execute("DEL", lease_key)
+
+    async def push_message(self, key: str, payload: str):
+        await self.execute("RPUSH", f"ai:queue:{key}", payload)
+
+    async def pop_message(self, key: str) -> Optional[str]:
+        return await self.execute("LPOP", f"ai:queue:{key}")
+
+    async def return_message(self, key: str, payload: str):
+        await self.execute("LPUSH", f"ai:queue:{key}", payload)
+
+    async def queue_length(self, key: str) -> int:
+        return await self.execute("LLEN", f"ai:queue:{key}")
+
+    async def close(self):
+        async with self._lock:
+            await self._disconnect()
+
+
+def create_state_store(url: str) -> StateStore:
+    """
+    Create the store for a URL: `memory://`, `sqlite:///path/to/file.db` or
+    `redis://[:password@]host[:port][/db]`
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "memory":
+        return MemoryStateStore()
+    if parsed.scheme == "sqlite":
+        # sqlite:///agents.db is relative, sqlite:////tmp/agents.db is absolute
+        path = parsed.path[1:] if parsed.path.startswith("/") else parsed.path
+        return SQLiteStateStore(path or "agents.db")
+    if parsed.scheme == "redis":
+        db = parsed.path.lstrip("/")
+        return RedisStateStore(
+            parsed.hostname or "localhost",
+            parsed.port or 6379,
+            int(db) if db else 0,
+            parsed.password,
+        )
+    raise ValueError(f"Unsupported state store URL: {url}")
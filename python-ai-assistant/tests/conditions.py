@@ -0,0 +1,26 @@
+"""Waiting on the state of the code under test rather than on fixed delays"""
+
+import asyncio
+import inspect
+import time
+from typing import Any, Callable
+
+# Generous, only reached when the condition never holds
+TIMEOUT = 10.0
+
+
+async def until(condition: Callable[[], Any], timeout: float = TIMEOUT):
+    """
+    Wait until `condition()` holds, it may return an awaitable. Fails the test
+    after `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        result = condition()
+        if inspect.isawaitable(result):
+            result = await result
+        if result:
+            return
+        if time.monotonic() > deadline:
+            raise AssertionError(f"Condition not met after {timeout}s")
+        await asyncio.sleep(0.001)
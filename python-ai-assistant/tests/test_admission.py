@@ -0,0 +1,69 @@
+"""Shedding of new messages while the worker is overloaded"""
+
+from admission import AdmissionController
+
+
+class Load:
+    def __init__(self):
+        self.in_flight = 0
+        self.queued = 0
+        self.first_token = 0.0
+
+
+def controller(load, **limits):
+    return AdmissionController(
+        lambda: load.in_flight,
+        lambda: load.queued,
+        lambda: load.first_token,
+        **limits,
+    )
+
+
+def test_messages_are_shed_above_each_limit():
+    load = Load()
+    admission = controller(load, max_in_flight=4, max_queued=10, max_first_token=5.0)
+    assert admission.admit("a") is None
+    load.in_flight = 4
+    assert admission.admit("b") == "in_flight"
+    load.in_flight, load.queued = 0, 10
+    assert admission.admit("b") == "queue"
+    load.queued, load.first_token = 0, 6.0
+    assert admission.admit("b") == "latency"
+    load.first_token = 1.0
+    assert admission.admit("b") is None
+
+
+def test_active_conversations_have_headroom_and_ignore_the_latency():
+    load = Load()
+    admission = controller(load, max_in_flight=4, max_first_token=5.0)
+    assert admission.admit("active") is None
+    load.in_flight, load.first_token = 7, 10.0
+    assert admission.admit("new") == "in_flight"
+    assert admission.admit("active") is None
+    load.in_flight = 8
+    assert admission.admit("active") == "in_flight"
+
+
+def test_conversations_stop_being_active_after_the_window():
+    load = Load()
+    admission = controller(load, max_first_token=5.0, active_window=0.0)
+    assert admission.admit("a") is None
+    assert not admission.is_active("a")
+    load.first_token = 10.0
+    assert admission.admit("a") == "latency"
+
+
+def test_active_channels_are_bounded_and_everything_is_shed_on_shutdown():
+    admission = controller(Load(), max_channels=2)
+    for key in ("a", "b", "c"):
+        assert admission.admit(key) is None
+    assert not admission.is_active("a")
+    assert admission.is_active("c")
+    admission.close()
+    assert admission.admit("c") == "shutdown"
+
+
+def test_limits_of_zero_are_not_checked():
+    load = Load()
+    load.in_flight, load.queued, load.first_token = 1000, 1000, 100.0
+    assert controller(load).admit("a") is None
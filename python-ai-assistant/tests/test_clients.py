@@ -0,0 +1,68 @@
+"""Shared Stream and LLM clients"""
+
+import asyncio
+import pytest
+from clients import ClientManager
+from config import Settings
+
+
+def settings(**overrides) -> Settings:
+    values = dict(
+        stream_api_key="key",
+        stream_api_secret="secret",
+        openai_api_key="openai key",
+        anthropic_api_key="anthropic key",
+        stream_pool_size=7,
+    )
+    values.update(overrides)
+    return Settings(**values)
+
+
+def test_agents_share_one_client_per_upstream():
+    async def run():
+        manager = ClientManager(settings())
+        await manager.start()
+        first, second = manager.lease(), manager.lease()
+        shared = (
+            first.stream is second.stream,
+            first.openai() is second.openai(),
+            first.anthropic() is second.anthropic(),
+            first.openai_compatible("http://llm")
+            is manager.openai_compatible("http://llm"),
+            first.openai_compatible("http://llm") is not first.openai(),
+        )
+        limit = manager.stream.session.connector.limit
+        await manager.close()
+        return shared, limit
+
+    shared, limit = asyncio.run(run())
+    assert all(shared)
+    assert limit == 7
+
+
+def test_leases_are_counted_and_released_once():
+    async def run():
+        manager = ClientManager(settings())
+        await manager.start()
+        lease = manager.lease()
+        manager.lease()
+        borrowed = manager.borrowed
+        lease.release()
+        lease.release()
+        with pytest.raises(RuntimeError):
+            lease.stream
+        left = manager.borrowed
+        await manager.close()
+        return borrowed, left
+
+    assert asyncio.run(run()) == (2, 1)
+
+
+def test_clients_need_their_key_and_a_started_manager():
+    manager = ClientManager(settings(openai_api_key=None, anthropic_api_key=None))
+    with pytest.raises(RuntimeError):
+        manager.stream
+    with pytest.raises(ValueError):
+        manager.openai()
+    with pytest.raises(ValueError):
+        manager.anthropic()
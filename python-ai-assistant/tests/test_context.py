@@ -0,0 +1,79 @@
+"""Token estimate and budgeted assembly of the LLM context"""
+
+from context import (
+    MESSAGE_OVERHEAD,
+    TRUNCATION_MARKER,
+    ContextBuilder,
+    count_tokens,
+    truncate_text,
+)
+
+
+def turn(message_id, content, role="user"):
+    return {"id": message_id, "content": content, "role": role}
+
+
+def test_token_estimate():
+    assert count_tokens("") == 0
+    assert count_tokens("Hello, world!") == 4
+    # Long words count as several tokens
+    assert count_tokens("internationalization") == 4
+    # Each CJK character is at least a token
+    assert count_tokens("你好世界") == 4
+    assert count_tokens("こんにちは") == 5
+    assert count_tokens("안녕하세요 world") == 6
+
+
+def test_truncated_text_keeps_its_start_and_end():
+    text = " ".join(f"word{index}" for index in range(100))
+    truncated = truncate_text(text, 30)
+    head, tail = truncated.split(TRUNCATION_MARKER)
+    assert head.startswith("word0 word1")
+    assert tail.endswith("word98 word99")
+    assert count_tokens(head) + count_tokens(tail) <= 30
+    assert truncate_text("short text", 30) == "short text"
+
+
+def test_recent_turns_are_packed_into_the_budget_of_the_model():
+    per_turn = count_tokens("one two three") + MESSAGE_OVERHEAD
+    builder = ContextBuilder(
+        default_budget=per_turn * 2, max_message_tokens=100, budgets={"big": 1000}
+    )
+    # Newest first, as read from the history
+    history = [turn(str(index), "one two three") for index in range(5, 0, -1)]
+
+    default = builder.build(history, "small")
+    big = builder.build(history, "big")
+    assert [item["content"] for item in default] == ["one two three"] * 2
+    assert len(big) == 5
+    assert builder.budget_for("big") == 1000
+
+
+def test_context_is_oldest_first_with_the_roles():
+    builder = ContextBuilder(default_budget=1000, max_message_tokens=100)
+    history = [turn("3", "Thanks"), turn("2", "Hi!", "assistant"), turn("1", "Hi")]
+    assert builder.build(history, "model") == [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hi!"},
+        {"role": "user", "content": "Thanks"},
+    ]
+
+
+def test_long_messages_are_truncated_and_the_newest_always_included():
+    long_text = " ".join(f"word{index}" for index in range(500))
+    builder = ContextBuilder(default_budget=50, max_message_tokens=1000)
+    context = builder.build([turn("2", long_text), turn("1", "older")], "model")
+    assert len(context) == 1
+    assert TRUNCATION_MARKER in context[0]["content"]
+
+    builder = ContextBuilder(default_budget=1000, max_message_tokens=20)
+    content = builder.build([turn("1", long_text)], "model")[0]["content"]
+    assert count_tokens(content) <= 20 + count_tokens(TRUNCATION_MARKER)
+
+
+def test_edited_message_is_counted_again():
+    builder = ContextBuilder(default_budget=1000, max_message_tokens=5)
+    first = builder.build([turn("1", "short")], "model")
+    edited = builder.build([turn("1", "a much longer text than before")], "model")
+    assert first[0]["content"] == "short"
+    assert TRUNCATION_MARKER in edited[0]["content"]
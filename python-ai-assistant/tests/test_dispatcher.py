@@ -0,0 +1,150 @@
+"""Lease handover between the workers of a channel, on the memory store"""
+
+import asyncio
+from conditions import until
+from dispatcher import ChannelDispatcher
+from model import NewMessageRequest
+from state_store import MemoryStateStore
+
+CID = "messaging:general"
+
+
+def message(message_id: str) -> NewMessageRequest:
+    return NewMessageRequest(
+        cid=CID, type="message.new", message={"id": message_id, "text": "hi"}
+    )
+
+
+def worker(store, name, delivered, acquired, busy=lambda key: False):
+    async def deliver(key, request):
+        delivered.append((name, request.message["id"]))
+
+    return ChannelDispatcher(
+        store,
+        deliver,
+        is_busy=busy,
+        lease_ttl=30,
+        poll_interval=0.01,
+        worker_id=name,
+        on_acquire=lambda key, cid: acquired.append((name, cid)),
+    )
+
+
+def test_lease_handed_over_when_the_channel_is_idle():
+    async def run():
+        store = MemoryStateStore()
+        delivered, acquired = [], []
+        a = worker(store, "a", delivered, acquired)
+        b = worker(store, "b", delivered, acquired)
+
+        await a.dispatch("bot", message("1"))
+        # Nothing left to do, a releases the lease
+        await until(lambda: delivered and a.owned_count == 0)
+        await b.dispatch("bot", message("2"))
+        await until(lambda: len(delivered) == 2)
+
+        await a.close()
+        await b.close()
+        return delivered, acquired
+
+    delivered, acquired = asyncio.run(run())
+    assert delivered == [("a", "1"), ("b", "2")]
+    assert acquired == [("a", CID), ("b", CID)]
+
+
+def test_owner_keeps_the_channel_while_busy():
+    async def run():
+        store = MemoryStateStore()
+        delivered, acquired = [], []
+        busy = {"bot"}
+        a = worker(store, "a", delivered, acquired, busy=lambda key: key in busy)
+        b = worker(store, "b", delivered, acquired)
+
+        await a.dispatch("bot", message("1"))
+        await until(lambda: delivered)
+        # Queued by b, pumped by a which still holds the lease
+        await b.dispatch("bot", message("2"))
+        await until(lambda: len(delivered) == 2)
+        assert (a.owned_count, b.owned_count) == (1, 0)
+
+        busy.clear()
+        await until(lambda: a.owned_count == 0)
+        await b.dispatch("bot", message("3"))
+        await until(lambda: len(delivered) == 3)
+
+        await a.close()
+        await b.close()
+        return delivered, acquired
+
+    delivered, acquired = asyncio.run(run())
+    assert delivered == [("a", "1"), ("a", "2"), ("b", "3")]
+    assert acquired == [("a", CID), ("b", CID)]
+
+
+def test_close_releases_the_lease_and_keeps_the_queue():
+    async def run():
+        store = MemoryStateStore()
+        delivered, acquired = [], []
+        a = worker(store, "a", delivered, acquired, busy=lambda key: True)
+        b = worker(store, "b", delivered, acquired)
+
+        await a.dispatch("bot", message("1"))
+        await until(lambda: delivered)
+        await a.close()
+        # Left in the queue by the stopped worker for the next owner
+        await a.dispatch("bot", message("2"))
+        await b.dispatch("bot", message("3"))
+        await until(lambda: len(delivered) == 3)
+
+        await b.close()
+        return delivered
+
+    assert asyncio.run(run()) == [("a", "1"), ("b", "2"), ("b", "3")]
+
+
+def test_message_being_delivered_on_stop_is_kept_for_the_next_owner():
+    async def run():
+        store = MemoryStateStore()
+        delivered, acquired = [], []
+        entered, release = asyncio.Event(), asyncio.Event()
+
+        async def slow_deliver(key, request):
+            entered.set()
+            await release.wait()
+
+        a = ChannelDispatcher(store, slow_deliver, lambda key: False, 30, 0.01, "a")
+        b = worker(store, "b", delivered, acquired)
+
+        await a.dispatch("bot", message("1"))
+        await entered.wait()
+        await a.close()
+        queued = await store.queue_length("bot")
+        await b.dispatch("bot", message("2"))
+        await until(lambda: len(delivered) == 2)
+        await b.close()
+        return queued, delivered
+
+    queued, delivered = asyncio.run(run())
+    assert queued == 1
+    assert delivered == [("b", "1"), ("b", "2")]
+
+
+def test_pump_failing_with_the_store_ends_quietly():
+    class BrokenStore(MemoryStateStore):
+        async def pop_message(self, key):
+            raise ConnectionError("store down")
+
+        async def release_lease(self, key, owner):
+            raise ConnectionError("store down")
+
+    async def run():
+        store = BrokenStore()
+        a = worker(store, "a", [], [])
+        await a.dispatch("bot", message("1"))
+        pump = a._pumps["bot"]
+        await asyncio.wait({pump})
+        return pump, a.owned_count
+
+    pump, owned = asyncio.run(run())
+    assert pump.exception() is None
+    assert owned == 0
@@ -0,0 +1,156 @@
+"""Background flushing of the partial updates of a streamed message"""
+
+import asyncio
+from conditions import until
+from flusher import PartialUpdateFlusher
+
+
+class Outbound:
+    """Records the updates, each one completes once `sent` is set"""
+
+    def __init__(self, budget: bool = True):
+        self.updates = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.sent = asyncio.Event()
+        self.sent.set()
+        self.budget = budget
+
+    def can_update(self) -> bool:
+        return self.budget
+
+    async def _send(self, update):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await self.sent.wait()
+            self.updates.append(update)
+        finally:
+            self.in_flight -= 1
+
+    async def partial(self, text: str):
+        await self._send(("partial", text))
+
+    async def delta(self, offset: int, text: str):
+        await self._send(("delta", offset, text))
+
+
+def flusher(outbound, **options) -> PartialUpdateFlusher:
+    values = dict(interval=30.0, min_chars=5, deltas=False, checkpoint_interval=30.0)
+    values.update(options)
+    return PartialUpdateFlusher(outbound, **values)
+
+
+def test_enough_new_text_is_flushed_without_waiting_for_the_interval():
+    async def run():
+        outbound = Outbound()
+        partial = flusher(outbound)
+        partial.start()
+        # The first text is sent right away
+        partial.append("Hel")
+        await until(lambda: outbound.updates)
+        # Under min_chars, waits for the interval
+        partial.append("lo")
+        for _ in range(10):
+            await asyncio.sleep(0)
+        waiting = list(outbound.updates)
+        partial.append(" world")
+        await until(lambda: len(outbound.updates) == 2)
+        return waiting, outbound.updates, await partial.close()
+
+    waiting, updates, text = asyncio.run(run())
+    assert waiting == [("partial", "Hel")]
+    assert updates == [("partial", "Hel"), ("partial", "Hello world")]
+    assert text == "Hello world"
+
+
+def test_latest_text_replaces_the_one_waiting_behind_the_update_in_flight():
+    async def run():
+        outbound = Outbound()
+        partial = flusher(outbound, interval=0.0, min_chars=1)
+        partial.start()
+        outbound.sent.clear()
+        partial.append("a")
+        await until(lambda: outbound.in_flight == 1)
+        # Appending never waits, even with an update in flight
+        for chunk in "bcd":
+            partial.append(chunk)
+        outbound.sent.set()
+        await until(lambda: len(outbound.updates) == 2)
+        text = await partial.close()
+        return outbound, text, partial.updates_sent
+
+    outbound, text, sent = asyncio.run(run())
+    assert outbound.updates == [("partial", "a"), ("partial", "abcd")]
+    assert outbound.max_in_flight == 1
+    assert (text, sent) == ("abcd", 2)
+
+
+def test_close_waits_for_the_update_in_flight_and_stops_flushing():
+    async def run():
+        outbound = Outbound()
+        partial = flusher(outbound, interval=0.0, min_chars=1)
+        partial.start()
+        outbound.sent.clear()
+        partial.append("Hello")
+        await until(lambda: outbound.in_flight == 1)
+        closing = asyncio.create_task(partial.close())
+        await asyncio.sleep(0)
+        waited = not closing.done()
+        outbound.sent.set()
+        text = await closing
+        partial.append(" ignored")
+        return waited, text, outbound.updates, partial.text
+
+    waited, text, updates, final = asyncio.run(run())
+    assert waited
+    assert text == final == "Hello"
+    assert updates == [("partial", "Hello")]
+
+
+def test_flushes_are_deferred_without_rate_budget():
+    async def run():
+        outbound = Outbound(budget=False)
+        partial = flusher(outbound, interval=0.001, min_chars=1)
+        partial.start()
+        partial.append("Hello")
+        await until(lambda: partial.deferred >= 2)
+        return outbound.updates, await partial.close()
+
+    updates, text = asyncio.run(run())
+    assert updates == []
+    assert text == "Hello"
+
+
+def test_delta_mode_sends_the_new_text_with_its_offset():
+    async def run():
+        outbound = Outbound()
+        partial = flusher(outbound, interval=0.0, min_chars=1, deltas=True)
+        partial.start()
+        for count, chunk in enumerate(("Hello", " wor", "ld"), start=1):
+            partial.append(chunk)
+            await until(lambda: len(outbound.updates) == count)
+        text = await partial.close()
+        return outbound.updates, text, partial.updates_sent, partial.deltas_sent
+
+    updates, text, sent, deltas = asyncio.run(run())
+    # The first flush is a checkpoint with the full text
+    assert updates == [("partial", "Hello"), ("delta", 5, " wor"), ("delta", 9, "ld")]
+    assert text == "Hello world"
+    assert (sent, deltas) == (1, 2)
+
+
+def test_delta_mode_sends_the_full_text_at_every_checkpoint():
+    async def run():
+        outbound = Outbound()
+        partial = flusher(
+            outbound, interval=0.0, min_chars=1, deltas=True, checkpoint_interval=0.0
+        )
+        partial.start()
+        for count, chunk in enumerate(("Hello", " world"), start=1):
+            partial.append(chunk)
+            await until(lambda: len(outbound.updates) == count)
+        await partial.close()
+        return outbound.updates
+
+    assert asyncio.run(run()) == [("partial", "Hello"), ("partial", "Hello world")]
@@ -0,0 +1,162 @@
+"""Startup of a generation: placeholder, thinking indicator, context and LLM call"""
+
+import asyncio
+import pytest
+from generation import open_generation
+from metrics import generation_metrics
+
+METRICS = generation_metrics("openai", "test")
+
+
+class Chat:
+    """Chat client and channel recording the calls. Creating a message blocks until
+    `created` is set, after Stream registered it."""
+
+    def __init__(self, event_error: Exception = None):
+        self.calls = []
+        self.received = asyncio.Event()
+        self.created = asyncio.Event()
+        self.event_error = event_error
+
+    async def send_message(self, message, user_id):
+        message_id = f"m{len(self.calls) + 1}"
+        self.calls.append(("created", message_id))
+        self.received.set()
+        await self.created.wait()
+        return {"message": {"id": message_id}}
+
+    async def send_event(self, event, user_id):
+        if self.event_error is not None:
+            raise self.event_error
+        self.calls.append(("event", event.get("ai_state") or event["type"]))
+
+    async def update_message_partial(self, message_id, update, user_id):
+        self.calls.append(("update", update["set"]["text"]))
+
+    async def delete_message(self, message_id, hard=False):
+        self.calls.append(("deleted", message_id))
+
+
+class Stream:
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+def start(chat, load_context, open_stream, pipelined=True):
+    return open_generation(
+        chat,
+        chat,
+        "ai-bot",
+        load_context,
+        open_stream,
+        METRICS,
+        0.0,
+        pipelined=pipelined,
+    )
+
+
+async def context():
+    return [{"role": "user", "content": "hi"}]
+
+
+def test_llm_is_called_while_the_placeholder_is_created():
+    async def run():
+        chat = Chat()
+        stream = Stream()
+
+        async def open_stream(messages):
+            # The placeholder is still being created
+            assert not chat.created.is_set()
+            chat.calls.append(("llm", len(messages)))
+            chat.created.set()
+            return stream
+
+        generation, opened = await start(chat, context, open_stream)
+        await generation.finish()
+        return chat.calls, generation.message_id, opened is stream
+
+    calls, message_id, opened = asyncio.run(run())
+    assert calls == [("created", "m1"), ("llm", 1), ("event", "AI_STATE_THINKING")]
+    assert message_id == "m1" and opened
+
+
+def test_failed_context_deletes_the_placeholder_still_being_created():
+    async def run():
+        chat = Chat()
+
+        async def failing_context():
+            await chat.received.wait()
+            # Stream answers once the startup already failed
+            asyncio.get_running_loop().call_soon(chat.created.set)
+            raise RuntimeError("history unavailable")
+
+        with pytest.raises(RuntimeError, match="history unavailable"):
+            await start(chat, failing_context, None)
+        return chat.calls
+
+    assert asyncio.run(run()) == [
+        ("created", "m1"),
+        ("event", "AI_STATE_THINKING"),
+        ("deleted", "m1"),
+    ]
+
+
+def test_cancelled_startup_deletes_the_placeholder_still_being_created():
+    async def run():
+        chat = Chat()
+        loading = asyncio.Event()
+
+        async def slow_context():
+            await loading.wait()
+
+        task = asyncio.create_task(start(chat, slow_context, None))
+        await chat.received.wait()
+        task.cancel()
+        await asyncio.sleep(0)
+        chat.created.set()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return chat.calls
+
+    calls = asyncio.run(run())
+    assert calls[0] == ("created", "m1")
+    assert calls[-1] == ("deleted", "m1")
+
+
+def test_failed_thinking_indicator_deletes_the_placeholder():
+    async def run():
+        chat = Chat(event_error=RuntimeError("event failed"))
+        chat.created.set()
+        stream = Stream()
+
+        async def open_stream(messages):
+            return stream
+
+        with pytest.raises(RuntimeError, match="event failed"):
+            await start(chat, context, open_stream)
+        return chat.calls, stream.closed
+
+    calls, closed = asyncio.run(run())
+    assert calls == [("created", "m1"), ("deleted", "m1")]
+    assert closed
+
+
+def test_failed_llm_call_keeps_the_placeholder_with_the_error_state():
+    async def run():
+        chat = Chat()
+        chat.created.set()
+
+        async def open_stream(messages):
+            raise RuntimeError("LLM down")
+
+        with pytest.raises(RuntimeError, match="LLM down"):
+            await start(chat, context, open_stream, pipelined=False)
+        return chat.calls
+
+    assert asyncio.run(run()) == [
+        ("created", "m1"),
+        ("event", "AI_STATE_THINKING"),
+        ("event", "AI_STATE_ERROR"),
+    ]
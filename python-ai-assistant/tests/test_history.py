@@ -0,0 +1,168 @@
+"""Cache of the recent conversation of the channels"""
+
+import asyncio
+from history import HistoryCache
+
+CID = "messaging:general"
+
+
+def message(message_id, text, user="u1", **fields):
+    return dict(id=message_id, text=text, user={"id": user}, **fields)
+
+
+class Chat:
+    """Search API returning `results`, newest first, and counting the searches"""
+
+    def __init__(self, results):
+        self.results = results
+        self.searches = 0
+
+    async def search(self, channel_filters, message_filters, sort, limit):
+        self.searches += 1
+        return {"results": [{"message": found} for found in self.results[:limit]]}
+
+
+def turns(history):
+    return [(item["role"], item["content"]) for item in history]
+
+
+def test_cold_channel_is_searched_once_then_fed_by_webhooks():
+    async def run():
+        chat = Chat([message("2", "How are you?"), message("1", "Hi")])
+        cache = HistoryCache(max_channels=10, max_messages=50)
+        first = await cache.get(chat, CID, 5)
+        cache.record(CID, message("3", " Fine thanks "))
+        cache.record_reply(CID, "4", "Good to hear", None)
+        second = await cache.get(chat, CID, 5)
+        return first, second, chat.searches, cache.stats()
+
+    first, second, searches, stats = asyncio.run(run())
+    assert turns(first) == [("user", "How are you?"), ("user", "Hi")]
+    assert turns(second) == [
+        ("assistant", "Good to hear"),
+        ("user", "Fine thanks"),
+        ("user", "How are you?"),
+        ("user", "Hi"),
+    ]
+    assert searches == 1
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_messages_recorded_before_the_search_are_kept_after_it():
+    async def run():
+        chat = Chat([message("2", "Second"), message("1", "First")])
+        cache = HistoryCache(max_channels=10, max_messages=50)
+        # Already returned by the search too, it is not repeated
+        cache.record(CID, message("2", "Second"))
+        cache.record(CID, message("3", "Third"))
+        return await cache.get(chat, CID, 5)
+
+    assert [item["id"] for item in asyncio.run(run())] == ["3", "2", "1"]
+
+
+def test_ignored_messages_and_bounded_buffers():
+    async def run():
+        cache = HistoryCache(max_channels=10, max_messages=3)
+        await cache.get(Chat([]), CID, 5)
+        for index in range(5):
+            cache.record(CID, message(str(index), f"message {index}"))
+        cache.record(CID, message("empty", "  "))
+        cache.record(CID, message("system", "joined", type="system"))
+        cache.record(CID, {"text": "no id"})
+        # The text of a known message is replaced, e.g. after an edit
+        cache.record(CID, message("4", "message 4 edited"))
+        cache.record(CID, message("bot", "answer", user="ai-bot-general"))
+        return await cache.get(Chat([]), CID, 10)
+
+    assert turns(asyncio.run(run())) == [
+        ("assistant", "answer"),
+        ("user", "message 4 edited"),
+        ("user", "message 3"),
+    ]
+
+
+def test_least_recently_used_channels_are_evicted_and_resynced():
+    async def run():
+        chat = Chat([message("1", "Hi")])
+        cache = HistoryCache(max_channels=2, max_messages=50)
+        for cid in ("messaging:a", "messaging:b", "messaging:a", "messaging:c"):
+            await cache.get(chat, cid, 5)
+        # b was the least recently used
+        await cache.get(chat, "messaging:b", 5)
+        cache.invalidate("messaging:b")
+        await cache.get(chat, "messaging:b", 5)
+        await cache.get(chat, "messaging:b", 5, resync=True)
+        return chat.searches, cache.stats()
+
+    searches, stats = asyncio.run(run())
+    assert searches == 6
+    assert stats["evictions"] == 2
+    assert stats["channels"] == 2
+
+
+class ThreadChat(Chat):
+    """Message and replies API of one thread, counting the reads"""
+
+    def __init__(self, parent, replies):
+        super().__init__([])
+        self.parent = parent
+        self.replies = replies
+        self.reads = 0
+
+    async def get_message(self, message_id):
+        self.reads += 1
+        return {"message": self.parent}
+
+    async def get_replies(self, parent_id, limit):
+        return {"messages": self.replies[-limit:]}
+
+
+def test_thread_is_loaded_from_its_replies_and_kept_apart_from_the_channel():
+    async def run():
+        # Replies are oldest first
+        chat = ThreadChat(
+            message("p", "Printer is broken"),
+            [
+                message("r1", "Which model?", user="ai-bot-general"),
+                message("r2", "The X100"),
+                message("r3", "joined", type="system"),
+            ],
+        )
+        cache = HistoryCache(max_channels=10, max_messages=50)
+        first = await cache.get_thread(chat, chat, CID, "p", 5)
+        cache.record(CID, message("r4", "Still broken", parent_id="p"))
+        cache.record(CID, message("top", "Unrelated", type="regular"))
+        cache.record_reply(CID, "r5", "Try turning it off", "p")
+        second = await cache.get_thread(chat, chat, CID, "p", 3)
+        return first, second, chat, cache.stats()
+
+    first, second, chat, stats = asyncio.run(run())
+    assert turns(first) == [
+        ("user", "The X100"),
+        ("assistant", "Which model?"),
+        ("user", "Printer is broken"),
+    ]
+    # The parent is always kept, after the newest replies
+    assert turns(second) == [
+        ("assistant", "Try turning it off"),
+        ("user", "Still broken"),
+        ("user", "Printer is broken"),
+    ]
+    assert (chat.reads, chat.searches) == (1, 0)
+    assert (stats["threads"], stats["hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_threads_are_bounded_and_invalidated_with_their_channel():
+    async def run():
+        chat = ThreadChat(message("p", "Parent"), [message("r1", "Reply")])
+        cache = HistoryCache(max_channels=10, max_messages=50, max_threads=1)
+        await cache.get_thread(chat, chat, CID, "p1", 5)
+        await cache.get_thread(chat, chat, CID, "p2", 5)
+        await cache.get_thread(chat, chat, CID, "p1", 5)
+        cache.invalidate(CID)
+        await cache.get_thread(chat, chat, CID, "p1", 5)
+        return chat.reads, cache.stats()
+
+    reads, stats = asyncio.run(run())
+    assert reads == 4
+    assert stats["evictions"] == 2
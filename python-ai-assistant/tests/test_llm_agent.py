@@ -0,0 +1,205 @@
+"""Answers of the LLM agent: streamed, stopped and failed"""
+
+import asyncio
+import pytest
+from conditions import until
+from context import ContextBuilder
+from history import HistoryCache
+from llm_agent import ChannelAgent, LLMAgent
+from model import NewMessageRequest
+from profiling import Profiler
+from providers import DONE, TEXT, LLMStream
+from registry import AgentBinding
+from response_cache import ResponseCache
+
+CID = "messaging:general"
+
+
+class Chat:
+    """Stream client and channel recording the calls"""
+
+    def __init__(self):
+        self.calls = []
+        self.channels = []
+
+    def channel(self, channel_type, channel_id):
+        self.channels.append(f"{channel_type}:{channel_id}")
+        return self
+
+    async def send_message(self, message, user_id):
+        self.calls.append(("created", message.get("parent_id")))
+        return {"message": {"id": "answer"}}
+
+    async def send_event(self, event, user_id):
+        self.calls.append(("event", event.get("ai_state") or event["type"]))
+
+    async def update_message_partial(self, message_id, update, user_id):
+        fields = update["set"]
+        self.calls.append(("update", fields["text"], fields["generating"]))
+
+    async def delete_message(self, message_id, hard=False):
+        self.calls.append(("deleted",))
+
+    async def search(self, channel_filters, message_filters, sort, limit):
+        self.calls.append(("search",))
+        return {"results": []}
+
+    async def get_message(self, message_id):
+        return {"message": {"id": message_id, "text": "Printer is broken"}}
+
+    async def get_replies(self, parent_id, limit):
+        return {"messages": [{"id": "r1", "text": "Which model?", "type": "reply"}]}
+
+
+class Clients:
+    def __init__(self):
+        self.stream = Chat()
+
+    def release(self):
+        pass
+
+
+class Response:
+    closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class Provider:
+    """Streams `chunks`, then waits for `finished` or raises `error`"""
+
+    name = "fake"
+    model = "fake-model"
+
+    def __init__(self, chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+        self.finished = asyncio.Event()
+        self.response = Response()
+
+    async def open(self, messages, params):
+        self.messages = messages
+
+        async def events():
+            for chunk in self.chunks:
+                yield TEXT, chunk
+            if self.error is not None:
+                raise self.error
+            await self.finished.wait()
+            yield DONE, None
+
+        return LLMStream(self.response, events(), self)
+
+
+def agent(provider, profiler=None):
+    return LLMAgent(
+        Clients(),
+        HistoryCache(10, 50),
+        ContextBuilder(3000, 1000),
+        ResponseCache(0, 1),
+        provider,
+        profiler or Profiler(0),
+    )
+
+
+def request(text="Hi", **fields):
+    return NewMessageRequest(
+        cid=CID, type="message.new", message={"id": "q", "text": text, **fields}
+    )
+
+
+BINDING = AgentBinding("ai-bot-general", "messaging", "general", "openai")
+
+
+def test_streamed_answer_is_completed_and_recorded():
+    async def run():
+        provider = Provider(["Hello", " there"])
+        provider.finished.set()
+        llm = agent(provider)
+        await llm.handle_message(BINDING, request())
+        history = await llm.history.get(llm.chat_client, CID, 5)
+        return llm.chat_client.calls, provider.response.closed, history
+
+    calls, closed, history = asyncio.run(run())
+    assert ("update", "Hello there", False) in calls
+    assert calls[-1] == ("event", "ai_indicator.clear")
+    assert closed
+    assert history[0]["content"] == "Hello there"
+
+
+def test_stopped_answer_saves_the_partial_text():
+    async def run():
+        provider = Provider(["Hello"])
+        llm = agent(provider)
+        task = asyncio.create_task(llm.handle_message(BINDING, request()))
+        await until(lambda: ("update", "Hello", True) in llm.chat_client.calls)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        history = await llm.history.get(llm.chat_client, CID, 5)
+        return llm.chat_client.calls, provider.response.closed, history
+
+    calls, closed, history = asyncio.run(run())
+    # Kept with the text generated so far, no longer generating
+    assert ("update", "Hello", False) in calls
+    assert calls[-1] == ("event", "ai_indicator.clear")
+    assert closed
+    assert history[0]["content"] == "Hello"
+
+
+def test_thread_message_is_answered_in_the_thread_with_its_context():
+    async def run():
+        provider = Provider(["The X100?"])
+        provider.finished.set()
+        llm = agent(provider)
+        await llm.handle_message(BINDING, request("Any idea?", parent_id="p"))
+        thread = await llm.history.get_thread(llm.chat_client, None, CID, "p", 5)
+        return llm.chat_client.calls, provider.messages, thread
+
+    calls, messages, thread = asyncio.run(run())
+    assert ("created", "p") in calls
+    assert ("search",) not in calls
+    assert [message["content"] for message in messages] == [
+        "Printer is broken",
+        "Which model?",
+        "Any idea?",
+    ]
+    assert thread[0]["content"] == "The X100?"
+
+
+def test_channel_agents_share_the_engine_and_answer_in_their_channel():
+    async def run():
+        provider = Provider(["Hello"])
+        provider.finished.set()
+        engine = agent(provider)
+        agents = [
+            ChannelAgent(
+                AgentBinding(f"ai-bot-{name}", "messaging", name, "openai"), engine
+            )
+            for name in ("general", "support")
+        ]
+        for channel_agent in agents:
+            await channel_agent.handle_message(request())
+            await channel_agent.dispose()
+        return engine.chat_client.channels, agents
+
+    channels, agents = asyncio.run(run())
+    assert channels == ["messaging:general", "messaging:support"]
+    assert not hasattr(agents[0], "__dict__")
+
+
+def test_profiled_generation_is_reported_with_its_timeline():
+    async def run():
+        provider = Provider(["Hello", " there"])
+        provider.finished.set()
+        llm = agent(provider, Profiler(1))
+        await llm.handle_message(BINDING, request())
+        return llm.profiler.report()
+
+    report = asyncio.run(run())
+    generation = report["generations"][0]
+    assert report["profiled"] == 1
+    assert (generation["message_id"], generation["outcome"]) == ("answer", "completed")
+    assert generation["chunks"]["count"] >= 2
+    assert generation["spans"]
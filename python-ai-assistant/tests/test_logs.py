@@ -0,0 +1,67 @@
+"""Logging off the event loop with the correlation ids of the task"""
+
+import asyncio
+import logging
+import queue
+import orjson
+from logs import (
+    ContextFilter,
+    JSONFormatter,
+    QueueHandler,
+    RateLimitFilter,
+    set_log_context,
+)
+
+
+def record(message="Chunk %s", level=logging.DEBUG, name="agent"):
+    return logging.LogRecord(name, level, __file__, 1, message, ("x",), None)
+
+
+def test_records_carry_the_ids_of_the_task_that_logged_them():
+    async def logged(cid, message_id):
+        set_log_context(cid=cid, bot_id=f"ai-bot-{cid}")
+        await asyncio.sleep(0)
+        set_log_context(message_id=message_id)
+        item = record()
+        ContextFilter().filter(item)
+        return item.cid, item.bot_id, item.message_id
+
+    async def run():
+        return await asyncio.gather(
+            asyncio.create_task(logged("a", "m1")),
+            asyncio.create_task(logged("b", "m2")),
+        )
+
+    assert asyncio.run(run()) == [("a", "ai-bot-a", "m1"), ("b", "ai-bot-b", "m2")]
+    outside = record()
+    ContextFilter().filter(outside)
+    assert (outside.cid, outside.bot_id, outside.message_id) == ("-", "-", "-")
+
+
+def test_debug_records_are_rate_limited_per_message():
+    limit = RateLimitFilter(rate=0.001, burst=2)
+    assert [limit.filter(record()) for _ in range(3)] == [True, True, False]
+    # Other messages and levels have their own budget
+    assert limit.filter(record("Skipped %s"))
+    assert limit.filter(record(level=logging.WARNING))
+    assert all(RateLimitFilter(rate=0).filter(record()) for _ in range(100))
+
+
+def test_records_are_formatted_as_json():
+    item = record("Failed to update %s", logging.WARNING)
+    ContextFilter().filter(item)
+    data = orjson.loads(JSONFormatter().format(item))
+    assert data["message"] == "Failed to update x"
+    assert (data["level"], data["logger"], data["cid"]) == ("WARNING", "agent", "-")
+
+
+def test_records_are_dropped_rather_than_waiting_for_the_writer():
+    records = queue.Queue(1)
+    handler = QueueHandler(records)
+    first, second = record(), record()
+    handler.handle(first)
+    handler.handle(second)
+    assert records.qsize() == 1
+    # Formatted by the writer thread, not by the task logging it
+    assert records.get_nowait() is first
+    assert first.msg == "Chunk %s"
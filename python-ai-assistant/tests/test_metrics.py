@@ -0,0 +1,66 @@
+"""Metrics in the Prometheus text format"""
+
+import pytest
+from metrics import (
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    generation_metrics,
+)
+from webhooks import type_label
+
+
+def test_counter_children_are_bound_once_and_rendered_with_their_labels():
+    counter = Counter("requests_total", "Requests", ("provider", "model"))
+    child = counter.labels("openai", 'gpt "4o"')
+    child.inc()
+    child.inc(2)
+    assert counter.labels("openai", 'gpt "4o"') is child
+    assert counter.render() == (
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{provider="openai",model="gpt \\"4o\\""} 3\n'
+    )
+    with pytest.raises(ValueError):
+        counter.labels("openai")
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "Latency", ("stage",), (0.1, 1.0))
+    child = histogram.labels("history")
+    for value in (0.05, 0.1, 0.5, 5.0):
+        child.observe(value)
+    assert histogram.samples() == [
+        'latency_seconds_bucket{stage="history",le="0.1"} 2',
+        'latency_seconds_bucket{stage="history",le="1.0"} 3',
+        'latency_seconds_bucket{stage="history",le="+Inf"} 4',
+        'latency_seconds_sum{stage="history"} 5.65',
+        'latency_seconds_count{stage="history"} 4',
+    ]
+
+
+def test_registry_renders_every_metric_and_gauges_read_their_function():
+    registry = Registry()
+    registry.register(Gauge("active_agents", "Agents", lambda: 7))
+    fixed = registry.register(Gauge("queue_depth", "Queued messages"))
+    fixed.set(2)
+    text = registry.render()
+    assert "# TYPE active_agents gauge\nactive_agents 7\n" in text
+    assert "queue_depth 2\n" in text
+
+
+def test_generation_metrics_are_shared_by_provider_and_model():
+    metrics = generation_metrics("openai", "test-model")
+    assert generation_metrics("openai", "test-model") is metrics
+    assert generation_metrics("anthropic", "test-model") is not metrics
+    before = metrics.completed.value
+    metrics.completed.inc()
+    assert generation_metrics("openai", "test-model").completed.value == before + 1
+
+
+def test_webhook_type_label_is_bounded():
+    assert type_label("message.new") == "message.new"
+    assert type_label("reaction.new") == "reaction.new"
+    assert type_label("made.up.type") == "other"
+    assert type_label(["message.new"]) == "other"
@@ -0,0 +1,60 @@
+"""Timelines of the generations and the report of the slowest ones"""
+
+import asyncio
+import time
+from profiling import Profiler, Timeline
+
+
+def timeline(profiler, message_id, seconds):
+    generation = profiler.begin("messaging:general", "ai-bot", "model", None)
+    generation.message_id = message_id
+    # Received `seconds` ago
+    generation.received_at = time.time() - seconds
+    return generation
+
+
+def test_disabled_profiler_creates_no_timeline():
+    profiler = Profiler(0)
+    profiler.start()
+    assert profiler.begin("messaging:general", "ai-bot", "model", None) is None
+    assert profiler.report() == {"enabled": False, "profiled": 0, "generations": []}
+
+
+def test_only_the_slowest_generations_are_kept_slowest_first():
+    profiler = Profiler(2)
+    for message_id, seconds in (("m1", 1.0), ("m2", 3.0), ("m3", 0.5), ("m4", 2.0)):
+        profiler.end(timeline(profiler, message_id, seconds))
+    report = profiler.report()
+    assert report["profiled"] == 4
+    assert [item["message_id"] for item in report["generations"]] == ["m2", "m4"]
+    assert profiler.folded().startswith("m2;generation;queued ")
+
+
+def test_timeline_records_spans_and_the_wait_for_each_chunk():
+    async def run():
+        generation = Timeline("messaging:general", "ai-bot", "model", time.time())
+
+        async def events():
+            for chunk in ("Hel", "lo"):
+                yield "text", chunk
+
+        received = [event async for event in generation.stream(events())]
+        began = generation.started
+        generation.span("history", began, began + 0.25)
+        generation.span("flush;update", began + 0.25, began + 0.3)
+        generation.span("flush;update", began + 0.3, began + 0.4)
+        return received, generation
+
+    received, generation = asyncio.run(run())
+    assert received == [("text", "Hel"), ("text", "lo")]
+    data = generation.to_dict()
+    assert data["chunks"]["count"] == 2
+    assert data["spans"][0] == {
+        "name": "history",
+        "start_ms": 0.0,
+        "duration_ms": 250.0,
+    }
+    folded = dict(line.rsplit(" ", 1) for line in generation.folded())
+    assert folded["generation;history"] == "250000"
+    # Spans with the same name add up
+    assert folded["generation;flush;update"] == "150000"
@@ -0,0 +1,177 @@
+"""Provider selection and the hedged requests"""
+
+import asyncio
+import pytest
+from config import Settings
+from providers import (
+    DONE,
+    HEDGED,
+    TEXT,
+    USAGE,
+    AnthropicProvider,
+    HedgedProvider,
+    OpenAIProvider,
+    Provider,
+    create_provider,
+)
+
+
+class Response:
+    """Streamed response of a fake provider"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeProvider(Provider):
+    """Answers after `opened` is set, or fails with `error`"""
+
+    name = "fake"
+
+    def __init__(self, name: str, error: Exception = None):
+        super().__init__(None, name)
+        self.opened = asyncio.Event()
+        self.error = error
+        self.responses = []
+
+    async def _create(self, messages, params):
+        await self.opened.wait()
+        if self.error is not None:
+            raise self.error
+        response = Response(self.model)
+        self.responses.append(response)
+        return response
+
+    async def _events(self, response):
+        yield USAGE, (10, 0, 0)
+        yield TEXT, response.name
+        yield DONE, None
+
+
+class OpensOther(FakeProvider):
+    """Answers right away and lets `other` answer in the same loop iteration"""
+
+    def __init__(self, name: str, other: FakeProvider):
+        super().__init__(name)
+        self.other = other
+        self.opened.set()
+
+    async def _create(self, messages, params):
+        self.other.opened.set()
+        return await super()._create(messages, params)
+
+
+async def read(stream):
+    return [event async for event in stream]
+
+
+def winners():
+    return HEDGED.labels("primary").value, HEDGED.labels("hedge").value
+
+
+def test_platform_selects_the_provider():
+    class Clients:
+        def openai(self):
+            return "openai client"
+
+        def anthropic(self):
+            return "anthropic client"
+
+    settings = Settings(None, None, None, None)
+    openai = create_provider("openai", Clients(), settings)
+    anthropic = create_provider("anthropic", Clients(), settings)
+    assert isinstance(openai, OpenAIProvider) and openai.client == "openai client"
+    assert isinstance(anthropic, AnthropicProvider)
+    assert anthropic.client == "anthropic client"
+    with pytest.raises(ValueError):
+        create_provider("llama", Clients(), settings)
+
+
+def test_fast_primary_is_not_hedged():
+    async def run():
+        primary, hedge = FakeProvider("primary"), FakeProvider("hedge")
+        primary.opened.set()
+        stream = await HedgedProvider(primary, hedge, 10).open([], {})
+        return await read(stream), primary, hedge
+
+    events, primary, hedge = asyncio.run(run())
+    assert events == [(USAGE, (10, 0, 0)), (TEXT, "primary"), (DONE, None)]
+    assert not primary.responses[0].closed
+    assert hedge.responses == []
+
+
+def test_hedge_answering_first_closes_the_primary():
+    async def run():
+        primary = FakeProvider("primary")
+        hedge = FakeProvider("hedge")
+        hedge.opened.set()
+        before = winners()
+        stream = await HedgedProvider(primary, hedge, 0).open([], {})
+        # The request of the primary was cancelled before it answered
+        events = await read(stream)
+        return events, primary, hedge, before
+
+    events, primary, hedge, before = asyncio.run(run())
+    assert (TEXT, "hedge") in events
+    assert not hedge.responses[0].closed
+    assert primary.responses == []
+    assert winners() == (before[0], before[1] + 1)
+
+
+def test_primary_wins_when_both_answer_at_once():
+    async def run():
+        primary = FakeProvider("primary")
+        hedge = OpensOther("hedge", primary)
+        before = winners()
+        stream = await HedgedProvider(primary, hedge, 0).open([], {})
+        return await read(stream), primary, hedge, before
+
+    # Repeated, the tasks done together come out of a set in any order
+    for _ in range(20):
+        events, primary, hedge, before = asyncio.run(run())
+        assert (TEXT, "primary") in events
+        assert not primary.responses[0].closed
+        assert hedge.responses[0].closed
+        assert winners() == (before[0] + 1, before[1])
+
+
+def test_failed_primary_falls_back_to_the_hedge():
+    async def run():
+        primary = FakeProvider("primary", RuntimeError("primary down"))
+        hedge = FakeProvider("hedge")
+        primary.opened.set()
+        hedge.opened.set()
+        stream = await HedgedProvider(primary, hedge, 10).open([], {})
+        return await read(stream)
+
+    assert (TEXT, "hedge") in asyncio.run(run())
+
+
+def test_error_of_the_primary_is_raised_when_both_fail():
+    async def run():
+        primary = FakeProvider("primary", RuntimeError("primary down"))
+        hedge = FakeProvider("hedge", RuntimeError("hedge down"))
+        primary.opened.set()
+        hedge.opened.set()
+        await HedgedProvider(primary, hedge, 0).open([], {})
+
+    with pytest.raises(RuntimeError, match="primary down"):
+        asyncio.run(run())
+
+
+def test_cancelled_open_closes_every_stream():
+    async def run():
+        primary, hedge = FakeProvider("primary"), FakeProvider("hedge")
+        task = asyncio.create_task(HedgedProvider(primary, hedge, 0).open([], {}))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        return primary, hedge
+
+    primary, hedge = asyncio.run(run())
+    assert primary.responses == [] and hedge.responses == []
@@ -0,0 +1,113 @@
+"""Provisioning of the bot users and their channel memberships"""
+
+import asyncio
+from conditions import until
+from provisioning import UPSERT_BATCH_SIZE, ProvisioningCache, Provisioner
+
+
+class Chat:
+    """Records the writes, membership adds are held until `added` is set"""
+
+    def __init__(self, failing_channels=()):
+        self.upserts = []
+        self.members = []
+        self.adding = 0
+        self.max_adding = 0
+        self.added = asyncio.Event()
+        self.added.set()
+        self.failing_channels = failing_channels
+
+    async def upsert_user(self, user):
+        self.upserts.append([user["id"]])
+
+    async def upsert_users(self, users):
+        self.upserts.append([user["id"] for user in users])
+
+    def channel(self, channel_type, channel_id):
+        return Channel(self, channel_id)
+
+
+class Channel:
+    def __init__(self, chat, channel_id):
+        self.chat = chat
+        self.channel_id = channel_id
+
+    async def add_members(self, user_ids):
+        chat = self.chat
+        chat.adding += 1
+        chat.max_adding = max(chat.max_adding, chat.adding)
+        try:
+            await chat.added.wait()
+            if self.channel_id in chat.failing_channels:
+                raise RuntimeError("Channel not found")
+            chat.members.append((self.channel_id, user_ids))
+        finally:
+            chat.adding -= 1
+
+
+def channels(count):
+    return [("messaging", f"c{index}", f"bot-{index}") for index in range(count)]
+
+
+def test_users_are_upserted_in_batches_and_cached():
+    async def run():
+        provisioner = Provisioner(ProvisioningCache(ttl=60.0))
+        chat = Chat()
+        many = channels(UPSERT_BATCH_SIZE + 1)
+        await provisioner.provision(chat, many)
+        first = [len(batch) for batch in chat.upserts]
+        chat.upserts.clear()
+        await provisioner.provision(chat, many + channels(UPSERT_BATCH_SIZE + 2))
+        return first, chat.upserts
+
+    first, second = asyncio.run(run())
+    assert first == [UPSERT_BATCH_SIZE, 1]
+    assert second == [[f"bot-{UPSERT_BATCH_SIZE + 1}"]]
+
+
+def test_cached_memberships_are_only_trusted_for_bound_agents():
+    async def run():
+        provisioner = Provisioner(ProvisioningCache(ttl=60.0))
+        chat = Chat()
+        await provisioner.provision(chat, channels(1))
+        await provisioner.provision(chat, channels(1), bound={"bot-0"})
+        added_once = len(chat.members)
+        # Stopped since, possibly by another worker
+        await provisioner.provision(chat, channels(1))
+        return added_once, len(chat.members)
+
+    assert asyncio.run(run()) == (1, 2)
+
+
+def test_membership_adds_are_bounded_and_failures_reported_per_bot():
+    async def run():
+        provisioner = Provisioner(ProvisioningCache(ttl=60.0), max_concurrent_adds=3)
+        chat = Chat(failing_channels={"c4"})
+        chat.added.clear()
+        provisioning = asyncio.create_task(provisioner.provision(chat, channels(10)))
+        await until(lambda: chat.adding == 3)
+        chat.added.set()
+        errors = await provisioning
+        return chat, errors, provisioner.cache
+
+    chat, errors, cache = asyncio.run(run())
+    assert chat.max_adding == 3
+    assert errors["bot-4"] == "Channel not found"
+    assert all(error is None for bot_id, error in errors.items() if bot_id != "bot-4")
+    assert not cache.is_member("messaging", "c4")
+    assert cache.is_member("messaging", "c5")
+
+
+def test_cache_entries_expire_and_are_bounded():
+    cache = ProvisioningCache(ttl=60.0, max_size=2)
+    cache.add_user("a")
+    cache.add_member("messaging", "c1")
+    cache.add_user("b")
+    assert not cache.has_user("a")
+    assert cache.is_member("messaging", "c1") and cache.has_user("b")
+    cache.remove_member("messaging", "c1")
+    assert not cache.is_member("messaging", "c1")
+
+    disabled = ProvisioningCache(ttl=0.0)
+    disabled.add_user("a")
+    assert not disabled.has_user("a")
@@ -0,0 +1,104 @@
+"""Rate budget of the calls made to the Stream API"""
+
+import asyncio
+import time
+from email.utils import formatdate
+import pytest
+from stream_chat import StreamChatAsync
+from clients import GovernedStreamChat, StreamRateLimited
+from rate_limit import StreamRateGovernor, TokenBucket, endpoint_class, retry_after
+
+
+def test_endpoint_classes():
+    assert endpoint_class("post", "messages/m1") == "update_message"
+    assert endpoint_class("put", "messages/m1") == "update_message"
+    assert endpoint_class("delete", "messages/m1") == "default"
+    assert endpoint_class("post", "channels/messaging/c1/event") == "send_event"
+    assert endpoint_class("post", "channels/messaging/c1/message") == "send_message"
+    assert endpoint_class("get", "search") == "search"
+
+
+def test_retry_after_headers():
+    assert retry_after({"Retry-After": "2.5"}) == 2.5
+    date = retry_after({"Retry-After": formatdate(time.time() + 30, usegmt=True)})
+    assert 25 < date <= 30
+    reset = retry_after({"X-RateLimit-Reset": str(int(time.time()) + 10)})
+    assert 5 < reset <= 10
+    assert retry_after({"Retry-After": "soon"}) is None
+    assert retry_after({}) is None
+
+
+def test_bucket_allows_a_burst_then_waits():
+    async def run():
+        bucket = TokenBucket(max_rate=1000.0, burst=3)
+        burst = [await bucket.acquire() for _ in range(3)]
+        return burst, await bucket.acquire()
+
+    burst, waited = asyncio.run(run())
+    assert burst == [False] * 3
+    assert waited
+
+
+def test_bucket_is_slowed_down_and_blocked_after_a_429():
+    bucket = TokenBucket(max_rate=100.0)
+    bucket.back_off(30.0)
+    assert bucket.rate == 50.0
+    assert not bucket.available()
+    for _ in range(10):
+        bucket.back_off(0.0)
+    assert bucket.rate == bucket.min_rate == 5.0
+
+
+def test_partial_updates_leave_a_reserve_of_the_budget_to_final_updates():
+    governor = StreamRateGovernor(rates={"update_message": 10.0}, update_reserve=0.2)
+    bucket = governor.bucket("update_message")
+    # No refill while the test runs
+    bucket._updated = float("inf")
+    bucket.tokens = 3.0
+    assert governor.can_update()
+    bucket.tokens = 2.5
+    assert not governor.can_update()
+    # Other calls still use the whole budget
+    assert bucket.available()
+
+
+def test_backoff_doubles_without_retry_after_and_resets_on_success():
+    governor = StreamRateGovernor()
+    delays = [governor.rate_limited("search", None) for _ in range(3)]
+    governor.succeeded("search")
+    assert delays == [0.5, 1.0, 2.0]
+    assert governor.rate_limited("search", None) == 0.5
+    assert governor.rate_limited("unknown", 4.0) == 4.0
+    assert governor.bucket("unknown") is governor.buckets["default"]
+
+
+def test_rate_limited_calls_are_retried(monkeypatch):
+    answers = []
+
+    async def make_request(self, method, relative_url, params=None, data=None):
+        if len(answers) < 2:
+            answers.append(429)
+            raise StreamRateLimited("Too many requests", 429, 0.0)
+        answers.append(200)
+        return {"ok": True}
+
+    monkeypatch.setattr(StreamChatAsync, "_make_request", make_request)
+
+    async def run():
+        governor = StreamRateGovernor(max_retries=2)
+        chat = GovernedStreamChat("key", "secret", governor=governor)
+        try:
+            response = await chat._make_request(
+                chat.session.post, "messages/m1", data={}
+            )
+            answers.clear()
+            failing = StreamRateGovernor(max_retries=1)
+            chat.governor = failing
+            with pytest.raises(StreamRateLimited):
+                await chat._make_request(chat.session.post, "messages/m1", data={})
+        finally:
+            await chat.close()
+        return response
+
+    assert asyncio.run(run()) == {"ok": True}
+    assert answers == [429, 429]
@@ -0,0 +1,103 @@
+"""Eviction and rebuilding of the agents of the channels"""
+
+import asyncio
+from registry import AgentBinding, AgentRegistry
+
+
+class Agent:
+    def __init__(self, binding):
+        self.binding = binding
+        self.disposed = False
+
+    async def dispose(self):
+        self.disposed = True
+
+
+def binding(bot_id, platform="openai"):
+    return AgentBinding(bot_id, "messaging", bot_id, platform)
+
+
+def registry(busy=(), **options):
+    values = dict(idle_ttl=60.0, max_size=10, reap_interval=60.0)
+    values.update(options)
+    return AgentRegistry(Agent, is_busy=lambda bot_id: bot_id in busy, **values)
+
+
+def test_idle_agents_are_evicted_and_rebuilt_on_the_next_message():
+    async def run():
+        agents = registry(idle_ttl=0.0)
+        first = Agent(binding("a"))
+        agents.register(first.binding, first)
+        await agents.reap()
+        evicted = agents.stats()
+        rebuilt = agents.get("a")
+        return first, rebuilt, evicted, agents.stats()
+
+    first, rebuilt, evicted, stats = asyncio.run(run())
+    assert first.disposed
+    assert evicted == {"resident": 0, "evicted": 1, "evictions": 1, "rehydrations": 0}
+    assert rebuilt is not first
+    assert rebuilt.binding == first.binding
+    assert stats == {"resident": 1, "evicted": 0, "evictions": 1, "rehydrations": 1}
+
+
+def test_least_recently_used_agents_above_max_size_are_evicted():
+    async def run():
+        agents = registry(max_size=2)
+        built = {}
+        for bot_id in ("a", "b"):
+            built[bot_id] = Agent(binding(bot_id))
+            agents.register(built[bot_id].binding, built[bot_id])
+        agents.get("a")
+        built["c"] = Agent(binding("c"))
+        agents.register(built["c"].binding, built["c"])
+        await agents.reap()
+        return agents, built
+
+    agents, built = asyncio.run(run())
+    assert built["b"].disposed
+    assert not built["a"].disposed and not built["c"].disposed
+    assert sorted(agents.keys()) == ["a", "b", "c"]
+    assert (agents.resident_count, agents.evicted_count) == (2, 1)
+
+
+def test_busy_agents_are_not_evicted_nor_replaced():
+    async def run():
+        agents = registry(busy={"a"}, idle_ttl=0.0, max_size=1)
+        first = Agent(binding("a"))
+        agents.register(first.binding, first)
+        agents.register(binding("b"), Agent(binding("b")))
+        agents.bind(binding("a", platform="anthropic"))
+        await agents.reap()
+        return first, agents.get("a")
+
+    first, current = asyncio.run(run())
+    assert not first.disposed
+    assert current is first
+
+
+def test_bound_channel_is_built_on_demand_and_removed_ones_are_forgotten():
+    async def run():
+        agents = registry()
+        agents.bind(binding("a", platform="anthropic"))
+        built = agents.get("a")
+        removed = agents.remove("a")
+        await agents.close()
+        return built, removed, agents.get("a"), len(agents)
+
+    built, removed, missing, count = asyncio.run(run())
+    assert built.binding.platform == "anthropic"
+    assert removed is built
+    assert missing is None
+    assert count == 0
+
+
+def test_bindings_are_compact_and_share_their_common_strings():
+    first = AgentBinding("ai-bot-a", "messaging", "a", "openai")
+    second = AgentBinding(
+        "ai-bot-b", "".join(["messa", "ging"]), "b", "".join(["open", "ai"])
+    )
+    assert not hasattr(first, "__dict__")
+    assert first.channel_type is second.channel_type
+    assert first.platform is second.platform
+    assert second.cid == "messaging:b"
@@ -0,0 +1,106 @@
+"""Cached answers and prompt caching"""
+
+import asyncio
+from types import SimpleNamespace
+from context import count_tokens
+from providers import with_cache_breakpoint
+from response_cache import CachedRequest, CachedResponse, ResponseCache
+
+PARAMS = {"temperature": 0.7}
+
+
+def conversation(text):
+    return [{"role": "user", "content": text}]
+
+
+def test_key_ignores_whitespace_but_not_the_model_or_parameters():
+    key = ResponseCache.key("model", PARAMS, conversation("How do I  reset\nit?"))
+    assert key == ResponseCache.key(
+        "model", PARAMS, conversation(" How do I reset it?")
+    )
+    assert key != ResponseCache.key("other", PARAMS, conversation("How do I reset it?"))
+    assert key != ResponseCache.key("model", {}, conversation("How do I reset it?"))
+    assert key != ResponseCache.key("model", PARAMS, conversation("How do I reset?"))
+
+
+def test_hits_count_the_savings_and_old_answers_expire_or_are_evicted():
+    cache = ResponseCache(max_size=2, ttl=60.0)
+    cache.put("a", "Answer a", prompt_tokens=10, seconds=2.0)
+    cache.put("b", "Answer b", prompt_tokens=10, seconds=1.0)
+    assert cache.get("a").text == "Answer a"
+    # b is the least recently used
+    cache.put("c", "Answer c", prompt_tokens=10, seconds=1.0)
+    assert cache.get("b") is None
+    cache.put("d", "", prompt_tokens=10, seconds=1.0)
+    assert cache.get("d") is None
+    expired = ResponseCache(max_size=2, ttl=0.0)
+    expired.put("a", "Answer a", prompt_tokens=10, seconds=2.0)
+    assert expired.get("a") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["size"]) == (1, 2, 2)
+    assert stats["hitRate"] == round(1 / 3, 4)
+    assert stats["savedTokens"] == 10 + count_tokens("Answer a")
+    assert stats["savedSeconds"] == 2.0
+
+
+def test_request_is_answered_from_the_cache_once_completed():
+    async def run():
+        cache = ResponseCache(max_size=10, ttl=60.0)
+        created = []
+
+        async def create(messages, params):
+            created.append(messages)
+            return "stream"
+
+        first = CachedRequest(cache, "model", PARAMS)
+        stream = await first.open(conversation("Hi"), create)
+        first.store(SimpleNamespace(outcome="cancelled", prompt_tokens=0), "Hel")
+        retried = CachedRequest(cache, "model", PARAMS)
+        await retried.open(conversation("Hi"), create)
+        retried.store(SimpleNamespace(outcome="completed", prompt_tokens=0), "Hello")
+        replayed = await CachedRequest(cache, "model", PARAMS).open(
+            conversation("Hi"), create
+        )
+        return stream, replayed, len(created)
+
+    stream, replayed, created = asyncio.run(run())
+    assert stream == "stream"
+    assert isinstance(replayed, CachedResponse)
+    assert replayed.text == "Hello"
+    assert created == 2
+
+
+def test_disabled_cache_always_calls_the_llm():
+    async def run():
+        cache = ResponseCache(max_size=0, ttl=60.0)
+
+        async def create(messages, params):
+            return "stream"
+
+        request = CachedRequest(cache, "model", PARAMS)
+        stream = await request.open(conversation("Hi"), create)
+        request.store(SimpleNamespace(outcome="completed", prompt_tokens=0), "Hello")
+        return stream, cache.stats()
+
+    stream, stats = asyncio.run(run())
+    assert stream == "stream"
+    assert (stats["enabled"], stats["hits"], stats["misses"]) == (False, 0, 0)
+
+
+def test_turns_before_the_new_message_are_marked_as_a_cached_prefix():
+    messages = [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello!"},
+        {"role": "user", "content": "Thanks"},
+    ]
+    marked = with_cache_breakpoint(messages)
+    assert marked[0] == messages[0]
+    assert marked[1] == {
+        "role": "assistant",
+        "content": [
+            {"type": "text", "text": "Hello!", "cache_control": {"type": "ephemeral"}}
+        ],
+    }
+    assert marked[2] == messages[2]
+    assert with_cache_breakpoint(messages[:1]) == messages[:1]
@@ -0,0 +1,183 @@
+"""Per-channel queues of the scheduler: cancellation and shutdown"""
+
+import asyncio
+from conditions import until
+from model import NewMessageRequest
+from scheduler import ChannelScheduler
+
+
+def message(message_id: str) -> NewMessageRequest:
+    return NewMessageRequest(
+        cid="messaging:general",
+        type="message.new",
+        message={"id": message_id, "text": f"message {message_id}"},
+    )
+
+
+class Agent:
+    """Handler recording how each message ended, answers once its gate is opened"""
+
+    def __init__(self, answered: bool = False):
+        self.started = []
+        self.outcomes = []
+        self.running = 0
+        self.max_running = 0
+        self.gates = {}
+        self.answered = answered
+
+    def gate(self, message_id: str) -> asyncio.Event:
+        gate = self.gates.setdefault(message_id, asyncio.Event())
+        if self.answered:
+            gate.set()
+        return gate
+
+    async def handle(self, request: NewMessageRequest):
+        message_id = request.message["id"]
+        self.started.append(message_id)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            # Yields to the loop at least once, like a real answer
+            await asyncio.sleep(0)
+            await self.gate(message_id).wait()
+        except asyncio.CancelledError:
+            self.outcomes.append((message_id, "cancelled"))
+            raise
+        finally:
+            self.running -= 1
+        self.outcomes.append((message_id, "answered"))
+
+
+def test_messages_of_a_channel_are_answered_in_order():
+    async def run():
+        scheduler = ChannelScheduler(max_concurrent=4)
+        agent = Agent(answered=True)
+        for message_id in "123":
+            scheduler.submit("bot", agent.handle, message(message_id))
+        await until(lambda: not scheduler.is_busy("bot"))
+        return agent
+
+    agent = asyncio.run(run())
+    assert agent.outcomes == [("1", "answered"), ("2", "answered"), ("3", "answered")]
+    assert agent.max_running == 1
+
+
+def test_channels_are_answered_concurrently_up_to_the_limit():
+    async def run():
+        scheduler = ChannelScheduler(max_concurrent=2)
+        agent = Agent()
+        for key in "abc":
+            scheduler.submit(key, agent.handle, message(key))
+        await until(lambda: len(agent.started) == 2 and scheduler.waiting == 1)
+        started = list(agent.started)
+        agent.gate(started[0]).set()
+        await until(lambda: len(agent.started) == 3)
+        for key in "abc":
+            agent.gate(key).set()
+        await until(lambda: len(agent.outcomes) == 3)
+        return started, agent
+
+    started, agent = asyncio.run(run())
+    assert started == ["a", "b"]
+    assert agent.max_running == 2
+
+
+def test_new_message_cancels_the_running_answer():
+    async def run():
+        scheduler = ChannelScheduler(max_concurrent=4)
+        agent = Agent()
+        scheduler.submit("bot", agent.handle, message("1"))
+        await until(lambda: agent.started == ["1"])
+        # What the worker does for a user message with CANCEL_ON_NEW_MESSAGE
+        scheduler.cancel("bot")
+        scheduler.submit("bot", agent.handle, message("2"))
+        agent.gate("2").set()
+        await until(lambda: len(agent.outcomes) == 2)
+        return agent.outcomes, scheduler.cancelled
+
+    outcomes, cancelled = asyncio.run(run())
+    assert outcomes == [("1", "cancelled"), ("2", "answered")]
+    assert cancelled == 1
+
+
+def test_cancel_without_a_running_answer():
+    async def run():
+        scheduler = ChannelScheduler(max_concurrent=4)
+        return scheduler.cancel("bot")
+
+    assert asyncio.run(run()) is None
+
+
+def test_drain_waits_for_the_running_answers():
+    async def run():
+        scheduler = ChannelScheduler(max_concurrent=4)
+        agent = Agent()
+        scheduler.submit("bot", agent.handle, message("1"))
+        await until(lambda: agent.started == ["1"])
+        drain = asyncio.create_task(scheduler.drain(timeout=30, finalize_timeout=1))
+        await until(lambda: scheduler.closing)
+        assert not drain.done()
+        agent.gate("1").set()
+        return agent.outcomes, await drain
+
+    outcomes, cancelled = asyncio.run(run())
+    assert outcomes == [("1", "answered")]
+    assert cancelled == 0
+
+
+def test_drain_cancels_the_slow_answers_and_keeps_the_queued_messages():
+    async def run():
+        scheduler = ChannelScheduler(max_concurrent=1)
+        agent = Agent()
+        scheduler.submit("a", agent.handle, message("1"))
+        scheduler.submit("a", agent.handle, message("2"))
+        # Waits for the only generation slot
+        scheduler.submit("b", agent.handle, message("3"))
+        await until(lambda: agent.started == ["1"] and scheduler.waiting == 1)
+
+        # Answer 1 never ends, it is cancelled after the timeout
+        cancelled = await scheduler.drain(timeout=0.01, finalize_timeout=30)
+        # Queued on shutdown, never started
+        scheduler.submit("b", agent.handle, message("4"))
+        queued = [
+            (key, request.message["id"]) for key, request in scheduler.take_queued()
+        ]
+        return agent.outcomes, cancelled, queued, scheduler.queue_depth
+
+    outcomes, cancelled, queued, depth = asyncio.run(run())
+    assert outcomes == [("1", "cancelled")]
+    assert cancelled == 1
+    assert queued == [("a", "2"), ("b", "3"), ("b", "4")]
+    assert depth == 0
+
+
+def test_merged_queue_answers_the_latest_message_of_each_thread():
+    def threaded(message_id, parent_id=None, **fields):
+        request = message(message_id)
+        request.message.update(fields)
+        if parent_id:
+            request.message["parent_id"] = parent_id
+        return request
+
+    async def run():
+        scheduler = ChannelScheduler(max_concurrent=4, merge_queued=True)
+        agent = Agent()
+        scheduler.submit("bot", agent.handle, message("1"))
+        await until(lambda: agent.started == ["1"])
+        # Piled up while 1 is answered
+        for request in (
+            threaded("2"),
+            threaded("t1", parent_id="p"),
+            threaded("3"),
+            threaded("ai", ai_generated=True),
+            threaded("t2", parent_id="p"),
+        ):
+            scheduler.submit("bot", agent.handle, request)
+        for message_id in ("1", "3", "t2"):
+            agent.gate(message_id).set()
+        await until(lambda: not scheduler.is_busy("bot"))
+        return agent.started
+
+    # The newest user message first, then the newest one of the channel. The
+    # merged ones are in the history, the answers see them.
+    assert asyncio.run(run()) == ["1", "t2", "3"]
@@ -0,0 +1,114 @@
+"""Order of the calls of the outbound sequencer, and the calls it drops"""
+
+import asyncio
+from conditions import until
+from sequencer import OutboundSequencer
+
+
+class Recorder:
+    """
+    Chat client and channel recording the calls. The first call is sent once
+    `first_sent` is set, the others right away.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.started = 0
+        self.first_sent = asyncio.Event()
+        self.first_sent.set()
+
+    async def _record(self, call):
+        self.started += 1
+        if self.started == 1:
+            await self.first_sent.wait()
+        self.calls.append(call)
+
+    async def send_event(self, event, user_id):
+        await self._record(event.get("ai_state") or event["type"])
+
+    async def update_message_partial(self, message_id, update, user_id):
+        fields = update["set"]
+        kind = "partial" if fields["generating"] else "final"
+        await self._record((kind, fields["text"]))
+
+
+def sequencer(recorder):
+    return OutboundSequencer(recorder, recorder, "m1", "ai-bot")
+
+
+def test_calls_run_in_the_order_they_were_made():
+    async def run():
+        recorder = Recorder()
+        recorder.first_sent.clear()
+        sequence = sequencer(recorder)
+        calls = asyncio.gather(
+            sequence.indicator("AI_STATE_GENERATING"),
+            sequence.partial("Hel"),
+            sequence.partial("Hello"),
+            sequence.final("Hello!"),
+            sequence.clear(),
+        )
+        await until(lambda: sequence.sequence == 5)
+        # The later calls wait for the first one, which is slower
+        assert recorder.started == 1
+        recorder.first_sent.set()
+        await calls
+        return recorder.calls, sequence
+
+    calls, sequence = asyncio.run(run())
+    assert calls == [
+        "AI_STATE_GENERATING",
+        ("partial", "Hel"),
+        ("partial", "Hello"),
+        ("final", "Hello!"),
+        "ai_indicator.clear",
+    ]
+    assert (sequence.sequence, sequence.completed, sequence.dropped) == (5, 5, 0)
+
+
+def test_updates_after_the_final_one_are_dropped():
+    async def run():
+        recorder = Recorder()
+        sequence = sequencer(recorder)
+        await sequence.partial("Hel")
+        await sequence.final("Hello")
+        await sequence.partial("Hello wor")
+        await sequence.delta(5, " wor")
+        await sequence.final("Hello world")
+        await sequence.clear()
+        return recorder.calls, sequence.dropped
+
+    calls, dropped = asyncio.run(run())
+    assert calls == [("partial", "Hel"), ("final", "Hello"), "ai_indicator.clear"]
+    assert dropped == 3
+
+
+def test_nothing_is_sent_after_the_clear():
+    async def run():
+        recorder = Recorder()
+        sequence = sequencer(recorder)
+        await sequence.indicator("AI_STATE_THINKING")
+        await sequence.clear()
+        await sequence.indicator("AI_STATE_GENERATING")
+        await sequence.partial("Hel")
+        await sequence.delta(0, "Hel")
+        await sequence.clear()
+        return recorder.calls, sequence.dropped
+
+    calls, dropped = asyncio.run(run())
+    assert calls == ["AI_STATE_THINKING", "ai_indicator.clear"]
+    assert dropped == 4
+
+
+def test_repeated_indicator_state_is_dropped():
+    async def run():
+        recorder = Recorder()
+        sequence = sequencer(recorder)
+        await sequence.indicator("AI_STATE_THINKING")
+        await sequence.indicator("AI_STATE_THINKING")
+        await sequence.indicator("AI_STATE_GENERATING")
+        return recorder.calls, sequence.dropped
+
+    calls, dropped = asyncio.run(run())
+    assert calls == ["AI_STATE_THINKING", "AI_STATE_GENERATING"]
+    assert dropped == 1
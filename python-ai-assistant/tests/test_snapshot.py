@@ -0,0 +1,30 @@
+"""Snapshot of the agent bindings kept across restarts"""
+
+from helpers import create_bot_id
+from registry import AgentBinding
+from snapshot import load_snapshot, save_snapshot
+
+
+def binding(channel_id, platform="openai"):
+    return AgentBinding(
+        create_bot_id(channel_id=channel_id), "messaging", channel_id, platform
+    )
+
+
+def test_bindings_are_restored_with_their_bot_id(tmp_path):
+    path = str(tmp_path / "agents.json")
+    bindings = [binding("general"), binding("support", "anthropic")]
+    save_snapshot(path, bindings)
+    assert load_snapshot(path) == bindings
+    # Replaced at once, no temporary file is left behind
+    assert [item.name for item in tmp_path.iterdir()] == ["agents.json"]
+
+
+def test_missing_or_unreadable_snapshots_restore_nothing(tmp_path):
+    assert load_snapshot(str(tmp_path / "missing.json")) == []
+    for content in (b"{not json", b"[]", b'{"version": 99, "bindings": []}'):
+        path = tmp_path / "agents.json"
+        path.write_bytes(content)
+        assert load_snapshot(str(path)) == []
+    path.write_bytes(b'{"version": 1, "bindings": [["messaging"]]}')
+    assert load_snapshot(str(path)) == []
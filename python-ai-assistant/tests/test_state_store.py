@@ -0,0 +1,248 @@
+"""Bindings, leases and queues of the state stores"""
+
+import asyncio
+import contextlib
+import time
+import pytest
+from conditions import until
+from registry import AgentBinding
+from state_store import (
+    _ACQUIRE_LEASE,
+    _RELEASE_LEASE,
+    MemoryStateStore,
+    RedisStateStore,
+    SQLiteStateStore,
+)
+
+STORES = ("memory", "sqlite", "redis", "redis-without-scripts")
+
+
+class FakeRedis:
+    """
+    A local stand-in speaking the Redis protocol, with the commands of the store.
+    It runs the lease scripts of the store, or rejects EVAL like minimal servers.
+    """
+
+    def __init__(self, scripts: bool):
+        self.scripts = scripts
+        self.commands = []
+        self.strings = {}
+        self.expires = {}
+        self.lists = {}
+        self.hashes = {}
+        self._server = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                count = int((await reader.readuntil(b"\r\n"))[1:-2])
+                args = []
+                for _ in range(count):
+                    length = int((await reader.readuntil(b"\r\n"))[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2].decode())
+                writer.write(self._reply(self._run(*args)))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    def _reply(self, value) -> bytes:
+        if isinstance(value, Exception):
+            return b"-%s\r\n" % str(value).encode()
+        if value is None:
+            return b"$-1\r\n"
+        if value == "OK":
+            return b"+OK\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(map(self._reply, value))
+        data = value.encode()
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    def _get(self, key):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.strings.pop(key, None)
+            del self.expires[key]
+        return self.strings.get(key)
+
+    def _set(self, key, value, ttl_ms):
+        self.strings[key] = value
+        self.expires[key] = time.monotonic() + int(ttl_ms) / 1000
+
+    def _run(self, command, *args):
+        self.commands.append(command)
+        if command == "EVAL":
+            if not self.scripts:
+                return RuntimeError("ERR unknown command 'EVAL'")
+            script, _, key, *argv = args
+            holder = self._get(key)
+            if script == _ACQUIRE_LEASE:
+                if holder in (None, argv[0]):
+                    self._set(key, argv[0], argv[1])
+                    return 1
+                return 0
+            if script == _RELEASE_LEASE:
+                if holder == argv[0]:
+                    del self.strings[key]
+                    return 1
+                return 0
+            return RuntimeError("ERR unexpected script")
+        if command == "SET":
+            key, value, condition, _, ttl_ms = args
+            assert condition == "NX"
+            if self._get(key) is not None:
+                return None
+            self._set(key, value, ttl_ms)
+            return "OK"
+        if command == "GET":
+            return self._get(args[0])
+        if command == "PEXPIRE":
+            self.expires[args[0]] = time.monotonic() + int(args[1]) / 1000
+            return 1
+        if command == "DEL":
+            return 1 if self.strings.pop(args[0], None) is not None else 0
+        if command in ("RPUSH", "LPUSH"):
+            items = self.lists.setdefault(args[0], [])
+            if command == "RPUSH":
+                items.append(args[1])
+            else:
+                items.insert(0, args[1])
+            return len(items)
+        if command == "LPOP":
+            items = self.lists.get(args[0])
+            return items.pop(0) if items else None
+        if command == "LLEN":
+            return len(self.lists.get(args[0], []))
+        if command == "HSET":
+            self.hashes.setdefault(args[0], {})[args[1]] = args[2]
+            return 1
+        if command == "HGET":
+            return self.hashes.get(args[0], {}).get(args[1])
+        if command == "HDEL":
+            return 1 if self.hashes.get(args[0], {}).pop(args[1], None) else 0
+        if command == "HGETALL":
+            return [
+                item for pair in self.hashes.get(args[0], {}).items() for item in pair
+            ]
+        return RuntimeError(f"ERR unknown command '{command}'")
+
+
+@contextlib.asynccontextmanager
+async def open_store(kind: str, directory):
+    server = None
+    if kind == "memory":
+        store = MemoryStateStore()
+    elif kind == "sqlite":
+        store = SQLiteStateStore(str(directory / "state.db"))
+    else:
+        server = FakeRedis(scripts=kind == "redis")
+        store = RedisStateStore("127.0.0.1", await server.start())
+    try:
+        yield store
+    finally:
+        await store.close()
+        if server is not None:
+            await server.close()
+
+
+def binding(bot_id: str, platform: str = "openai") -> AgentBinding:
+    return AgentBinding(bot_id, "messaging", bot_id[len("ai-bot-") :], platform)
+
+
+@pytest.mark.parametrize("kind", STORES)
+def test_bindings(kind, tmp_path):
+    async def run():
+        async with open_store(kind, tmp_path) as store:
+            await store.save_binding(binding("ai-bot-a"))
+            await store.save_binding(binding("ai-bot-b"))
+            await store.save_binding(binding("ai-bot-a", "anthropic"))
+            loaded = await store.load_binding("ai-bot-a")
+            await store.delete_binding("ai-bot-b")
+            return loaded, await store.list_bindings(), await store.load_binding("x")
+
+    loaded, listed, missing = asyncio.run(run())
+    assert loaded == binding("ai-bot-a", "anthropic")
+    assert listed == [binding("ai-bot-a", "anthropic")]
+    assert missing is None
+
+
+@pytest.mark.parametrize("kind", STORES)
+def test_lease_is_held_renewed_and_released_by_its_owner(kind, tmp_path):
+    async def run():
+        async with open_store(kind, tmp_path) as store:
+            steps = [
+                await store.acquire_lease("k", "a", 30),
+                await store.acquire_lease("k", "b", 30),
+                # Renewed by its owner
+                await store.acquire_lease("k", "a", 30),
+            ]
+            # Only its owner releases it
+            await store.release_lease("k", "b")
+            steps.append(await store.acquire_lease("k", "b", 30))
+            await store.release_lease("k", "a")
+            steps.append(await store.acquire_lease("k", "b", 30))
+            steps.append(await store.acquire_lease("other", "a", 30))
+            return steps
+
+    assert asyncio.run(run()) == [True, False, True, False, True, True]
+
+
+@pytest.mark.parametrize("kind", STORES)
+def test_expired_lease_is_taken_over(kind, tmp_path):
+    async def run():
+        async with open_store(kind, tmp_path) as store:
+            assert await store.acquire_lease("k", "a", 0.5)
+            refused = not await store.acquire_lease("k", "b", 30)
+            await until(lambda: store.acquire_lease("k", "b", 30))
+            return refused, await store.acquire_lease("k", "a", 30)
+
+    assert asyncio.run(run()) == (True, False)
+
+
+@pytest.mark.parametrize("kind", STORES)
+def test_queue_is_fifo_per_key(kind, tmp_path):
+    async def run():
+        async with open_store(kind, tmp_path) as store:
+            for payload in ("1", "2", "3"):
+                await store.push_message("k", payload)
+            await store.push_message("other", "x")
+            first = await store.pop_message("k")
+            # Taken and put back, it is the first again
+            await store.return_message("k", first)
+            lengths = await store.queue_length("k"), await store.queue_length("other")
+            popped = [await store.pop_message("k") for _ in range(4)]
+            return lengths, popped, await store.queue_length("k")
+
+    lengths, popped, left = asyncio.run(run())
+    assert lengths == (3, 1)
+    assert popped == ["1", "2", "3", None]
+    assert left == 0
+
+
+@pytest.mark.parametrize("scripts", (True, False))
+def test_redis_leases_use_scripts_when_the_server_runs_them(scripts):
+    async def run():
+        server = FakeRedis(scripts)
+        store = RedisStateStore("127.0.0.1", await server.start())
+        await store.acquire_lease("k", "a", 30)
+        await store.acquire_lease("k", "a", 30)
+        await store.release_lease("k", "a")
+        await store.close()
+        await server.close()
+        return server.commands, store.scripts
+
+    commands, used_scripts = asyncio.run(run())
+    if scripts:
+        assert commands == ["EVAL", "EVAL", "EVAL"]
+    else:
+        # EVAL is only tried once
+        assert commands == ["EVAL", "SET", "SET", "GET", "PEXPIRE", "GET", "DEL"]
+    assert used_scripts is scripts
@@ -0,0 +1,55 @@
+"""Fast path of the /new-message webhooks"""
+
+import pytest
+from webhooks import compact_message, drop_reason, read_webhook
+
+
+def new_message(**message):
+    return {"type": "message.new", "message": message}
+
+
+def test_only_json_objects_are_read():
+    assert read_webhook(b'{"type": "message.new"}') == {"type": "message.new"}
+    with pytest.raises(ValueError):
+        read_webhook(b"[1, 2]")
+    with pytest.raises(ValueError):
+        read_webhook(b"{not json")
+
+
+def test_webhooks_no_agent_would_answer_are_dropped():
+    assert drop_reason({"type": "message.read"}) == "type"
+    assert drop_reason({"type": ["message.new"]}) == "type"
+    assert drop_reason({}) == "type"
+    assert drop_reason({"type": "message.new"}) == "empty"
+    assert drop_reason(new_message(text="  ")) == "empty"
+    assert drop_reason(new_message(text=None)) == "empty"
+    assert drop_reason(new_message(text="Hi", ai_generated=True)) == "ai_generated"
+
+
+def test_answerable_webhooks_are_delivered():
+    assert drop_reason(new_message(text="Hi")) is None
+    assert drop_reason({"type": "ai_indicator.stop"}) is None
+
+
+def test_only_the_fields_used_by_the_agents_are_kept():
+    message = {
+        "id": "m1",
+        "text": "Hi",
+        "html": "<p>Hi</p>",
+        "parent_id": "p1",
+        "user": {"id": "u1", "name": "User", "image": "https://example.com/u1.png"},
+        "reactions": [],
+    }
+    assert compact_message(message) == {
+        "id": "m1",
+        "text": "Hi",
+        "type": "regular",
+        "parent_id": "p1",
+        "user": {"id": "u1"},
+    }
+    assert compact_message({"text": None, "user": "u1"}) == {
+        "id": "",
+        "text": "",
+        "type": "regular",
+    }
+    assert compact_message("Hi") is None
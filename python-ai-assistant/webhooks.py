@@ -0,0 +1,82 @@
+"""Fast path of the /new-message webhooks, most of them are dropped unparsed"""
+
+from typing import Any, Dict, Optional
+import orjson
+from metrics import REGISTRY, Counter
+from model import WebhookMessage
+
+MESSAGE_NEW = "message.new"
+
+# Webhooks delivered to the agents, every other type is dropped
+HANDLED_TYPES = frozenset((MESSAGE_NEW, "ai_indicator.stop"))
+# Types counted under their own label, the type is set by the caller so any other
+# one is counted as "other" to keep the number of series bounded
+COUNTED_TYPES = HANDLED_TYPES | frozenset(
+    (
+        "message.updated",
+        "message.deleted",
+        "message.read",
+        "reaction.new",
+        "reaction.deleted",
+        "ai_indicator.update",
+        "ai_indicator.clear",
+    )
+)
+
+DROPPED = REGISTRY.register(
+    Counter(
+        "ai_webhooks_dropped_total",
+        "Webhooks dropped before reaching an agent, by reason",
+        ("reason",),
+    )
+)
+
+
+def read_webhook(body: bytes) -> Dict[str, Any]:
+    """The JSON object of a webhook, raises a ValueError if it isn't one"""
+    event = orjson.loads(body)
+    if not isinstance(event, dict):
+        raise ValueError("Webhook is not a JSON object")
+    return event
+
+
+def type_label(event_type: Any) -> str:
+    """The label of the webhook counter for the type of an event"""
+    if isinstance(event_type, str) and event_type in COUNTED_TYPES:
+        return event_type
+    return "other"
+
+
+def drop_reason(event: Dict[str, Any]) -> Optional[str]:
+    """Why no agent would answer the webhook, None if it should be delivered"""
+    event_type = event.get("type")
+    if not isinstance(event_type, str) or event_type not in HANDLED_TYPES:
+        return "type"
+    if event_type != MESSAGE_NEW:
+        return None
+    message = event.get("message")
+    if not isinstance(message, dict):
+        return "empty"
+    if message.get("ai_generated"):
+        return "ai_generated"
+    text = message.get("text")
+    if not isinstance(text, str) or not text.strip():
+        return "empty"
+    return None
+
+
+def compact_message(message: Any) -> Optional[WebhookMessage]:
+    """The fields of the webhook message the agents use, the rest is left out"""
+    if not isinstance(message, dict):
+        return None
+    compact: WebhookMessage = {
+        "id": message.get("id") or "",
+        "text": message.get("text") or "",
+        "type": message.get("type") or "regular",
+    }
+    if message.get("parent_id"):
+        compact["parent_id"] = message["parent_id"]
+    user = message.get("user")
+    if isinstance(user, dict) and user.get("id"):
+        compact["user"] = {"id": user["id"]}
+    return compact